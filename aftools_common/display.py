@@ -0,0 +1,158 @@
+from collections import Counter
+from contextlib import contextmanager
+import sys
+import threading
+import time
+
+
+class my_colors : 
+    HEADER = "\033[38;5;218m"
+    OKBLUE = "\033[94m"
+    OKCYAN = "\033[38;5;140m"
+    OKGREEN = "\033[38;5;121m"
+    WARNING = "\033[94m" #change this back to 93 
+    FAIL = "\033[38;5;198m"
+    ENDC = "\033[0m"
+    BOLD = "\033[1m"
+    UNDERLINE = "\033[4m"
+
+
+def formats_duration(seconds) : 
+    seconds = int(seconds)
+    if seconds >= 3600 : return f'{seconds // 3600}h{seconds % 3600 // 60:02d}m'
+    if seconds >= 60 : return f'{seconds // 60}m{seconds % 60:02d}s'
+    return f'{seconds}s'
+
+
+class Progress : 
+    #L : one line for a whole batch, redrawn in place at most every interval on a terminal, and a summary line every summary_interval otherwise
+    def __init__(self, display, label, total=None, interval=0.2, summary_interval=30, quiet=False):
+        self.display = display
+        self.quiet = quiet
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.summary_interval = summary_interval
+        self.counts = Counter()
+        self.done = 0
+        #L : items a previous run already finished, they count in the total but not in the rate
+        self.resumed = 0
+        self.in_flight = 0
+        self.tracked = False
+        self.started = time.time()
+        self.drawn = 0
+        self.printed = None
+        self.lock = threading.Lock()
+        self.tty = sys.stdout.isatty()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def advance(self, state='done', n=1, final=True, resumed=False):
+        with self.lock: 
+            self.counts[state] += n
+            if final: self.done += n
+            if resumed: self.resumed += n
+        self.refreshes()
+
+    def sets(self, counts, done):
+        #L : for polling loops that know the state of every item at once
+        with self.lock: 
+            self.counts = Counter(counts)
+            self.done = done
+        self.refreshes()
+
+    @contextmanager
+    def tracks(self):
+        with self.lock: 
+            self.in_flight += 1
+            self.tracked = True
+        try: 
+            yield
+        finally: 
+            with self.lock: self.in_flight -= 1
+
+    def line(self):
+        elapsed = max(time.time() - self.started, 1e-9)
+        rate = (self.done - self.resumed) / elapsed
+        parts = [f'{self.label} : {self.done}' + (f'/{self.total}' if self.total else '')]
+        if self.total: parts[0] += f' ({100 * self.done / self.total:.0f}%)'
+        parts += [f'{state} {count}' for state, count in self.counts.items() if count]
+        parts.append(f'{rate:.1f}/s')
+        if self.tracked: parts.append(f'{self.in_flight} in flight')
+        if self.total and rate > 0 and self.done < self.total: parts.append(f'ETA {formats_duration((self.total - self.done) / rate)}')
+        parts.append(formats_duration(elapsed))
+        return ' | '.join(parts)
+
+    def refreshes(self, force=False):
+        if self.quiet or self.display.quiet: return
+        now = time.time()
+        if not force and now - self.drawn < (self.interval if self.tty else self.summary_interval): return
+        self.drawn = now
+        if self.tty: 
+            self.display.progress_line = True
+            print(f'\r\033[K{my_colors.OKCYAN}{self.line()}{my_colors.ENDC}', end='', flush=True)
+        else: 
+            self.printed = (self.done, tuple(self.counts.items()))
+            print(self.line(), flush=True)
+
+    def close(self):
+        if self.quiet or self.display.quiet: return
+        if self.tty: 
+            print(f'\r\033[K{my_colors.OKCYAN}{self.line()}{my_colors.ENDC}', flush=True)
+            self.display.progress_line = False
+        elif self.printed != (self.done, tuple(self.counts.items())): 
+            print(self.line(), flush=True)
+
+
+class Display :
+    def __init__(self, quiet=False):
+        self.quiet = quiet
+        self.progress_line = False
+
+    def progress(self, label, total=None, interval=0.2, summary_interval=30, quiet=False):
+        return Progress(self, label, total, interval, summary_interval, quiet)
+        
+    def __call__(self, label="", value="", color: my_colors=my_colors.OKCYAN, end=None, adjust=30) -> None:
+        if self.quiet: return
+        if label.isspace() or label == "":
+            print(label)
+            return
+        label = label.ljust(adjust) if adjust > 0 else label
+        print(f"{color}{label}{my_colors.ENDC}{value}",end=end)
+
+    def header(self, *args, end="\n"): 
+        self.__print(*args, color=my_colors.HEADER, end=end)
+
+    def info(self, *args, end="\n"):
+        self.__print(*args, color=my_colors.OKCYAN, end=end)
+
+    def warning(self, *args, end="\n"):
+        self.__print(*args, color=my_colors.WARNING, end=end)
+
+    def error(self, *args, end="\n"):
+        self.__print(*args, color=my_colors.FAIL, end=end)
+    
+    def print(self, *args, end="\n"):
+        self.__print(*args, end=end)
+
+    def __print(self, *args, color="", end):
+        if self.quiet: return
+        #L : a message in the middle of a progress bar takes its line, the bar is drawn again below at its next update
+        if self.progress_line: 
+            print('\r\033[K', end='')
+            self.progress_line = False
+        # check if all args are strings
+        if all(isinstance(arg, str) for arg in args):
+            msg = ",".join(list(args))
+            print(f"{color}{msg}{my_colors.ENDC}", end=end)
+        else:
+            for arg in args:
+                print(f"{color}{arg}{my_colors.ENDC}", end='')
+            print(end, end=end)
+
+    def ok(self, *args, end="\n"):
+        self.__print(*args, color=my_colors.OKGREEN, end=end)
@@ -0,0 +1,158 @@
+from array import array
+from bisect import bisect_left
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+import json
+import mmap
+import os
+
+
+WHITESPACE = b' \t\r\n'
+PAIR_SEPARATOR = b':'
+
+
+class FastaReader :
+    #L : reads a FASTA file or an "id : sequence" file through a memory map, records come out one at a time and only the pages being read stay in memory
+    def __init__(self, path, index_path = None) :
+        self.path = Path(path)
+        self.index_path = Path(index_path) if index_path else None
+        self.size = self.path.stat().st_size
+        self.data = None
+        if self.size :
+            with open(self.path, 'rb') as handle :
+                self.data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        self.format = self.detects_format()
+        self.malformed = []
+        self.ids, self.starts, self.ends = None, None, None
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, *args) :
+        self.close()
+
+    def __iter__(self) :
+        return self.records()
+
+    def close(self) :
+        if self.data is not None : self.data.close()
+        self.data = None
+
+    def detects_format(self) -> str :
+        if self.data is None : return 'fasta'
+        position = 0
+        while position < self.size and self.data[position:position + 1] in [b' ', b'\t', b'\r', b'\n'] : position += 1
+        return 'fasta' if self.data[position:position + 1] == b'>' else 'pairs'
+
+    def scans(self) -> Iterator[Tuple[bytes, int, int]] :
+        #L : (header or id, start, end) of every record, the sequence is data[start:end] with its line breaks
+        #L : a record without an id is not given out, it goes to malformed with its line like a line without separator
+        self.malformed = []
+        if self.data is None : return
+        data, size = self.data, self.size
+        if self.format == 'fasta' :
+            #L : line numbers are only counted up to the records without an id, from the previous one
+            counted, line_num = 0, 1
+            header = data.find(b'>')
+            while header != -1 :
+                line_end = data.find(b'\n', header)
+                if line_end == -1 : line_end = size
+                following = data.find(b'\n>', line_end)
+                end = size if following == -1 else following + 1
+                if data[header + 1:line_end].split() : yield data[header + 1:line_end].strip(), line_end + 1, end
+                else : 
+                    line_num += data[counted:header].count(b'\n')
+                    counted = header
+                    self.malformed.append((line_num, f'> without an id, {len(self.sequence_at(line_end + 1, end))} residues skipped'))
+                header = following + 1 if following != -1 else -1
+            return
+
+        start, line_num = 0, 0
+        while start < size :
+            line_end = data.find(b'\n', start)
+            if line_end == -1 : line_end = size
+            line_num += 1
+            separator = data.find(PAIR_SEPARATOR, start, line_end)
+            if separator != -1 and data[start:separator].strip() :
+                yield data[start:separator].strip(), separator + 1, line_end
+            elif data[start:line_end].strip() :
+                self.malformed.append((line_num, data[start:line_end].decode(errors='replace').strip()))
+            start = line_end + 1
+
+    def splits_header(self, header : bytes) -> Tuple[str, str] :
+        #L : the id of a FASTA record is the first word of its header, as Biopython gives it, an "id : sequence" line keeps its whole id
+        text = header.decode(errors='replace')
+        if self.format == 'pairs' : return text, ''
+        parts = text.split(None, 1)
+        return (parts[0] if parts else ''), (parts[1] if len(parts) > 1 else '')
+
+    def sequence_at(self, start : int, end : int) -> str :
+        return self.data[start:end].translate(None, WHITESPACE).decode()
+
+    def records(self, descriptions : bool = False) -> Iterator[Tuple] :
+        for header, start, end in self.scans() :
+            id, description = self.splits_header(header)
+            if not id : continue
+            if descriptions : yield id, description, self.sequence_at(start, end)
+            else : yield id, self.sequence_at(start, end)
+
+    def chunks(self, size : int) -> Iterator[dict] :
+        chunk = {}
+        for id, sequence in self.records() :
+            chunk[id] = sequence
+            if len(chunk) >= size :
+                yield chunk
+                chunk = {}
+        if chunk : yield chunk
+
+    def index_is_current(self) -> bool :
+        if self.index_path is None or not self.index_path.exists() : return False
+        with open(self.index_path, 'r') as index_file :
+            meta = json.loads(index_file.readline()[1:] or '{}')
+        stat = self.path.stat()
+        return meta.get('size') == stat.st_size and meta.get('mtime') == stat.st_mtime_ns
+
+    def builds_index(self) :
+        #L : ids sorted next to two arrays of offsets, a binary search finds a record without a dictionary of millions of entries
+        records = sorted((self.splits_header(header)[0], start, end) for header, start, end in self.scans())
+        records = [record for record in records if record[0]]
+        self.ids = [id for id, _, _ in records]
+        self.starts = array('q', (start for _, start, _ in records))
+        self.ends = array('q', (end for _, _, end in records))
+        if self.index_path is None : return
+        stat = self.path.stat()
+        tmp_path = self.index_path.with_name(f'.{self.index_path.name}.tmp')
+        with open(tmp_path, 'w') as index_file :
+            index_file.write('#' + json.dumps({'path' : str(self.path), 'size' : stat.st_size, 'mtime' : stat.st_mtime_ns}) + '\n')
+            for id, start, end in records : index_file.write(f'{id}\t{start}\t{end}\n')
+        os.replace(tmp_path, self.index_path)
+
+    def loads_index(self) :
+        self.ids, self.starts, self.ends = [], array('q'), array('q')
+        with open(self.index_path, 'r') as index_file :
+            next(index_file)
+            for line in index_file :
+                id, start, end = line.rstrip('\n').split('\t')
+                self.ids.append(id)
+                self.starts.append(int(start))
+                self.ends.append(int(end))
+
+    def index(self) :
+        if self.ids is not None : return self
+        if self.index_is_current() : self.loads_index()
+        else : self.builds_index()
+        return self
+
+    def __contains__(self, id : str) -> bool :
+        self.index()
+        position = bisect_left(self.ids, id)
+        return position < len(self.ids) and self.ids[position] == id
+
+    def get(self, id : str) -> Optional[str] :
+        self.index()
+        position = bisect_left(self.ids, id)
+        if position == len(self.ids) or self.ids[position] != id : return None
+        return self.sequence_at(self.starts[position], self.ends[position])
+
+    def gets_many(self, ids : List[str]) -> dict :
+        return {id : sequence for id, sequence in ((id, self.get(id)) for id in ids) if sequence is not None}
@@ -0,0 +1,234 @@
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+
+PREFIX = 'aftools'
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+PHASE_BUCKETS = [0.001, 0.01, 0.1, 1, 10, 60, 300, 1800, 3600]
+#L : path segments with two digits or more are ids (accessions, job ids, RIDs), they are folded so that an endpoint stays one series
+ID_SEGMENT = re.compile(r'^[^.]*\d[^.]*\d[^.]*')
+COMMAND_PARAMS = ['CMD', 'FORMAT_OBJECT']
+
+
+def endpoint_of(url : str, body = None) -> str :
+    parsed = urlparse(url)
+    path = '/'.join(ID_SEGMENT.sub('{id}', segment) for segment in parsed.path.split('/'))
+    #L : the BLAST URL API has a single path, the command tells submissions, polls and downloads apart
+    params = parse_qs(parsed.query)
+    if isinstance(body, bytes) : body = body.decode(errors='replace')
+    if isinstance(body, str) and '=' in body : params.update(parse_qs(body))
+    command = ' '.join(params[param][0] for param in COMMAND_PARAMS if param in params)
+    return f'{path} {command}' if command else path
+
+
+def escapes(value) -> str :
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram :
+    def __init__(self, buckets : List[float]) :
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value : float) :
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> Dict[str, int] :
+        total, cumulative = 0, {}
+        for bound, count in zip(self.buckets + ['+Inf'], self.counts) :
+            total += count
+            cumulative[str(bound)] = total
+        return cumulative
+
+
+class Metrics :
+    def __init__(self) :
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.gauges = defaultdict(float)
+        self.histograms = {}
+        self.started = time.time()
+        self.http_original = None
+
+    def inc(self, name : str, value : float = 1, **labels) :
+        with self.lock : self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def gauge(self, name : str, delta : float, **labels) :
+        with self.lock : self.gauges[(name, tuple(sorted(labels.items())))] += delta
+
+    def observe(self, name : str, value : float, buckets : List[float] = LATENCY_BUCKETS, **labels) :
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock :
+            if key not in self.histograms : self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def phase(self, name : str) :
+        start = time.perf_counter()
+        self.gauge('phase_in_progress', 1, phase=name)
+        try :
+            yield
+        finally :
+            self.gauge('phase_in_progress', -1, phase=name)
+            self.observe('phase_seconds', time.perf_counter() - start, PHASE_BUCKETS, phase=name)
+
+    def times(self, name : str) :
+        def decorator(function) :
+            @wraps(function)
+            def timed(*args, **kwargs) :
+                with self.phase(name) : return function(*args, **kwargs)
+            return timed
+        return decorator
+
+    def instruments_http(self) :
+        #L : every request of requests goes through HTTPAdapter.send, sessions and plain requests.get alike, so one hook covers all the clients
+        from requests.adapters import HTTPAdapter
+        if self.http_original is not None : return
+        self.http_original = original = HTTPAdapter.send
+        metrics = self
+
+        def send(adapter, request, **kwargs) :
+            labels = {'service' : urlparse(request.url).hostname or '', 'endpoint' : endpoint_of(request.url, request.body)}
+            sent = request.body if isinstance(request.body, (bytes, str)) else b''
+            metrics.gauge('http_in_flight', 1, **labels)
+            status = 'error'
+            start = time.perf_counter()
+            try :
+                response = original(adapter, request, **kwargs)
+                status = str(response.status_code)
+                retries = getattr(response.raw, 'retries', None)
+                if retries is not None and retries.history : metrics.inc('http_retries_total', len(retries.history), **labels)
+                length = response.headers.get('Content-Length', '')
+                if length.isdigit() : received = int(length)
+                else : received = 0 if kwargs.get('stream') else len(response.content)
+                metrics.inc('http_received_bytes_total', received, **labels)
+                return response
+            finally :
+                metrics.gauge('http_in_flight', -1, **labels)
+                metrics.inc('http_requests_total', 1, status=status, **labels)
+                metrics.inc('http_sent_bytes_total', len(sent), **labels)
+                metrics.observe('http_request_seconds', time.perf_counter() - start, **labels)
+
+        HTTPAdapter.send = send
+
+    def snapshot(self) -> Dict :
+        with self.lock :
+            return {
+                'uptime_seconds' : time.time() - self.started,
+                'counters' : [{'name' : name, 'labels' : dict(labels), 'value' : value} for (name, labels), value in sorted(self.counters.items())],
+                'gauges' : [{'name' : name, 'labels' : dict(labels), 'value' : value} for (name, labels), value in sorted(self.gauges.items())],
+                'histograms' : [{'name' : name, 'labels' : dict(labels), 'count' : histogram.count, 'sum' : histogram.sum, 'buckets' : histogram.cumulative()}
+                                for (name, labels), histogram in sorted(self.histograms.items())]
+            }
+
+    def prometheus(self) -> str :
+        def labels_of(labels, extra = ()) :
+            pairs = list(labels) + list(extra)
+            if not pairs : return ''
+            return '{' + ','.join(f'{key}="{escapes(value)}"' for key, value in pairs) + '}'
+
+        snapshot = self.snapshot()
+        lines = [f'# TYPE {PREFIX}_uptime_seconds gauge', f"{PREFIX}_uptime_seconds {snapshot['uptime_seconds']:.3f}"]
+        typed = set()
+        for kind, entries in [('counter', snapshot['counters']), ('gauge', snapshot['gauges'])] :
+            for entry in entries :
+                name = f"{PREFIX}_{entry['name']}"
+                if name not in typed :
+                    lines.append(f'# TYPE {name} {kind}')
+                    typed.add(name)
+                lines.append(f"{name}{labels_of(entry['labels'].items())} {entry['value']:.17g}")
+        for entry in snapshot['histograms'] :
+            name = f"{PREFIX}_{entry['name']}"
+            if name not in typed :
+                lines.append(f'# TYPE {name} histogram')
+                typed.add(name)
+            for bound, count in entry['buckets'].items() :
+                lines.append(f"{name}_bucket{labels_of(entry['labels'].items(), [('le', bound)])} {count}")
+            lines.append(f"{name}_sum{labels_of(entry['labels'].items())} {entry['sum']:.6f}")
+            lines.append(f"{name}_count{labels_of(entry['labels'].items())} {entry['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def writes(self, path) :
+        #L : .json gives a snapshot, anything else the Prometheus text format, for the node exporter textfile collector
+        path = Path(path)
+        text = json.dumps(self.snapshot(), indent=2) if path.suffix == '.json' else self.prometheus()
+        tmp_path = path.with_name(f'.{path.name}.tmp')
+        with open(tmp_path, 'w') as output : output.write(text)
+        os.replace(tmp_path, path)
+        return path
+
+    def phase_summary(self) -> List[str] :
+        with self.lock :
+            phases = [(dict(labels)['phase'], histogram) for (name, labels), histogram in self.histograms.items() if name == 'phase_seconds']
+        return [f'{phase} : {histogram.sum:.2f} s over {histogram.count} calls' for phase, histogram in sorted(phases, key=lambda item : -item[1].sum)]
+
+
+class Profiler :
+    #L : cprofile is exact but only sees the main thread, sample walks the stacks of every thread and writes collapsed stacks for flame graphs
+    def __init__(self, mode : Optional[str], path, interval : float = 0.005) :
+        self.mode = mode
+        self.path = Path(path)
+        self.interval = interval
+        self.profile = None
+        self.stacks = Counter()
+        self.running = False
+        self.thread = None
+
+    def start(self) :
+        if self.mode == 'cprofile' :
+            #L : cProfile and pstats are only imported when a run asks for a profile
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        elif self.mode == 'sample' :
+            self.running = True
+            self.thread = threading.Thread(target=self.samples, daemon=True)
+            self.thread.start()
+        return self
+
+    def samples(self) :
+        own = threading.get_ident()
+        while self.running :
+            for thread_id, frame in sys._current_frames().items() :
+                if thread_id == own : continue
+                stack = []
+                while frame is not None :
+                    stack.append(f'{Path(frame.f_code.co_filename).name}:{frame.f_code.co_name}')
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def stop(self) -> Optional[Path] :
+        if self.mode == 'cprofile' and self.profile is not None :
+            import io, pstats
+            self.profile.disable()
+            self.profile.dump_stats(self.path.with_suffix('.prof'))
+            text = io.StringIO()
+            pstats.Stats(self.profile, stream=text).sort_stats('cumulative').print_stats(40)
+            with open(self.path.with_suffix('.txt'), 'w') as report : report.write(text.getvalue())
+            return self.path.with_suffix('.prof')
+        if self.mode == 'sample' and self.thread is not None :
+            self.running = False
+            self.thread.join()
+            with open(self.path.with_suffix('.folded'), 'w') as folded :
+                for stack, count in self.stacks.most_common() : folded.write(f'{stack} {count}\n')
+            return self.path.with_suffix('.folded')
+        return None
+
+
+metrics = Metrics()
@@ -0,0 +1,16 @@
+import os
+
+
+def lazy_settings(namespace : dict, required : dict, optional : dict) : 
+    #L : the module __getattr__ of a config, the settings are read from the environment the first time they are imported, so a mode only requires the variables it uses, and --help none
+    def __getattr__(name) : 
+        if name in required : 
+            if name not in os.environ : raise Exception(required[name])
+            value = os.environ[name]
+        elif name in optional : 
+            value = optional[name]()
+        else : 
+            raise AttributeError(f"module {namespace['__name__']!r} has no attribute {name!r}")
+        namespace[name] = value
+        return value
+    return __getattr__
@@ -0,0 +1,196 @@
+from blast_xml import ITERATION, ITERATIONS_OPEN, ITERATIONS_CLOSE, format_blast_tabular, format_blast_xml
+from synthetic import blast_hits, interpro_result, taxonomy_node, uniprot_entry
+
+from dataclasses import dataclass
+from typing import Dict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, parse_qsl, urlparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+
+
+@dataclass
+class MockSettings :
+    latency : float = 0.005
+    jitter : float = 0.0
+    error_rate : float = 0.0
+    queue_time : float = 0.5
+    seed : int = 0
+
+
+class MockHandler(BaseHTTPRequestHandler) :
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args) :
+        pass
+
+    @property
+    def settings(self) -> MockSettings :
+        return self.server.settings
+
+    def replies(self, text : str, status : int = 200, content_type : str = 'text/plain') :
+        body = text.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def simulates(self) -> bool :
+        #L : every request waits for the network latency, and fails with a 503 at the error rate, like a busy public server
+        with self.server.lock :
+            self.server.requests += 1
+            delay = self.settings.latency + self.server.rng.uniform(0, self.settings.jitter)
+            failing = self.server.rng.random() < self.settings.error_rate
+        if delay > 0 : time.sleep(delay)
+        if failing :
+            with self.server.lock : self.server.errors += 1
+            self.replies('Service temporarily unavailable', 503)
+        return not failing
+
+    def form(self) -> dict :
+        length = int(self.headers.get('Content-Length', 0))
+        return {key : values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+
+    def job_status(self, submitted : float) -> str :
+        elapsed = time.time() - submitted
+        if elapsed < self.settings.queue_time / 2 : return 'QUEUED'
+        if elapsed < self.settings.queue_time : return 'RUNNING'
+        return 'FINISHED'
+
+
+class InterproHandler(MockHandler) :
+    #L : iprscan5 REST, POST /run gives a job id, GET /status/{id} and GET /result/{id}/json
+    def do_POST(self) :
+        data = self.form()
+        if not self.simulates() : return
+        if not urlparse(self.path).path.endswith('/run') : return self.replies('Not found', 404)
+        job_id = f'iprscan5-R{next(self.server.counter)}-p1m'
+        with self.server.lock : self.server.jobs[job_id] = (time.time(), data.get('sequence', ''))
+        self.replies(job_id)
+
+    def do_GET(self) :
+        if not self.simulates() : return
+        parts = urlparse(self.path).path.strip('/').split('/')
+        job = self.server.jobs.get(parts[-2] if parts[-1] == 'json' else parts[-1])
+        if job is None : return self.replies('NOT_FOUND', 404)
+        if 'status' in parts : return self.replies(self.job_status(job[0]))
+        if 'result' in parts :
+            if self.job_status(job[0]) != 'FINISHED' : return self.replies('Job not finished', 400)
+            return self.replies(json.dumps(interpro_result(parts[-2], job[1])), content_type='application/json')
+        self.replies('Not found', 404)
+
+
+class BlastHandler(MockHandler) :
+    #L : the BLAST URL API, CMD=Put gives a RID, CMD=Get with FORMAT_OBJECT=SearchInfo polls it, CMD=Get fetches the result
+    def do_POST(self) :
+        data = self.form()
+        if not self.simulates() : return
+        if data.get('CMD') != 'Put' : return self.replies('Unknown command', 400)
+        queries = [(block.split('\n', 1)[0].split()[0], ''.join(block.split('\n')[1:])) for block in data.get('QUERY', '').split('>') if block.strip()]
+        rid = f'R{next(self.server.counter):08d}'
+        with self.server.lock : self.server.jobs[rid] = (time.time(), queries, data)
+        self.replies(f'<!--QBlastInfoBegin\n    RID = {rid}\n    RTOE = {int(self.settings.queue_time)}\nQBlastInfoEnd\n-->\n')
+
+    def do_GET(self) :
+        if not self.simulates() : return
+        query = dict(parse_qsl(urlparse(self.path).query))
+        search = self.server.jobs.get(query.get('RID'))
+        if search is None : return self.replies('Status=UNKNOWN\n')
+        submitted, queries, data = search
+        ready = self.job_status(submitted) == 'FINISHED'
+        if query.get('FORMAT_OBJECT') == 'SearchInfo' :
+            return self.replies('QBlastInfoBegin\n\tStatus=READY\n\tThereAreHits=yes\nQBlastInfoEnd\n' if ready else 'QBlastInfoBegin\n\tStatus=WAITING\nQBlastInfoEnd\n')
+        if not ready : return self.replies('Status=WAITING\n')
+
+        hitlist_size = int(data.get('HITLIST_SIZE', 50))
+        database, program = data.get('DATABASE', 'nr'), data.get('PROGRAM', 'blastp')
+        if query.get('FORMAT_TYPE') == 'Tabular' :
+            return self.replies(''.join(format_blast_tabular(name, name, blast_hits(name, len(sequence), hitlist_size), database, program, '2.16.0+')
+                                        for name, sequence in queries))
+
+        #L : one document with an iteration per query, as NCBI sends multi-query searches
+        documents = [format_blast_xml(f'Query_{i}', name, len(sequence), blast_hits(name, len(sequence), hitlist_size), database, 100000000, 40000000000, program, 'BLASTP 2.16.0+')
+                     for i, (name, sequence) in enumerate(queries, 1)]
+        if not documents : return self.replies('No query', 400)
+        head = documents[0][:documents[0].find(ITERATIONS_OPEN) + len(ITERATIONS_OPEN)]
+        tail = documents[0][documents[0].rfind(ITERATIONS_CLOSE):]
+        iterations = [ITERATION.search(document).group(0) for document in documents]
+        self.replies(head + '\n' + '\n'.join(iterations) + '\n' + tail, content_type='text/xml')
+
+
+class UniprotHandler(MockHandler) :
+    #L : /uniprotkb/accessions and /uniprotkb/{accession}.json as json, /taxonomy/search as TSV, the entries come from synthetic.uniprot_entry
+    def entry_json(self, accession : str) -> Dict :
+        entry = uniprot_entry(accession)
+        return {
+            'primaryAccession' : accession,
+            'proteinDescription' : {
+                'recommendedName' : {'fullName' : {'value' : entry['protein_name']}, 'ecNumbers' : [{'value' : entry['ec']}]},
+                'alternativeNames' : [{'fullName' : {'value' : f"{entry['protein_name']} homolog"}}]
+            },
+            'organism' : {'taxonId' : int(entry['organism_id'])},
+            'sequence' : {'length' : int(entry['length']), 'value' : entry['sequence']}
+        }
+
+    def do_GET(self) :
+        if not self.simulates() : return
+        url = urlparse(self.path)
+        query = dict(parse_qsl(url.query))
+        if url.path.endswith('/uniprotkb/accessions') :
+            results = [self.entry_json(accession) for accession in query.get('accessions', '').split(',') if accession.startswith('SYN')]
+            return self.replies(json.dumps({'results' : results}), content_type='application/json')
+        if url.path.endswith('/taxonomy/search') :
+            rows = ['Taxon Id\tScientific name\tRank\tParent']
+            for taxon_id in re.findall(r'tax_id:(\d+)', query.get('query', '')) :
+                node = taxonomy_node(int(taxon_id))
+                if node : rows.append(f"{taxon_id}\t{node['name']}\t{node['rank']}\t{node['parent']}")
+            return self.replies('\n'.join(rows) + '\n')
+        if url.path.endswith('.json') :
+            accession = url.path.rsplit('/', 1)[1][:-len('.json')]
+            if not accession.startswith('SYN') : return self.replies('{}', 404, 'application/json')
+            return self.replies(json.dumps(self.entry_json(accession)), content_type='application/json')
+        self.replies('Not found', 404)
+
+
+class MockHTTPServer(ThreadingHTTPServer) :
+    #L : the tools open up to 20 connections at once without a session, the default backlog of 5 resets them
+    request_queue_size = 256
+    daemon_threads = True
+
+
+class MockServer :
+    def __init__(self, handler, settings : MockSettings, path : str = '') :
+        self.server = MockHTTPServer(('127.0.0.1', 0), handler)
+        self.server.settings = settings
+        self.server.rng = random.Random(settings.seed)
+        self.server.lock = threading.Lock()
+        self.server.counter = itertools.count(1)
+        self.server.jobs = {}
+        self.server.requests = 0
+        self.server.errors = 0
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}{path}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self) :
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args) :
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self) :
+        return {'requests' : self.server.requests, 'errors' : self.server.errors}
+
+
+def starts_mock_servers(settings : MockSettings) :
+    return {
+        'interpro' : MockServer(InterproHandler, settings, '/Tools/services/rest/iprscan5'),
+        'blast' : MockServer(BlastHandler, settings, '/Blast.cgi'),
+        'uniprot' : MockServer(UniprotHandler, settings)
+    }
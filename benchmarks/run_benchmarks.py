@@ -0,0 +1,251 @@
+from pathlib import Path
+import sys
+
+ROOT = Path(__file__).resolve().parent.parent
+#L : the two tools are not installed packages, the benchmarks import them the way their own scripts do
+for path in [ROOT / 'benchmarks', ROOT / 'ncbi_blast_handler', ROOT / 'interpro_batch_analyzer'] :
+    if str(path) not in sys.path : sys.path.insert(0, str(path))
+
+from dataclasses import asdict
+import argparse
+import json
+import os
+import resource
+import subprocess
+import tempfile
+import time
+
+import synthetic
+
+
+SUITES = ['interpro', 'analysis', 'blast', 'uniprot']
+DEFAULT_SIZES = [100, 1000, 10000]
+
+
+def records_latencies() :
+    #L : every HTTP request of the tools goes through HTTPAdapter.send, timing it there covers plain requests.get calls and sessions alike
+    from requests.adapters import HTTPAdapter
+    latencies = []
+    send = HTTPAdapter.send
+
+    def timed_send(self, request, **kwargs) :
+        start = time.perf_counter()
+        try :
+            return send(self, request, **kwargs)
+        finally :
+            latencies.append(time.perf_counter() - start)
+
+    HTTPAdapter.send = timed_send
+    return latencies
+
+
+def percentile(values, q : float) :
+    if not values : return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def peak_rss_mb() :
+    #L : ru_maxrss is in kB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def silences_displays() :
+    from config import display as blast_display
+    from src.config import display as interpro_display
+    blast_display.quiet = True
+    interpro_display.quiet = True
+
+
+def runs_interpro(size : int, workplace : Path, poll_interval : float) :
+    from src.interpro_client import InterproClient, ClientConfig
+    results_dir = Path(os.environ['INTERPRO_RESULTS_DIR'])
+    client = InterproClient(ClientConfig(batch_size=100, results_dir=results_dir, workplace=workplace))
+    phases = {}
+
+    start = time.perf_counter()
+    infos = client.batch_submits(synthetic.sequences(size))
+    phases['submit'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    while True :
+        client.refresh()
+        with open(client.log_path, 'r') as log :
+            if not any(item['status'] in ['RUNNING', 'QUEUED'] for item in json.load(log)['list']) : break
+        time.sleep(poll_interval)
+    phases['refresh'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    client.updates_data()
+    phases['results'] = time.perf_counter() - start
+    return len(list(results_dir.glob('*.json'))), phases
+
+
+def runs_analysis(size : int, workplace : Path, poll_interval : float) :
+    from src.interpro_analysis import InterproAnalyzer, AnalysisConfig
+    results_dir = Path(os.environ['INTERPRO_RESULTS_DIR'])
+    start = time.perf_counter()
+    synthetic.writes_interpro_workplace(workplace, results_dir, size)
+    phases = {'setup' : time.perf_counter() - start}
+
+    analyzer = InterproAnalyzer(AnalysisConfig(results_dir=results_dir, workplace=workplace, keywords=['SIGNAL_PEPTIDE', 'PF00005']))
+    start = time.perf_counter()
+    analyzer.batch_analysis('analysisall')
+    phases['analysis'] = time.perf_counter() - start
+    with open(workplace / 'interpro_log.json', 'r') as log :
+        return sum(1 for item in json.load(log)['list'] if item['analysis']), phases
+
+
+def runs_blast(size : int, workplace : Path, poll_interval : float) :
+    from ncbi_blast import BlastJob, NCBIBlastClient, RemoteBlastBackend
+    results_dir = Path(os.environ['BLAST_RESULTS_DIR'])
+    results_dir.mkdir(parents=True, exist_ok=True)
+    jobs = [BlastJob(id=id, sequence=sequence) for id, sequence in synthetic.sequences(size).items()]
+    backend = RemoteBlastBackend(0, 10000, ledger_path=results_dir / '.rid_ledger.json', url=os.environ['NCBI_BLAST_URL'], poll_interval=poll_interval)
+    client = NCBIBlastClient(results_dir, 0, backend=backend)
+
+    start = time.perf_counter()
+    results = client.process_batch_jobs(jobs)
+    return len(results), {'batch' : time.perf_counter() - start}
+
+
+def runs_uniprot(size : int, workplace : Path, poll_interval : float) :
+    from uniprot import Uniprot
+    ids_path = workplace / 'ids.txt'
+    synthetic.writes_ids(ids_path, synthetic.accessions(size))
+    uniprot = Uniprot(cache_dir=workplace / '.uniprot_cache')
+
+    start = time.perf_counter()
+    count = uniprot.batch_gets_name_and_sequence(ids_path, workplace / 'names.txt')
+    return count, {'names' : time.perf_counter() - start}
+
+
+RUNNERS = {'interpro' : runs_interpro, 'analysis' : runs_analysis, 'blast' : runs_blast, 'uniprot' : runs_uniprot}
+
+
+def runs_case(suite : str, size : int, poll_interval : float) :
+    #L : this runs in its own process, so the peak RSS and the imports belong to this case only
+    silences_displays()
+    latencies = records_latencies()
+    workplace = Path(os.environ['WORKPLACE'])
+
+    start = time.perf_counter()
+    done, phases = RUNNERS[suite](size, workplace, poll_interval)
+    elapsed = time.perf_counter() - start
+    return {
+        'suite' : suite,
+        'size' : size,
+        'done' : done,
+        'seconds' : round(elapsed, 4),
+        'items_per_s' : round(done / elapsed, 2) if elapsed else None,
+        'phases' : {phase : round(seconds, 4) for phase, seconds in phases.items()},
+        'requests' : len(latencies),
+        'latency_ms' : {f'p{q}' : round(percentile(latencies, q) * 1000, 3) if latencies else None for q in [50, 90, 99]},
+        'peak_rss_mb' : round(peak_rss_mb(), 1)
+    }
+
+
+def spawns_case(suite : str, size : int, servers, args) :
+    with tempfile.TemporaryDirectory(prefix=f'bench_{suite}_{size}_') as workplace :
+        env = dict(os.environ)
+        env.update({
+            'WORKPLACE' : workplace,
+            'TOOLS' : str(ROOT),
+            'INTERPRO_RESULTS_DIR' : str(Path(workplace) / 'interpro'),
+            'INTERPRO_COOKIES' : env.get('INTERPRO_COOKIES') or 'benchmark=1',
+            'INTERPRO_API_URL' : servers['interpro'].url,
+            'BLAST_RESULTS_DIR' : str(Path(workplace) / 'blast'),
+            'NCBI_BLAST_URL' : servers['blast'].url,
+            'UNIPROT_REST_URL' : servers['uniprot'].url,
+            'UNIPROT_CACHE_DIR' : str(Path(workplace) / '.uniprot_cache')
+        })
+        env.pop('UNIPROT_DUMP', None)
+        Path(env['INTERPRO_RESULTS_DIR']).mkdir()
+        command = [sys.executable, __file__, '--case', suite, '--size', str(size), '--poll_interval', str(args.poll_interval)]
+        try :
+            process = subprocess.run(command, env=env, cwd=workplace, capture_output=True, text=True, timeout=args.timeout)
+        except subprocess.TimeoutExpired :
+            return {'suite' : suite, 'size' : size, 'error' : f'timed out after {args.timeout} s'}
+        if process.returncode != 0 :
+            return {'suite' : suite, 'size' : size, 'error' : process.stderr.strip().splitlines()[-1] if process.stderr.strip() else f'exit code {process.returncode}'}
+        return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def git_commit() :
+    try :
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError :
+        return None
+
+
+def previous_results(output_path : Path, settings : dict) :
+    #L : the last record of every suite and size measured with the same mock settings, to compare against
+    previous = {}
+    if not output_path.exists() : return previous
+    with open(output_path, 'r') as output :
+        for line in output :
+            record = json.loads(line)
+            if record.get('settings') == settings and 'items_per_s' in record :
+                previous[(record['suite'], record['size'])] = record
+    return previous
+
+
+def prints_result(result : dict, before : dict = None, threshold : float = 0.2) :
+    if 'error' in result :
+        print(f"{result['suite']:<10}{result['size']:>8}  failed : {result['error']}")
+        return
+    latency = ''.join(f'{value:>10.2f}' if value is not None else f"{'-':>10}" for value in result['latency_ms'].values())
+    line = (f"{result['suite']:<10}{result['size']:>8}{result['done']:>8}{result['seconds']:>10.2f}s{result['items_per_s']:>12.1f}/s"
+            f"{latency} ms{result['peak_rss_mb']:>10.1f} MB")
+    if before and before.get('items_per_s') :
+        change = result['items_per_s'] / before['items_per_s'] - 1
+        line += f'  {change:+.0%} vs {before.get("commit") or "last run"}'
+        if change < -threshold : line += '  REGRESSION'
+    print(line, flush=True)
+
+
+def main() :
+    parser = argparse.ArgumentParser('Offline benchmarks of the InterPro, BLAST and UniProt tools against local mock servers')
+    parser.add_argument('-s', '--suites', nargs='+', choices=SUITES, default=SUITES, help='The benchmarks to run (default: all)')
+    parser.add_argument('-n', '--sizes', nargs='+', type=int, default=DEFAULT_SIZES, help='The numbers of items of every benchmark, e.g. 100 1000 10000 100000')
+    parser.add_argument('-l', '--latency', type=float, default=0.005, help='The delay the mock servers add to every request, in seconds')
+    parser.add_argument('-j', '--jitter', type=float, default=0.0, help='A random extra delay of up to this many seconds per request')
+    parser.add_argument('-e', '--error_rate', type=float, default=0.0, help='The fraction of requests answered with a 503')
+    parser.add_argument('-q', '--queue_time', type=float, default=0.5, help='How long a submitted InterPro or BLAST job stays queued and running, in seconds')
+    parser.add_argument('-pi', '--poll_interval', type=float, default=0.1, help='The delay between two status checks of the benchmarked clients')
+    parser.add_argument('-t', '--timeout', type=float, default=3600, help='The time limit of every case, in seconds')
+    parser.add_argument('-r', '--regression', type=float, default=0.2, help='Flag a case whose throughput dropped by more than this fraction since the last run')
+    parser.add_argument('-o', '--output', default=str(ROOT / 'benchmarks' / 'results.jsonl'), help='Every result is appended to this JSON lines file')
+    parser.add_argument('--case', choices=SUITES, help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case :
+        print(json.dumps(runs_case(args.case, args.size, args.poll_interval)))
+        return
+
+    from mock_servers import MockSettings, starts_mock_servers
+    settings = MockSettings(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, queue_time=args.queue_time)
+    output_path = Path(args.output)
+    previous = previous_results(output_path, asdict(settings))
+    commit = git_commit()
+
+    servers = starts_mock_servers(settings)
+    for server in servers.values() : server.__enter__()
+    print(f"{'suite':<10}{'size':>8}{'done':>8}{'time':>11}{'throughput':>14}{'p50':>10}{'p90':>10}{'p99':>13}{'peak RSS':>13}")
+    try :
+        with open(output_path, 'a') as output :
+            for suite in args.suites :
+                for size in args.sizes :
+                    result = spawns_case(suite, size, servers, args)
+                    result.update({'commit' : commit, 'settings' : asdict(settings), 'timestamp' : time.strftime('%Y-%m-%dT%H:%M:%S')})
+                    prints_result(result, previous.get((suite, size)), args.regression)
+                    output.write(json.dumps(result) + '\n')
+                    output.flush()
+    finally :
+        for server in servers.values() : server.__exit__()
+
+
+if __name__ == '__main__' :
+    main()
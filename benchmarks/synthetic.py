@@ -0,0 +1,109 @@
+from pathlib import Path
+from typing import Dict, List
+import json
+import random
+
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+#L : rough natural frequencies, so that low complexity stretches and k-mer statistics look like real proteins
+FREQUENCIES = [8.3, 1.4, 5.5, 6.8, 3.9, 7.1, 2.3, 5.9, 5.8, 9.7, 2.4, 4.1, 4.7, 3.9, 5.3, 6.6, 5.3, 6.9, 1.1, 2.9]
+KEYWORDS = ['SIGNAL_PEPTIDE', 'TRANSMEMBRANE', 'PF00005', 'PF00072', 'IPR003593', 'cd03225']
+NAMES = ['ABC transporter', 'Response regulator', 'Uncharacterized protein', 'S-layer protein', 'Zinc finger protein',
+         'DNA-binding domain-containing protein', 'Histidine kinase', 'Glycosyltransferase', 'Outer membrane protein']
+
+
+def accessions(n : int, prefix : str = 'SYN') -> List[str] :
+    return [f'{prefix}{i:07d}' for i in range(n)]
+
+
+def random_sequence(rng : random.Random, length : int) -> str :
+    return 'M' + ''.join(rng.choices(AMINO_ACIDS, weights=FREQUENCIES, k=length - 1))
+
+
+def sequence_for(accession : str, min_length : int = 80, max_length : int = 600) -> str :
+    #L : every generator derives the protein from its accession, so the mock servers need no database
+    rng = random.Random(accession)
+    return random_sequence(rng, rng.randint(min_length, max_length))
+
+
+def sequences(n : int, prefix : str = 'SYN', min_length : int = 80, max_length : int = 600) -> Dict[str, str] :
+    return {accession : sequence_for(accession, min_length, max_length) for accession in accessions(n, prefix)}
+
+
+def writes_fasta(path, records : Dict[str, str], width : int = 60) :
+    with open(path, 'w') as fasta :
+        for title, sequence in records.items() :
+            fasta.write(f'>{title}\n')
+            for i in range(0, len(sequence), width) : fasta.write(sequence[i:i + width] + '\n')
+
+
+def writes_ids(path, ids : List[str]) :
+    with open(path, 'w') as ids_file :
+        for id in ids : ids_file.write(f'{id}\n')
+
+
+def uniprot_entry(accession : str) -> Dict :
+    rng = random.Random(accession)
+    sequence = sequence_for(accession)
+    return {
+        'accession' : accession,
+        'protein_name' : f'{rng.choice(NAMES)} {rng.randint(1, 99)}',
+        'ec' : f'3.6.3.{rng.randint(1, 50)}',
+        'length' : str(len(sequence)),
+        'sequence' : sequence,
+        'organism_id' : str(100000 + rng.randint(0, 499))
+    }
+
+
+def taxonomy_node(taxon_id : int) -> Dict :
+    #L : a five level tree, species (>= 100000) -> genus -> family -> phylum -> superkingdom -> root
+    if taxon_id >= 100000 : return {'name' : f'Species {taxon_id}', 'rank' : 'species', 'parent' : 10000 + taxon_id % 50}
+    if taxon_id >= 10000 : return {'name' : f'Genus {taxon_id}', 'rank' : 'genus', 'parent' : 1000 + taxon_id % 10}
+    if taxon_id >= 1000 : return {'name' : f'Family {taxon_id}', 'rank' : 'family', 'parent' : 100 + taxon_id % 3}
+    if taxon_id >= 100 : return {'name' : f'Phylum {taxon_id}', 'rank' : 'phylum', 'parent' : 2}
+    if taxon_id == 2 : return {'name' : 'Bacteria', 'rank' : 'superkingdom', 'parent' : 1}
+    return None
+
+
+def interpro_result(job_id : str, sequence : str) -> Dict :
+    rng = random.Random(job_id)
+    matches = []
+    for keyword in rng.sample(KEYWORDS, rng.randint(0, 3)) :
+        start = rng.randint(1, max(1, len(sequence) - 30))
+        matches.append({
+            'signature' : {'accession' : keyword, 'name' : keyword.lower(), 'signatureLibraryRelease' : {'library' : 'SYNTHETIC'}},
+            'locations' : [{'start' : start, 'end' : min(len(sequence), start + rng.randint(20, 200)), 'score' : rng.random()}]
+        })
+    return {'interproscan-version' : 'synthetic', 'results' : [{'sequence' : sequence, 'md5' : '', 'matches' : matches}]}
+
+
+def blast_hits(query_id : str, query_len : int, hitlist_size : int = 50) -> List[Dict] :
+    rng = random.Random(query_id)
+    hits = []
+    bitscore = rng.uniform(200, 1000)
+    for num in range(rng.randint(0, hitlist_size)) :
+        align_len = rng.randint(min(30, query_len), query_len)
+        identity = rng.randint(align_len // 4, align_len)
+        qseq = ''.join(rng.choices(AMINO_ACIDS, k=align_len))
+        hits.append({
+            'hit_id' : f'ref|WP_{rng.randint(0, 10**9):09d}.1|', 'hit_def' : f'{rng.choice(NAMES)} [Species {rng.randint(0, 999)}]',
+            'accession' : f'WP_{rng.randint(0, 10**9):09d}', 'hit_len' : align_len + rng.randint(0, 200),
+            'bitscore' : bitscore, 'score' : int(bitscore * 2.2), 'evalue' : 10 ** -(bitscore / 10),
+            'query_from' : 1, 'query_to' : align_len, 'hit_from' : 1, 'hit_to' : align_len,
+            'identity' : identity, 'positive' : min(align_len, identity + align_len // 10), 'gaps' : 0, 'align_len' : align_len,
+            'qseq' : qseq, 'hseq' : qseq, 'midline' : qseq
+        })
+        bitscore *= rng.uniform(0.8, 0.99)
+    return hits
+
+
+def writes_interpro_workplace(workplace, results_dir, n : int) :
+    #L : what a finished submitall leaves behind, a log of FINISHED jobs and one result per job, for the analysis benchmark
+    workplace, results_dir = Path(workplace), Path(results_dir)
+    results_dir.mkdir(parents=True, exist_ok=True)
+    items = []
+    for title, sequence in sequences(n).items() :
+        job_id = f'iprscan5-{title}'
+        items.append({'title' : title, 'status' : 'FINISHED', 'id' : job_id, 'sequence' : sequence, 'analysis' : {}})
+        with open(results_dir / f'{title}.json', 'w') as result : json.dump(interpro_result(job_id, sequence), result)
+    with open(workplace / 'interpro_log.json', 'w') as log : json.dump({'list' : items}, log, indent=2)
@@ -1,24 +1,32 @@
-from src.interpro_client import InterproClient , ClientConfig
-from src.interpro_analysis import InterproAnalyzer, AnalysisConfig
-from src.config import INTERPRO_RESULTS_DIR , WORKPLACE
 from src.config import display
+from aftools_common.metrics import metrics, Profiler
 
 import argparse
 from pathlib import Path
 import sys
-from Bio import SeqIO
 import ast
+import atexit
 
 
+#L : only these modes talk to the Interpro server, the others never import requests nor need the cookies
+CLIENT_MODES = ['submit', 'submitall', 'refresh', 'autorefresh', 'pipeline']
+
+
+def finishes_run(profiler, metrics_file) : 
+    from src.config import WORKPLACE
+    profile_path = profiler.stop()
+    if profile_path : display.info(f'We have written the profile to {profile_path.name}')
+    if metrics_file : 
+        metrics.writes(Path(WORKPLACE) / metrics_file)
+        for line in metrics.phase_summary() : display.info(line)
+        display.info(f'We have written the metrics to {metrics_file}')
+
 
 def reads_fasta(file) : 
-    file = Path(WORKPLACE) / file
-    sequences = SeqIO.parse(open(file), 'fasta')
-    d = {}
-    for fasta in sequences : 
-        name, sequence = fasta.id, str(fasta.seq)
-        d[name.strip()] = sequence.strip()
-    return d
+    #L : the records are read lazily from a memory map, batch_submits takes them batch by batch, the caller closes the reader with a with block
+    from src.config import WORKPLACE
+    from aftools_common.fasta_reader import FastaReader
+    return FastaReader(Path(WORKPLACE) / file)
 
 
 
@@ -26,8 +34,6 @@ if __name__ == '__main__' :
 
     #Setup
 
-    results_dir = Path(INTERPRO_RESULTS_DIR)
-    workplace = Path(WORKPLACE)
     display.header("Tool for interacting with the Interpro server.\nDeveloped by Laurène in Pr. Doye's group at the University of Oxford\n")
 
     parser = argparse.ArgumentParser('Script for interacting with the Interpro server')
@@ -36,23 +42,40 @@ if __name__ == '__main__' :
     parser.add_argument('runmode', choices = ['submit', 'submitall', 'refresh', 'autorefresh', 'analysis', 'analysisall', 'summary', 'write', 'pipeline'], help = 'The mode you want to operate in')
     parser.add_argument('-f', '--file', default = None, help = 'a fasta file for all your systems. this should be faster than just running this entire script in submit mode with a single title/sequence each time')
     parser.add_argument('-k', '--keywords', type=ast.literal_eval , default= ['SIGNAL_PEPTIDE'], help='A list of each keyword you want to parse your files for.')
+    parser.add_argument('-me', '--metrics', default = None, help = 'A file in your workplace the request counts, latencies, retries, bytes and phase times are written to at the end, as JSON if it ends with .json and in the Prometheus text format otherwise')
+    parser.add_argument('-pf', '--profile', choices = ['cprofile', 'sample'], default = None, help = 'Profile the run into profile_{runmode}.prof/.txt in your workplace (cprofile, main thread only) or profile_{runmode}.folded (sample, every thread, for flame graphs)')
+    parser.add_argument('-mb', '--memory_budget', type = int, default = None, help = 'The MB of sequences the log keeps in memory, the others are spilled to a temporary file in your workplace. For runs of millions of proteins on a small node')
     args=parser.parse_args()
 
-    keywords = args.keywords
+    from src.config import INTERPRO_RESULTS_DIR , WORKPLACE
+    from src.interpro_analysis import InterproAnalyzer, AnalysisConfig
+    results_dir = Path(INTERPRO_RESULTS_DIR)
+    workplace = Path(WORKPLACE)
 
-    client_config = ClientConfig(
-        batch_size=100 , 
-        results_dir=results_dir , 
-        workplace=workplace , 
-    )
+    #L : written at exit, so the modes that stop early with sys.exit still leave their metrics and profile behind
+    if args.metrics : metrics.instruments_http()
+    profiler = Profiler(args.profile, Path(WORKPLACE) / f'profile_{args.runmode}').start()
+    atexit.register(finishes_run, profiler, args.metrics)
+
+    keywords = args.keywords
 
     analysis_config = AnalysisConfig(
         results_dir=results_dir,
         workplace=workplace,
-        keywords=keywords
+        keywords=keywords,
+        memory_budget=args.memory_budget
         )
 
-    client = InterproClient(client_config)
+    client = None
+    if args.runmode in CLIENT_MODES : 
+        from src.interpro_client import InterproClient , ClientConfig
+        client_config = ClientConfig(
+            batch_size=100 , 
+            results_dir=results_dir , 
+            workplace=workplace , 
+            memory_budget=args.memory_budget , 
+        )
+        client = InterproClient(client_config)
     analyzer = InterproAnalyzer(analysis_config)
 
     sequence = args.sequence
@@ -78,8 +101,8 @@ if __name__ == '__main__' :
         if file is None : 
             display.error('A fasta file is needed for submitall mode')
             sys.exit()
-        d = reads_fasta(file)
-        infos = client.batch_submits(d)
+        with reads_fasta(file) as d : 
+            infos = client.batch_submits(d)
 
     elif mode == 'refresh' : 
         client.refresh()
@@ -109,8 +132,8 @@ if __name__ == '__main__' :
         if file is None : 
             display.error('A fasta file is needed for submitall mode')
             sys.exit()
-        d = reads_fasta(file)
-        infos = client.batch_submits(d)
+        with reads_fasta(file) as d : 
+            infos = client.batch_submits(d)
 
         client.auto_refresh()
         client.updates_data()
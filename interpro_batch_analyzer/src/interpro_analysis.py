@@ -2,16 +2,19 @@ from pathlib import Path
 import json
 from dataclasses import dataclass
 from typing import List, Optional
-from concurrent.futures import as_completed , ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 import os 
 
 from .config import WORKPLACE , INTERPRO_RESULTS_DIR , display
+from aftools_common.metrics import metrics
+from .job_log import JobLog, reads_items, writes_items, appends_items, runs_bounded
 
 @dataclass
 class AnalysisConfig:
     results_dir: Optional[str] = None
     workplace: Optional[str] = None
     keywords: List[str] = None
+    memory_budget: Optional[int] = None
 
 class InterproAnalyzer:
 
@@ -33,11 +36,11 @@ class InterproAnalyzer:
     
         self.log_path = self.workplace / 'interpro_log.json'
         self.ids_path = Path(WORKPLACE) / 'ids.txt'
-        
-        init = {
-            "list": [
-                ]
-            }
+
+        #L : the client is no longer created in the analysis modes, so the analyzer starts the log of a new workplace itself
+        self.job_log = JobLog(self.log_path, self.config.memory_budget)
+        if not self.log_path.exists():  
+            writes_items(self.log_path, [])
         
         if self.config.keywords:
             for keyword in self.config.keywords : 
@@ -45,14 +48,12 @@ class InterproAnalyzer:
                 setattr(self, keyword.lower(), path)
 
                 if not path.exists():  
-                    with open(path, 'w') as f:
-                        json.dump(init, f, indent=2) 
+                    writes_items(path, [])
                         #display.warning(f'Warning : we have created a file for {keyword.lower()} at location : {path} because it did not exist')
 
 
 
     def find_keywords(self, json_file) : 
-        files = os.listdir(self.results_dir)
         all = {
             keyword.lower() : False for keyword in self.keywords
         }
@@ -60,7 +61,8 @@ class InterproAnalyzer:
         name = json_file
 
         #this needs to be tested
-        if json_file not in files :  
+        #L : one stat instead of listing the results folder for every protein
+        if not self.results_dir.joinpath(json_file).exists() :  
             display.warning(f'{json_file} not in {self.results_dir}. Data analysis for this system will be skipped.')
             all = {
                 keyword.lower() : 'File not found' for keyword in self.keywords
@@ -83,77 +85,46 @@ class InterproAnalyzer:
     def analysis(self, title, mode) :
         analysis_data = self.find_keywords(f'{title}.json')
         if mode == 'analysis' : 
-            with open(self.log_path, 'r+') as log : 
-                data = json.load(log)
-                for item in data["list"] : 
-                    if item ['title'] == title : 
-                        item['analysis'] = analysis_data
-                log.seek(0)
-                json.dump(data, log, indent=2)
+            log = self.job_log.current()
+            if title in log : 
+                log.sets_analysis(title, analysis_data)
+                log.saves()
 
         return analysis_data
 
 
 
 
+    @metrics.times('interpro_parse')
     def batch_analysis(self, mode) :
+        log = self.job_log.current()
         titles = []
-        all_analysis_data = {}
-
-        with open(self.log_path, 'r+') as log : 
-            all = json.load(log)
-            for item in all['list'] : 
-                if len(item['title'].split('|')) > 1 : title = item['title'].split('|')[1]
-                else : title = item['title']
-                titles.append(title)
-
-        with ThreadPoolExecutor(max_workers=20) as executor:
-            futures = {executor.submit(self.analysis, title, mode): title 
-                    for title in titles}
-            for future in as_completed(futures) : 
-                analysis_data = future.result()
-                all_analysis_data[futures[future]] = analysis_data
-        
-        with open(self.log_path, 'r+') as log : 
-            all = json.load(log)
-
-            for item in all['list'] : 
-                if len(item['title'].split('|')) > 1 : 
-                    title = item['title'].split('|')[1]
-                else : 
-                    title = item['title']
 
-                if title in all_analysis_data:
-                    item['analysis'] = all_analysis_data[title]
-            
-            log.seek(0)
-            log.truncate()
-            json.dump(all, log, indent=2)
+        for job in log : 
+            if len(job.title.split('|')) > 1 : title = job.title.split('|')[1]
+            else : title = job.title
+            titles.append((job.title, title))
+
+        #L : every analysis goes straight to its job, at most a window of them are in flight
+        with ThreadPoolExecutor(max_workers=20) as executor, display.progress('Analysed', len(titles)) as progress:
+            for (log_title, _), analysis_data in runs_bounded(executor, lambda log_title, title : self.analysis(title, mode), titles) : 
+                log.sets_analysis(log_title, analysis_data)
+                if 'File not found' in analysis_data.values() : progress.advance('missing')
+                else : progress.advance('with keywords' if any(analysis_data.values()) else 'without keywords')
+        
+        log.saves()
 
 
 
+    @metrics.times('interpro_summary')
     def summary(self) : 
-        lists_dict = {
-            keyword.lower() : [] for keyword in self.keywords
-        }
-
-        with open(self.log_path, 'r') as log : 
-            all = json.load(log)
-            for item in all['list'] : 
-                for keyword in self.keywords : 
-                    if keyword.lower() in item['analysis'] and item['analysis'][keyword.lower()] == True : 
-                        lists_dict[keyword.lower()].append(item)
-                        continue
-
+        log = self.job_log.current()
 
+        #L : one keyword at a time, only the jobs of that keyword are turned back into full items
         for keyword in self.keywords : 
             summary_path = getattr(self, keyword.lower())
-            with open(summary_path, 'r+') as summary : 
-                data = json.load(summary)
-                for item in lists_dict[keyword.lower()] : 
-                    data['list'].append(item)
-                summary.seek(0)
-                json.dump(data, summary, indent=2)
+            jobs = [job for job in log if job.analysis.get(keyword.lower()) == True]
+            appends_items(summary_path, (log.item(job) for job in jobs))
 
     
     def writes_ids_txt(self) : 
@@ -162,12 +133,10 @@ class InterproAnalyzer:
         for keyword in self.keywords : 
             ids.append(f'#{keyword}')
             summary_path = getattr(self, keyword.lower())
-            with open(summary_path, 'r') as summary : 
-                data = json.load(summary)
-                for item in data['list'] :
-                    if len(item['title'].split('|')) > 1 : id = item['title'].split('|')[1]
-                    else : id = item['title']
-                    ids.append(id)
+            for item in reads_items(summary_path) :
+                if len(item['title'].split('|')) > 1 : id = item['title'].split('|')[1]
+                else : id = item['title']
+                ids.append(id)
 
 
         
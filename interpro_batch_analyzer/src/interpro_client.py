@@ -1,3 +1,4 @@
+from collections import Counter
 from pathlib import Path
 import json
 from concurrent.futures import as_completed, ThreadPoolExecutor
@@ -6,7 +7,9 @@ import os
 from typing import List, Optional
 from dataclasses import dataclass
 
-from .config import WORKPLACE , INTERPRO_RESULTS_DIR , INTERPRO_COOKIES, display
+from .config import WORKPLACE , INTERPRO_RESULTS_DIR , INTERPRO_COOKIES, INTERPRO_API_URL, display
+from aftools_common.metrics import metrics
+from .job_log import JobLog, runs_bounded
 
 
 @dataclass
@@ -14,6 +17,7 @@ class ClientConfig:
     batch_size: Optional[int] = None
     results_dir: Optional[str] = None
     workplace: Optional[str] = None
+    memory_budget: Optional[int] = None
 
 class InterproClient : 
 
@@ -36,15 +40,8 @@ class InterproClient :
 
         self.log_path = Path(WORKPLACE) / 'interpro_log.json'
 
-
-        init = {
-            "list": [
-                ]
-            }
-        
-        if not self.log_path.exists():  
-            with open(self.log_path, 'w') as f:
-                json.dump(init, f, indent=2) 
+        #L : the log is read once into compact jobs, the sequences past memory_budget MB are kept on disk
+        self.job_log = JobLog(self.log_path, self.config.memory_budget)
 
         
         cookie_string = INTERPRO_COOKIES
@@ -82,7 +79,7 @@ class InterproClient :
         data['title'] = title
         data['sequence'] = sequence
         response = requests.post(
-            'https://www.ebi.ac.uk/Tools/services/rest/iprscan5/run',
+            f'{INTERPRO_API_URL}/run',
             cookies = self.cookies,
             headers = self.__request['headers'],
             data = data
@@ -93,48 +90,48 @@ class InterproClient :
             return None
         return response.text
     
+    @metrics.times('interpro_submit')
     def batch_submits(self, d) : 
-        display.info(f"Starting batch submit with {len(d)} proteins:")
-        for title in sorted(d.keys()):  
-            display.info(f"  - {title}")
-
-        print()
-        infos = {}
+        #L : d is a dictionnary or any iterable of (title, sequence) like a FastaReader, only one batch of sequences is in memory at a time
+        if isinstance(d, dict) : 
+            display.info(f"Starting batch submit with {len(d)} proteins")
+            records, total = d.items(), len(d)
+        else : 
+            display.info(f"Starting batch submit")
+            records, total = d, None
+        submitted = 0
         batch_size = self.batch_size 
 
-        def splits_d_into_dictionnary(d):
+        def splits_d_into_dictionnary(records):
             dictionnary = {}
-            i = 0
-            name = 'd0'
-            dictionnary[name] = {}
-            for item in d:
+            for item, sequence in records:
                 if len(item.split('|')) > 1:
                     clean_title = item.split('|')[1]
                 else:
                     clean_title = item
-                sequence = d[item]
-                i += 1
-                if i % batch_size == 0:
-                    name = str(f'd{int(name[1:]) + 1}')
-                    dictionnary[name] = {}
-                dictionnary[name][clean_title] = sequence 
-            return dictionnary
-        
-        dictionnary = splits_d_into_dictionnary(d)
-
+                dictionnary[clean_title] = sequence 
+                if len(dictionnary) == batch_size:
+                    yield dictionnary
+                    dictionnary = {}
+            if dictionnary : yield dictionnary
+
+        def submits_one(title, sequence) : 
+            with progress.tracks() : 
+                id = self.submit(title, sequence)
+            progress.advance('submitted' if id is not None else 'failed')
+            return id
+
+        #L : dictionnary.txt is written batch by batch, in the same {"d0" : {title : sequence}} layout as before
         p = Path(WORKPLACE) / 'dictionnary.txt'
-        with open(p, 'w') as p : 
-            json.dump(dictionnary, p, indent=2)
-
-
-        #d being a dictionnary like : title : sequence
-        with ThreadPoolExecutor(max_workers=20) as executor : 
-        
-            for name in dictionnary : 
+        with ThreadPoolExecutor(max_workers=20) as executor, display.progress('Submitted', total) as progress, open(p, 'w') as dictionnary_file : 
+            dictionnary_file.write('{')
+            for i, batch in enumerate(splits_d_into_dictionnary(records)) : 
+                name = f'd{i}'
+                dictionnary_file.write(('\n' if i == 0 else ',\n') + f'  "{name}": ' + json.dumps(batch, indent=2).replace('\n', '\n  '))
                 #display.info(f'Submitting {name} part of dictionnary')
                 futures = {}
-                for title, sequence in dictionnary[name].items() : 
-                    e = executor.submit(self.submit, title, sequence)
+                for title, sequence in batch.items() : 
+                    e = executor.submit(submits_one, title, sequence)
                     futures[e] = title
 
                 batch_infos = {}
@@ -142,10 +139,9 @@ class InterproClient :
                     id = future.result()
                     if id is not None : 
                         title = futures[future]
-                        sequence = dictionnary[name][title]
-                        batch_infos[title] = [sequence, id]
+                        batch_infos[title] = [batch[title], id]
                 
-                infos.update(batch_infos)
+                submitted += len(batch_infos)
 
                 #display.info(f'Saving batch {name} : {len(batch_infos)} items submitted')
                 try:
@@ -154,17 +150,21 @@ class InterproClient :
                 except Exception as e:
                     display.warning(f'Cannot write log file for batch {name}: {e}')
                 batch_infos = {}
+            dictionnary_file.write('\n}\n')
+        for line_num, line in getattr(d, 'malformed', []) : 
+            display.warning(f"Skipping malformed line {line_num}: {line}")
 
-        return infos
+        #L : the job ids and sequences are in the log, only one batch of them was in memory at a time
+        return submitted
 
     
     def gets_status(self, id) : 
-        url = f'https://www.ebi.ac.uk/Tools/services/rest/iprscan5/status/{id}'
+        url = f'{INTERPRO_API_URL}/status/{id}'
         response = requests.get(url)
         return response.text
     
     def gets_data_json(self, id) : 
-        url = f'https://www.ebi.ac.uk/Tools/services/rest/iprscan5/result/{id}/json'
+        url = f'{INTERPRO_API_URL}/result/{id}/json'
         #display.info(url)
         response = requests.get(url)
         if response.status_code != 200 : 
@@ -172,72 +172,53 @@ class InterproClient :
             return None
         return response.json()
     
+    @metrics.times('interpro_poll')
     def refresh(self):
         changed = []
-        with open(self.log_path, 'r') as log:
-            all_data = json.load(log)
-        
-        running = {item['title']: item['id'] for item in all_data['list'] 
-                if item['status'] == 'RUNNING' or item['status'] == 'QUEUED'}
+        log = self.job_log.current()
+        running = [(job.title, job.id) for job in log if job.status == 'RUNNING' or job.status == 'QUEUED']
         
-        def refresh_one(item_id):
+        def refresh_one(title, item_id):
             #display.info(f'Status of job {item_id} : {self.gets_status(item_id)}')
             return self.gets_status(item_id)
 
         with ThreadPoolExecutor() as executor:  
-            futures = {executor.submit(refresh_one, id): title 
-                    for title, id in running.items()}
-
-            for future in as_completed(futures):
-                title = futures[future]
-                new_status = future.result()
-
-                for item in all_data['list']:
-                    if item['title'] == title:
-                        store = item['status']
-                        item['status'] = new_status
-                        if new_status != store :
-                            changed.append(title)
-                        break
-
-        with open(self.log_path, 'w') as log:
-            json.dump(all_data, log, indent=2)
+            for (title, _), new_status in runs_bounded(executor, refresh_one, running):
+                if log.sets_status(title, new_status) :
+                    changed.append(title)
+
+        #L : the log is only rewritten when a status changed
+        if changed : log.saves()
         
         return changed
     
     def auto_refresh(self) : 
 
-        def is_all_finished() : 
-            finished = True 
-            with open(self.log_path, 'r') as log : 
-                data = json.load(log)
-                for item in data['list'] : 
-                    if item['status'] not in ['FINISHED', 'FAILED', 'ERROR']:
-                        finished = False
-            if finished == False : display.error(f'Finished : {finished}')
-            elif finished == True : display.ok(f'Finished : {finished}')
-
-            return finished
-
-        finished = False
-        while not finished:
-            self.refresh()
-            finished = is_all_finished()
-            if not finished:  
-                display.info('\nSleeping for 10 more seconds\n')
-                time.sleep(10)
+        def is_all_finished(progress) : 
+            statuses = Counter(job.status for job in self.job_log.current())
+            done = sum(count for status, count in statuses.items() if status in ['FINISHED', 'FAILED', 'ERROR'])
+            progress.total = sum(statuses.values())
+            progress.sets(statuses, done)
+            return done == progress.total
+
+        #L : one line with the count of every status instead of a message per poll, the interval of the summary lines matches the polls
+        with display.progress('Finished', summary_interval=10) as progress : 
+            finished = False
+            while not finished:
+                self.refresh()
+                finished = is_all_finished(progress)
+                if not finished:  
+                    time.sleep(10)
 
     def writes_interpro_log(self, infos):
     # Format of infos should be title : [sequence, id]
-        with open(self.log_path, 'r+') as log:
-            all_data = json.load(log)
-        
-        existing_titles = {item['title'] for item in all_data['list']}
+        log = self.job_log.current()
+        new_items, added = [], set()
         
         for original_title in infos:
             clean_title = original_title.split('|')[1] if '|' in original_title else original_title
             
-            if clean_title in existing_titles:
+            if clean_title in log or clean_title in added:
                 display.warning(f"Duplicate submission detected: {clean_title}")
                 continue
             
@@ -255,30 +236,26 @@ class InterproClient :
                 'sequence': sequence,
                 'analysis': {}
             }
-            all_data['list'].append(new)
+            new_items.append(new)
+            added.add(clean_title)
         
-        with open(self.log_path, 'w') as log:
-            json.dump(all_data, log, indent=2)
+        #L : the new jobs are appended, the jobs already in the log are not written again for every batch
+        log.appends(new_items)
 
 
+    @metrics.times('interpro_download')
     def updates_data(self) : 
-        files = os.listdir(self.results_dir)
-        to_update = {}
-
-        with open(self.log_path, 'r') as log : 
-            all = json.load(log)
-            for item in all['list'] :
-                if item['status'] == 'FINISHED' and f'{item["title"]}.json' not in files : to_update[item['title']] = item['id']
+        files = set(os.listdir(self.results_dir))
+        to_update = [(job.title, job.id) for job in self.job_log.current() if job.status == 'FINISHED' and f'{job.title}.json' not in files]
 
-        def updates_one(title, id, result_dir) : 
-            data = self.gets_data_json(id)
+        def updates_one(title, id) : 
+            with progress.tracks() : 
+                data = self.gets_data_json(id)
             if data : 
-                path = result_dir.joinpath(f'{title}.json')
+                path = self.results_dir.joinpath(f'{title}.json')
                 with open(path, 'w') as file : json.dump(data, file, indent=2)
                 #display.info(f'Created data json file for {title}')
+            progress.advance('downloaded' if data else 'failed')
         
-        with ThreadPoolExecutor() as executor : 
-            futures = {executor.submit(updates_one, title, id, self.results_dir): title 
-                    for title, id in to_update.items()}
-            for future in as_completed(futures):
-                future.result()
+        with ThreadPoolExecutor() as executor, display.progress('Downloaded', len(to_update)) as progress : 
+            for _ in runs_bounded(executor, updates_one, to_update) : pass
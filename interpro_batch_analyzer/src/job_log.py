@@ -0,0 +1,207 @@
+from concurrent.futures import FIRST_COMPLETED, as_completed, wait
+from itertools import chain
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional
+import json
+import os
+import sys
+import tempfile
+import threading
+
+
+#L : the logs keep the {"list" : [...]} layout of before, with one job per line, so they can be read and appended to line by line
+HEAD = '{"list": ['
+TAIL = '\n]}\n'
+WINDOW = 2000
+
+
+def reads_items(path) -> Iterator[dict] :
+    with open(path, 'r') as log :
+        if log.readline().strip() != HEAD :
+            #L : a log written by an older version is one indented document, it is read at once and the next save writes it one job per line
+            log.seek(0)
+            yield from json.load(log)['list']
+            return
+        for line in log :
+            line = line.strip().rstrip(',')
+            if line.startswith('{') : yield json.loads(line)
+
+
+def writes_items(path, items : Iterable[dict]) :
+    path = Path(path)
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+    with open(tmp_path, 'w') as log :
+        log.write(HEAD)
+        for i, item in enumerate(items) : log.write((',\n' if i else '\n') + json.dumps(item))
+        log.write(TAIL)
+    os.replace(tmp_path, path)
+
+
+def appends_items(path, items : Iterable[dict]) :
+    #L : the new items are written before the closing bracket, the ones already in the file are not read again
+    path = Path(path)
+    items = list(items)
+    if not items : return
+    with open(path, 'r+b') as log :
+        first = log.readline().strip() == HEAD.encode()
+        empty = log.read(len(TAIL) - 1) == TAIL[1:].encode()
+        log.seek(0, 2)
+        if first and log.tell() >= len(TAIL) :
+            log.seek(-len(TAIL), 2)
+            if log.read() == TAIL.encode() :
+                log.seek(-len(TAIL), 2)
+                log.write((('\n' if empty else ',\n') + ',\n'.join(json.dumps(item) for item in items) + TAIL).encode())
+                return
+    writes_items(path, chain(reads_items(path), items))
+
+
+def runs_bounded(executor, function, items : Iterable[tuple], window : int = WINDOW) -> Iterator[tuple] :
+    #L : at most window calls wait in the executor, a future for each of a million jobs would not fit in memory
+    pending = {}
+    for item in items :
+        pending[executor.submit(function, *item)] = item
+        if len(pending) >= window :
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done : yield pending.pop(future), future.result()
+    for future in as_completed(pending) : yield pending[future], future.result()
+
+
+class Job :
+    #L : one slotted record per job instead of a dictionary, the sequence stays in the SequenceStore and the job only knows where
+    __slots__ = ('title', 'id', 'status', 'start', 'length', 'analysis')
+
+    def __init__(self, title : str, id : str, status : str, start : int, length : int, analysis : dict) :
+        self.title = title
+        self.id = id
+        self.status = status
+        self.start = start
+        self.length = length
+        self.analysis = analysis
+
+
+class SequenceStore :
+    #L : the sequences packed one after the other as bytes, past the memory budget they are spilled to a temporary file next to the log
+    def __init__(self, budget : Optional[int] = None, directory = None) :
+        self.budget = budget
+        self.directory = directory
+        self.buffer = bytearray()
+        self.spilled = 0
+        self.file = None
+        self.lock = threading.Lock()
+
+    def adds(self, sequence : str) -> tuple :
+        data = sequence.encode()
+        with self.lock :
+            start = self.spilled + len(self.buffer)
+            self.buffer += data
+            if self.budget is not None and len(self.buffer) > self.budget : self.spills()
+        return start, len(data)
+
+    def spills(self) :
+        if self.file is None : self.file = tempfile.TemporaryFile(prefix='.interpro_sequences_', dir=self.directory)
+        self.file.seek(0, 2)
+        self.file.write(self.buffer)
+        self.file.flush()
+        self.spilled += len(self.buffer)
+        self.buffer = bytearray()
+
+    def gets(self, start : int, length : int) -> str :
+        with self.lock :
+            if start >= self.spilled : return self.buffer[start - self.spilled:start - self.spilled + length].decode()
+            self.file.seek(start)
+            return self.file.read(length).decode()
+
+    def size(self) -> int :
+        return self.spilled + len(self.buffer)
+
+    def close(self) :
+        if self.file is not None : self.file.close()
+        self.file = None
+
+
+class JobLog :
+    #L : interpro_log.json held as compact jobs, the whole log is only rewritten when statuses or analyses change
+    def __init__(self, path, memory_budget : Optional[int] = None) :
+        self.path = Path(path)
+        self.budget = memory_budget * 1024 * 1024 if memory_budget is not None else None
+        self.jobs : Dict[str, Job] = {}
+        self.analyses = {}
+        self.store = None
+        self.stamp = None
+        self.lock = threading.RLock()
+
+    def __iter__(self) :
+        return iter(list(self.jobs.values()))
+
+    def __len__(self) :
+        return len(self.jobs)
+
+    def __contains__(self, title : str) :
+        return title in self.jobs
+
+    def get(self, title : str) -> Optional[Job] :
+        return self.jobs.get(title)
+
+    def stamps(self) -> tuple :
+        stat = self.path.stat()
+        return stat.st_size, stat.st_mtime_ns
+
+    def loads(self) :
+        with self.lock :
+            if self.store is not None : self.store.close()
+            self.jobs, self.analyses = {}, {}
+            self.store = SequenceStore(self.budget, self.path.parent)
+            if not self.path.exists() : writes_items(self.path, [])
+            for item in reads_items(self.path) : self.adds(item)
+            self.stamp = self.stamps()
+        return self
+
+    def current(self) :
+        #L : another run may have written the log since we read it
+        with self.lock :
+            if self.stamp is None or not self.path.exists() or self.stamps() != self.stamp : self.loads()
+        return self
+
+    def interns(self, analysis : dict) -> dict :
+        #L : most jobs share one of a few analysis results, so they share one dictionary too
+        return self.analyses.setdefault(tuple(analysis.items()), analysis)
+
+    def adds(self, item : dict) -> Job :
+        start, length = self.store.adds(item.get('sequence') or '')
+        job = Job(item['title'], item.get('id'), sys.intern(item.get('status') or ''), start, length, self.interns(item.get('analysis') or {}))
+        self.jobs[job.title] = job
+        return job
+
+    def gets_sequence(self, job : Job) -> str :
+        return self.store.gets(job.start, job.length)
+
+    def item(self, job : Job) -> dict :
+        return {'title' : job.title, 'status' : job.status, 'id' : job.id, 'sequence' : self.gets_sequence(job), 'analysis' : job.analysis}
+
+    def items(self) -> Iterator[dict] :
+        return (self.item(job) for job in self)
+
+    def sets_status(self, title : str, status : str) -> bool :
+        job = self.jobs[title]
+        changed = job.status != status
+        job.status = sys.intern(status)
+        return changed
+
+    def sets_analysis(self, title : str, analysis : dict) :
+        with self.lock : self.jobs[title].analysis = self.interns(analysis)
+
+    def appends(self, items : Iterable[dict]) :
+        with self.lock :
+            self.current()
+            jobs = [self.adds(item) for item in items]
+            appends_items(self.path, (self.item(job) for job in jobs))
+            self.stamp = self.stamps()
+        return jobs
+
+    def saves(self) :
+        with self.lock :
+            writes_items(self.path, self.items())
+            self.stamp = self.stamps()
+
+    def close(self) :
+        if self.store is not None : self.store.close()
@@ -0,0 +1,6 @@
+from pathlib import Path
+import sys
+
+#L : the tool imports its modules as src.*, as when main.py is run from its folder
+TOOL_DIR = Path(__file__).resolve().parent.parent
+if str(TOOL_DIR) not in sys.path : sys.path.insert(0, str(TOOL_DIR))
@@ -0,0 +1,55 @@
+import json
+
+from src.job_log import HEAD, TAIL, appends_items, reads_items, writes_items
+
+
+def job(i) :
+    return {'title' : f'protein_{i}', 'id' : f'iprscan5-R{i}', 'status' : 'RUNNING', 'sequence' : 'MKVLA' * (i + 1), 'analysis' : {}}
+
+
+def writes_old_log(path, items) :
+    #L : the layout of the logs written before, one indented document
+    with open(path, 'w') as log : json.dump({'list' : items}, log, indent=4)
+
+
+def test_appends_to_an_old_log(tmp_path) :
+    path = tmp_path / 'interpro_log.json'
+    writes_old_log(path, [job(0), job(1)])
+
+    appends_items(path, [job(2)])
+
+    assert list(reads_items(path)) == [job(0), job(1), job(2)]
+    with open(path) as log : assert log.readline().strip() == HEAD
+    with open(path) as log : assert json.load(log) == {'list' : [job(0), job(1), job(2)]}
+
+
+def test_appends_in_place_after_conversion(tmp_path) :
+    path = tmp_path / 'interpro_log.json'
+    writes_old_log(path, [job(0)])
+    appends_items(path, [job(1)])
+    before = path.read_bytes()
+
+    appends_items(path, [job(2), job(3)])
+
+    #L : the jobs already in the log are left as they were, only the closing bracket moves
+    assert path.read_bytes().startswith(before[:-len(TAIL)])
+    assert list(reads_items(path)) == [job(i) for i in range(4)]
+    with open(path) as log : assert json.load(log)['list'] == [job(i) for i in range(4)]
+
+
+def test_appends_to_an_empty_log(tmp_path) :
+    path = tmp_path / 'interpro_log.json'
+    writes_items(path, [])
+
+    appends_items(path, [job(0)])
+
+    with open(path) as log : assert json.load(log) == {'list' : [job(0)]}
+
+
+def test_appends_to_an_empty_old_log(tmp_path) :
+    path = tmp_path / 'interpro_log.json'
+    writes_old_log(path, [])
+
+    appends_items(path, [job(0)])
+
+    assert list(reads_items(path)) == [job(0)]
@@ -0,0 +1,221 @@
+import html
+from xml.sax.saxutils import escape
+import re
+from typing import List, Tuple
+
+
+ITERATIONS_OPEN = '<BlastOutput_iterations>'
+ITERATIONS_CLOSE = '</BlastOutput_iterations>'
+
+ITERATION = re.compile(r'<Iteration>.*?</Iteration>', re.S)
+
+
+def _field(text, tag) :
+    match = re.search(rf'<{tag}>(.*?)</{tag}>', text, re.S)
+    return html.unescape(match.group(1)).strip() if match else None
+
+
+def _replace_field(text, tag, value) :
+    return re.sub(rf'<{tag}>.*?</{tag}>', lambda _ : f'<{tag}>{value}</{tag}>', text, count=1, flags=re.S)
+
+
+def query_names(iteration) :
+    #L : NCBI renames queries to Query_1, Query_2... so we keep every candidate name of the query
+    names = []
+    query_id = _field(iteration, 'Iteration_query-ID')
+    query_def = _field(iteration, 'Iteration_query-def')
+    if query_id : names.append(query_id)
+    if query_def :
+        names.append(query_def)
+        names.append(query_def.split()[0])
+    return names
+
+
+def split_multi_query_xml(xml_text : str) -> List[Tuple[List[str], str]] :
+    start = xml_text.find(ITERATIONS_OPEN)
+    end = xml_text.rfind(ITERATIONS_CLOSE)
+    if start == -1 or end == -1 :
+        raise ValueError('This is not a BLAST XML output : no iterations found.')
+
+    head = xml_text[:start + len(ITERATIONS_OPEN)]
+    tail = xml_text[end:]
+    body = xml_text[len(head):end]
+
+    parts = []
+    for match in ITERATION.finditer(body) :
+        iteration = match.group(0)
+        single_head = head
+        for output_tag, iteration_tag in [('BlastOutput_query-ID', 'Iteration_query-ID'),
+                                          ('BlastOutput_query-def', 'Iteration_query-def'),
+                                          ('BlastOutput_query-len', 'Iteration_query-len')] :
+            value = re.search(rf'<{iteration_tag}>(.*?)</{iteration_tag}>', iteration, re.S)
+            if value : single_head = _replace_field(single_head, output_tag, value.group(1))
+        parts.append((query_names(iteration), f'{single_head}\n{iteration}\n{tail}'))
+    return parts
+
+
+def split_multi_query_tabular(text : str) -> List[Tuple[List[str], str]] :
+    #L : every query opens with its block of # comment lines, led by the program line, the hit rows follow until the next block
+    blocks = []
+    in_comments = False
+    for line in text.splitlines(keepends=True) :
+        if not line.strip() : continue
+        if line.startswith('#') :
+            if not in_comments or line.lower().startswith('# blast') : blocks.append([])
+            in_comments = True
+        else :
+            if not blocks : blocks.append([])
+            in_comments = False
+        blocks[-1].append(line)
+
+    parts = []
+    for block in blocks :
+        names = []
+        query = next((line[len('# Query:'):].strip() for line in block if line.startswith('# Query:')), None)
+        if query :
+            names.append(query)
+            names.append(query.split()[0])
+        rows = [line for line in block if not line.startswith('#')]
+        if rows : names.append(rows[0].split('\t')[0])
+        parts.append((names, ''.join(block)))
+    return parts
+
+
+def split_multi_query(text : str, format_type : str = 'XML') -> List[Tuple[List[str], str]] :
+    if format_type == 'Tabular' : return split_multi_query_tabular(text)
+    return split_multi_query_xml(text)
+
+
+def assign_to_jobs(parts, job_ids : List[str]) :
+    assigned = {}
+    unmatched = []
+    wanted = set(job_ids)
+
+    for names, text in parts :
+        job_id = next((name for name in names if name in wanted and name not in assigned), None)
+        if job_id is None : unmatched.append(text)
+        else : assigned[job_id] = text
+
+    #L : if the names were lost, NCBI still gives the iterations back in submission order
+    if unmatched and len(parts) == len(job_ids) :
+        return {job_id : text for job_id, (_, text) in zip(job_ids, parts)}
+    return assigned
+
+
+XML_HEADER = '''<?xml version="1.0"?>
+<!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" "http://www.ncbi.nlm.nih.gov/dtd/NCBI_BlastOutput.dtd">
+<BlastOutput>
+  <BlastOutput_program>{program}</BlastOutput_program>
+  <BlastOutput_version>{version}</BlastOutput_version>
+  <BlastOutput_reference>{reference}</BlastOutput_reference>
+  <BlastOutput_db>{database}</BlastOutput_db>
+  <BlastOutput_query-ID>{query_id}</BlastOutput_query-ID>
+  <BlastOutput_query-def>{query_def}</BlastOutput_query-def>
+  <BlastOutput_query-len>{query_len}</BlastOutput_query-len>
+  <BlastOutput_param>
+    <Parameters>
+      <Parameters_matrix>{matrix}</Parameters_matrix>
+      <Parameters_expect>{expect}</Parameters_expect>
+      <Parameters_gap-open>{gap_open}</Parameters_gap-open>
+      <Parameters_gap-extend>{gap_extend}</Parameters_gap-extend>
+      <Parameters_filter>F</Parameters_filter>
+    </Parameters>
+  </BlastOutput_param>
+<BlastOutput_iterations>
+<Iteration>
+  <Iteration_iter-num>1</Iteration_iter-num>
+  <Iteration_query-ID>{query_id}</Iteration_query-ID>
+  <Iteration_query-def>{query_def}</Iteration_query-def>
+  <Iteration_query-len>{query_len}</Iteration_query-len>
+<Iteration_hits>
+'''
+
+XML_HIT = '''<Hit>
+  <Hit_num>{num}</Hit_num>
+  <Hit_id>{hit_id}</Hit_id>
+  <Hit_def>{hit_def}</Hit_def>
+  <Hit_accession>{accession}</Hit_accession>
+  <Hit_len>{hit_len}</Hit_len>
+  <Hit_hsps>
+    <Hsp>
+      <Hsp_num>1</Hsp_num>
+      <Hsp_bit-score>{bitscore:.4f}</Hsp_bit-score>
+      <Hsp_score>{score}</Hsp_score>
+      <Hsp_evalue>{evalue:.4g}</Hsp_evalue>
+      <Hsp_query-from>{query_from}</Hsp_query-from>
+      <Hsp_query-to>{query_to}</Hsp_query-to>
+      <Hsp_hit-from>{hit_from}</Hsp_hit-from>
+      <Hsp_hit-to>{hit_to}</Hsp_hit-to>
+      <Hsp_query-frame>0</Hsp_query-frame>
+      <Hsp_hit-frame>0</Hsp_hit-frame>
+      <Hsp_identity>{identity}</Hsp_identity>
+      <Hsp_positive>{positive}</Hsp_positive>
+      <Hsp_gaps>{gaps}</Hsp_gaps>
+      <Hsp_align-len>{align_len}</Hsp_align-len>
+      <Hsp_qseq>{qseq}</Hsp_qseq>
+      <Hsp_hseq>{hseq}</Hsp_hseq>
+      <Hsp_midline>{midline}</Hsp_midline>
+    </Hsp>
+  </Hit_hsps>
+</Hit>
+'''
+
+XML_FOOTER = '''</Iteration_hits>
+  <Iteration_stat>
+    <Statistics>
+      <Statistics_db-num>{db_num}</Statistics_db-num>
+      <Statistics_db-len>{db_len}</Statistics_db-len>
+      <Statistics_hsp-len>0</Statistics_hsp-len>
+      <Statistics_eff-space>{eff_space}</Statistics_eff-space>
+      <Statistics_kappa>{kappa}</Statistics_kappa>
+      <Statistics_lambda>{lam}</Statistics_lambda>
+      <Statistics_entropy>{entropy}</Statistics_entropy>
+    </Statistics>
+  </Iteration_stat>
+{message}</Iteration>
+</BlastOutput_iterations>
+</BlastOutput>
+'''
+
+
+def format_blast_xml(query_id, query_def, query_len, hits, database, db_num, db_len, program='blastp', version='', reference='',
+                     matrix='BLOSUM62', expect=10, gap_open=11, gap_extend=1, kappa=0.041, lam=0.267, entropy=0.14) :
+    #L : hits are dicts with the keys of XML_HIT, so the output reads like any NCBI result
+    parts = [XML_HEADER.format(
+        program=program, version=escape(version), reference=escape(reference), database=escape(database),
+        query_id=escape(query_id), query_def=escape(query_def), query_len=query_len,
+        matrix=matrix, expect=expect, gap_open=gap_open, gap_extend=gap_extend
+    )]
+    for num, hit in enumerate(hits, 1) :
+        values = dict(hit)
+        for key in ['hit_id', 'hit_def', 'accession'] : values[key] = escape(values[key])
+        parts.append(XML_HIT.format(num=num, **values))
+    message = '' if hits else '  <Iteration_message>No hits found</Iteration_message>\n'
+    parts.append(XML_FOOTER.format(
+        db_num=db_num, db_len=db_len, eff_space=query_len * db_len,
+        kappa=kappa, lam=lam, entropy=entropy, message=message
+    ))
+    return ''.join(parts)
+
+
+TABULAR_FIELDS = 'query acc.ver, subject acc.ver, % identity, alignment length, mismatches, gap opens, q. start, q. end, s. start, s. end, evalue, bit score'
+
+
+def format_blast_tabular(query_id, query_def, hits, database, program='blastp', version='') :
+    #L : the same rows and comment lines as blastp -outfmt 7, a fraction of the size of the XML
+    lines = [
+        f'# {program.upper()} {version}'.rstrip() + '\n',
+        f'# Query: {query_def}\n',
+        f'# Database: {database}\n'
+    ]
+    if hits : lines.append(f'# Fields: {TABULAR_FIELDS}\n')
+    lines.append(f'# {len(hits)} hits found\n')
+    for hit in hits :
+        gap_opens = len(re.findall('-+', hit['qseq'])) + len(re.findall('-+', hit['hseq']))
+        mismatches = hit['align_len'] - hit['identity'] - hit['gaps']
+        lines.append('\t'.join([
+            query_id, hit['accession'], f"{100 * hit['identity'] / hit['align_len']:.3f}", str(hit['align_len']),
+            str(mismatches), str(gap_opens), str(hit['query_from']), str(hit['query_to']),
+            str(hit['hit_from']), str(hit['hit_to']), f"{hit['evalue']:.2e}", f"{hit['bitscore']:.1f}"
+        ]) + '\n')
+    return ''.join(lines)
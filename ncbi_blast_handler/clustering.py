@@ -0,0 +1,88 @@
+from config import display
+
+from typing import Dict, List, Tuple
+import numpy as np
+
+
+MASK = np.uint64((1 << 61) - 1)
+
+
+def kmer_set(sequence : str, k : int) :
+    codes = np.frombuffer(sequence.upper().encode('ascii', 'replace'), dtype=np.uint8).astype(np.uint64)
+    if len(codes) < k : return np.unique(codes)
+    windows = np.lib.stride_tricks.sliding_window_view(codes, k)
+    weights = np.uint64(256) ** np.arange(k - 1, -1, -1, dtype=np.uint64)
+    return np.unique(windows @ weights)
+
+
+def minhash_sketches(sequences : List[str], k : int = 4, num_hashes : int = 64, seed : int = 0) :
+    #L : one row per sequence, column i is the smallest value of the i-th hash over the k-mers of the sequence
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 1 << 61, num_hashes, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 1 << 61, num_hashes, dtype=np.uint64)
+
+    sketches = np.empty((len(sequences), num_hashes), dtype=np.uint64)
+    with np.errstate(over='ignore') :
+        for i, sequence in enumerate(sequences) :
+            kmers = kmer_set(sequence, k)[:, None]
+            #L : an empty sequence has nothing to hash, its row keeps the largest value a hash can take
+            if len(kmers) == 0 :
+                sketches[i] = MASK
+                continue
+            hashed = kmers * a + b
+            hashed ^= hashed >> np.uint64(29)
+            sketches[i] = (hashed & MASK).min(axis=0)
+    return sketches
+
+
+def identity_from_jaccard(jaccard, k : int) :
+    #L : two sequences at identity p share about p**k of their k-mers, so J = p**k / (2 - p**k)
+    return (2 * jaccard / (1 + jaccard)) ** (1 / k)
+
+
+def cluster_jobs(jobs, threshold : float = 0.9, min_coverage : float = 0.9, k : int = 4,
+                 num_hashes : int = 64, bands : int = 32) -> Tuple[list, Dict[str, Tuple[str, float]]] :
+    if len(jobs) < 2 : return list(jobs), {}
+    #L : a sequence shorter than k has no k-mer to compare, it is its own cluster
+    short = [job for job in jobs if len(job.sequence) < k]
+    total = len(jobs)
+    jobs = [job for job in jobs if len(job.sequence) >= k]
+    if len(jobs) < 2 : return short + jobs, {}
+
+    rows = num_hashes // bands
+    order = sorted(range(len(jobs)), key=lambda i : -len(jobs[i].sequence))
+    lengths = np.array([len(job.sequence) for job in jobs])
+    sketches = minhash_sketches([job.sequence for job in jobs], k, num_hashes)
+
+    #L : locality sensitive hashing, sequences sharing one band of their sketch become candidates
+    buckets = [{} for _ in range(bands)]
+    for i in range(len(jobs)) :
+        for band in range(bands) :
+            buckets[band].setdefault(sketches[i, band * rows:(band + 1) * rows].tobytes(), []).append(i)
+
+    assigned = np.zeros(len(jobs), dtype=bool)
+    representatives = []
+    members = {}
+
+    for rep in order :
+        if assigned[rep] : continue
+        assigned[rep] = True
+        representatives.append(jobs[rep])
+
+        candidates = set()
+        for band in range(bands) :
+            candidates.update(buckets[band][sketches[rep, band * rows:(band + 1) * rows].tobytes()])
+        candidates = np.array([c for c in candidates if not assigned[c]], dtype=np.int64)
+        if len(candidates) == 0 : continue
+
+        jaccard = (sketches[candidates] == sketches[rep]).mean(axis=1)
+        identity = identity_from_jaccard(jaccard, k)
+        coverage = lengths[candidates] / lengths[rep]
+        for c, estimate in zip(candidates[(identity >= threshold) & (coverage >= min_coverage)],
+                               identity[(identity >= threshold) & (coverage >= min_coverage)]) :
+            assigned[c] = True
+            members[jobs[c].id] = (jobs[rep].id, float(estimate))
+
+    representatives.extend(short)
+    display.info(f'We have clustered {total} jobs into {len(representatives)} representatives at {threshold:.0%} estimated identity.')
+    return representatives, members
@@ -1,72 +1,28 @@
 import os 
 from pathlib import Path
+import sys
 
-if "WORKPLACE" not in os.environ:
-    raise Exception("WORKPLACE not set. Please specify a folder to work in.")
-if "BLAST_RESULTS_DIR" not in os.environ:
-    raise Exception("BLAST_RESULTS_DIR not set. Please specify a folder to access for Interpro results.")
-if "TOOLS" not in os.environ : 
-    raise Exception("TOOLS not set. Please specify a folder containing your tools.")
+#L : the modules shared by both tools live at the root of the repository
+REPO_ROOT = Path(__file__).resolve().parent.parent
+if str(REPO_ROOT) not in sys.path : sys.path.append(str(REPO_ROOT))
 
+from aftools_common.display import Display, Progress, formats_duration, my_colors
+from aftools_common.settings import lazy_settings
 
-WORKPLACE = os.environ['WORKPLACE']
-BLAST_RESULTS_DIR = os.environ['BLAST_RESULTS_DIR']
-TOOLS = os.environ['TOOLS']
+REQUIRED = {
+    'WORKPLACE' : 'WORKPLACE not set. Please specify a folder to work in.',
+    'BLAST_RESULTS_DIR' : 'BLAST_RESULTS_DIR not set. Please specify a folder to access for Interpro results.',
+    'TOOLS' : 'TOOLS not set. Please specify a folder containing your tools.'
+}
+OPTIONAL = {
+    'NCBI_BLAST_URL' : lambda : os.environ.get('NCBI_BLAST_URL', 'https://blast.ncbi.nlm.nih.gov/Blast.cgi'),
+    'UNIPROT_REST_URL' : lambda : os.environ.get('UNIPROT_REST_URL', 'https://rest.uniprot.org').rstrip('/'),
+    'UNIPROT_DUMP' : lambda : os.environ.get('UNIPROT_DUMP'),
+    'UNIPROT_CACHE_DIR' : lambda : os.environ.get('UNIPROT_CACHE_DIR', str(Path(__getattr__('WORKPLACE')) / '.uniprot_cache'))
+}
 
 
-class my_colors : 
-    HEADER = "\033[38;5;218m"
-    OKBLUE = "\033[94m"
-    OKCYAN = "\033[38;5;140m"
-    OKGREEN = "\033[38;5;121m"
-    WARNING = "\033[94m" #change this back to 93 
-    FAIL = "\033[38;5;198m"
-    ENDC = "\033[0m"
-    BOLD = "\033[1m"
-    UNDERLINE = "\033[4m"
-
-
-class Display :
-    def __init__(self, quiet=False):
-        self.quiet = quiet
-        
-    def __call__(self, label="", value="", color: my_colors=my_colors.OKCYAN, end=None, adjust=30) -> None:
-        if self.quiet: return
-        if label.isspace() or label == "":
-            print(label)
-            return
-        label = label.ljust(adjust) if adjust > 0 else label
-        print(f"{color}{label}{my_colors.ENDC}{value}",end=end)
-
-    def header(self, *args, end="\n"): 
-        self.__print(*args, color=my_colors.HEADER, end=end)
-
-    def info(self, *args, end="\n"):
-        self.__print(*args, color=my_colors.OKCYAN, end=end)
-
-    def warning(self, *args, end="\n"):
-        self.__print(*args, color=my_colors.WARNING, end=end)
-
-    def error(self, *args, end="\n"):
-        self.__print(*args, color=my_colors.FAIL, end=end)
-    
-    def print(self, *args, end="\n"):
-        self.__print(*args, end=end)
-
-    def __print(self, *args, color="", end):
-        if self.quiet: return
-        # check if all args are strings
-        if all(isinstance(arg, str) for arg in args):
-            msg = ",".join(list(args))
-            print(f"{color}{msg}{my_colors.ENDC}", end=end)
-        else:
-            for arg in args:
-                print(f"{color}{arg}{my_colors.ENDC}", end='')
-            print(end, end=end)
-
-    def ok(self, *args, end="\n"):
-        self.__print(*args, color=my_colors.OKGREEN, end=end)
-
+__getattr__ = lazy_settings(globals(), REQUIRED, OPTIONAL)
 
 
 display = Display()
\ No newline at end of file
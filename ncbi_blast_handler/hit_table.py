@@ -0,0 +1,266 @@
+from config import display
+from aftools_common.metrics import metrics
+from result_names import split_result_name, result_format
+
+from pathlib import Path
+import gzip
+from typing import Dict, List, Optional
+import os
+import xml.etree.ElementTree as ET
+import numpy as np
+
+
+COLUMNS = {
+    'query' : np.int32,
+    'subject' : np.int32,
+    'identity' : np.float32,
+    'align_len' : np.int32,
+    'evalue' : np.float64,
+    'bitscore' : np.float32,
+    'query_from' : np.int32,
+    'query_to' : np.int32,
+    'hit_from' : np.int32,
+    'hit_to' : np.int32,
+    'file' : np.int32
+}
+
+HSP_FIELDS = {
+    'Hsp_identity' : 'identities',
+    'Hsp_align-len' : 'align_len',
+    'Hsp_evalue' : 'evalue',
+    'Hsp_bit-score' : 'bitscore',
+    'Hsp_query-from' : 'query_from',
+    'Hsp_query-to' : 'query_to',
+    'Hsp_hit-from' : 'hit_from',
+    'Hsp_hit-to' : 'hit_to'
+}
+
+
+TABULAR_COLUMNS = {
+    'subject' : ['subject acc.ver', 'subject acc.', 'subject id'],
+    'identity' : ['% identity'],
+    'align_len' : ['alignment length'],
+    'evalue' : ['evalue'],
+    'bitscore' : ['bit score'],
+    'query_from' : ['q. start'],
+    'query_to' : ['q. end'],
+    'hit_from' : ['s. start'],
+    'hit_to' : ['s. end']
+}
+TABULAR_DEFAULT = ['query acc.ver', 'subject acc.ver', '% identity', 'alignment length', 'mismatches', 'gap opens',
+                   'q. start', 'q. end', 's. start', 's. end', 'evalue', 'bit score']
+
+
+def iter_result_hits(path) :
+    if result_format(Path(path).name) == 'Tabular' : return iter_tabular_hits(path)
+    return iter_xml_hits(path)
+
+
+def iter_tabular_hits(path) :
+    path = Path(path)
+    fields = TABULAR_DEFAULT
+    with (gzip.open(path, 'rt') if path.name.endswith('.gz') else open(path, 'r')) as handle :
+        for line in handle :
+            if line.startswith('# Fields:') :
+                fields = [field.strip() for field in line[len('# Fields:'):].split(',')]
+                continue
+            if line.startswith('#') or not line.strip() : continue
+            values = line.rstrip('\n').split('\t')
+            if len(values) != len(fields) :
+                raise ValueError(f'expected {len(fields)} columns, got {len(values)}')
+            row = dict(zip(fields, values))
+            hit = {column : next((row[name] for name in names if name in row), None) for column, names in TABULAR_COLUMNS.items()}
+            yield (hit['subject'], float(hit['identity'] or 0), int(hit['align_len'] or 0), float(hit['evalue'] or 'nan'),
+                   float(hit['bitscore'] or 'nan'), int(hit['query_from'] or 0), int(hit['query_to'] or 0),
+                   int(hit['hit_from'] or 0), int(hit['hit_to'] or 0))
+
+
+def iter_xml_hits(path) :
+    path = Path(path)
+    with (gzip.open(path, 'rb') if path.name.endswith('.gz') else open(path, 'rb')) as handle :
+        yield from _iter_xml_hits(handle)
+
+
+def _iter_xml_hits(handle) :
+    #L : iterparse keeps only the current Hit in memory, we clear every element once it is read
+    subject = None
+    hsp = {}
+    for _, elem in ET.iterparse(handle, events=('end',)) :
+        tag = elem.tag
+        if tag in HSP_FIELDS :
+            hsp[HSP_FIELDS[tag]] = elem.text
+        elif tag == 'Hit_accession' :
+            subject = elem.text
+        elif tag == 'Hit_id' and subject is None :
+            subject = elem.text
+        elif tag == 'Hsp' :
+            align_len = int(hsp.get('align_len', 0))
+            identity = 100.0 * int(hsp.get('identities', 0)) / align_len if align_len else 0.0
+            yield (subject, identity, align_len, float(hsp.get('evalue', 'nan')), float(hsp.get('bitscore', 'nan')),
+                   int(hsp.get('query_from', 0)), int(hsp.get('query_to', 0)), int(hsp.get('hit_from', 0)), int(hsp.get('hit_to', 0)))
+            hsp = {}
+            elem.clear()
+        elif tag == 'Hit' :
+            subject = None
+            elem.clear()
+        elif tag == 'Iteration' :
+            elem.clear()
+
+
+def result_files(results_dir) :
+    files = []
+    with os.scandir(results_dir) as entries :
+        for entry in entries :
+            if entry.name.startswith('.') or not entry.is_file() : continue
+            if split_result_name(entry.name) :
+                stat = entry.stat()
+                files.append((entry.name, stat.st_size, stat.st_mtime_ns))
+    return sorted(files)
+
+
+class HitTable :
+    def __init__(self, queries : List[str], subjects : List[str], columns : Dict[str, np.ndarray], files = None) :
+        self.queries = list(queries)
+        self.subjects = list(subjects)
+        self.columns = columns
+        self.files = files or []
+
+    def __len__(self) :
+        return len(self.columns['query'])
+
+    def __getitem__(self, column) :
+        return self.columns[column]
+
+    @classmethod
+    def empty(cls) :
+        return cls([], [], {name : np.empty(0, dtype=dtype) for name, dtype in COLUMNS.items()})
+
+    @classmethod
+    def load(cls, path) :
+        with np.load(path, allow_pickle=False) as data :
+            columns = {name : data[f'column_{name}'] for name in COLUMNS}
+            files = list(zip(data['file_names'].tolist(), data['file_sizes'].tolist(), data['file_mtimes'].tolist()))
+            return cls(data['queries'].tolist(), data['subjects'].tolist(), columns, files)
+
+    def save(self, path) :
+        path = Path(path)
+        names, sizes, mtimes = zip(*self.files) if self.files else ([], [], [])
+        tmp_path = path.with_name(path.name + '.tmp.npz')
+        np.savez(
+            tmp_path,
+            queries=np.array(self.queries, dtype=str),
+            subjects=np.array(self.subjects, dtype=str),
+            file_names=np.array(names, dtype=str),
+            file_sizes=np.array(sizes, dtype=np.int64),
+            file_mtimes=np.array(mtimes, dtype=np.int64),
+            **{f'column_{name}' : values for name, values in self.columns.items()}
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    @metrics.times('hits_parse')
+    def from_results_dir(cls, results_dir, cache_path = None) :
+        #L : only the files that changed since the cache was written are parsed again
+        results_dir = Path(results_dir)
+        cache_path = Path(cache_path) if cache_path else results_dir / '.hit_table.npz'
+
+        table = cls.load(cache_path) if cache_path.exists() else cls.empty()
+        current = result_files(results_dir)
+        cached = {name : (size, mtime) for name, size, mtime in table.files}
+        unchanged = {name for name, size, mtime in current if cached.get(name) == (size, mtime)}
+
+        if len(unchanged) == len(current) == len(table.files) :
+            display.info(f'Hit table cache is up to date : {len(table)} hits from {len(current)} files.')
+            return table
+
+        keep_files = [i for i, (name, _, _) in enumerate(table.files) if name in unchanged]
+        remap = np.full(len(table.files) + 1, -1, dtype=np.int32)
+        remap[keep_files] = np.arange(len(keep_files), dtype=np.int32)
+        table = table.keep(np.isin(table['file'], keep_files))
+        table.columns['file'] = remap[table['file']]
+        table.files = [table.files[i] for i in keep_files]
+        #L : the queries whose result files were deleted leave the table, and so do the subjects only they hit
+        live = {split_result_name(name)[0] for name, _, _ in current}
+        table = table.compacts([name in live for name in table.queries])
+        to_parse = [entry for entry in current if entry[0] not in unchanged]
+        display.info(f'We have {len(unchanged)} cached result files, parsing {len(to_parse)} new or changed ones.')
+
+        query_index = {name : i for i, name in enumerate(table.queries)}
+        subject_index = {name : i for i, name in enumerate(table.subjects)}
+        rows = {name : [] for name in COLUMNS}
+
+        for entry in to_parse :
+            name = entry[0]
+            file_id = len(table.files)
+            query, _ = split_result_name(name)
+            try :
+                hits = list(iter_result_hits(results_dir / name))
+            except (ET.ParseError, ValueError) as e :
+                display.warning(f'Skipping {name}, it could not be parsed : {e}')
+                continue
+            query_id = query_index.setdefault(query, len(query_index))
+            for subject, *values in hits :
+                rows['query'].append(query_id)
+                rows['subject'].append(subject_index.setdefault(subject, len(subject_index)))
+                for column, value in zip(list(COLUMNS)[2:-1], values) : rows[column].append(value)
+                rows['file'].append(file_id)
+            table.files.append(entry)
+
+        columns = {
+            column : np.concatenate([table.columns[column], np.array(rows[column], dtype=dtype)])
+            for column, dtype in COLUMNS.items()
+        }
+        table = cls(list(query_index), list(subject_index), columns, table.files)
+        table.save(cache_path)
+        display.info(f'Hit table saved to {cache_path} : {len(table)} hits from {len(table.files)} files.')
+        return table
+
+    def keep(self, mask) :
+        columns = {name : values[mask] for name, values in self.columns.items()}
+        return HitTable(self.queries, self.subjects, columns, list(self.files))
+
+    def compacts(self, kept_queries) :
+        #L : drops the rows of the queries not kept and the subjects no row uses anymore, the ids are renumbered
+        kept_queries = np.asarray(kept_queries, dtype=bool)
+        mask = kept_queries[self['query']]
+        columns = {name : values[mask] for name, values in self.columns.items()}
+        used = np.zeros(len(self.subjects), dtype=bool)
+        used[columns['subject']] = True
+        columns['query'] = (np.cumsum(kept_queries) - 1)[columns['query']].astype(np.int32)
+        columns['subject'] = (np.cumsum(used) - 1)[columns['subject']].astype(np.int32)
+        queries = [name for name, kept in zip(self.queries, kept_queries) if kept]
+        subjects = [name for name, kept in zip(self.subjects, used) if kept]
+        return HitTable(queries, subjects, columns, list(self.files))
+
+    def filter(self, max_evalue : Optional[float] = None, min_identity : Optional[float] = None,
+               min_bitscore : Optional[float] = None, min_align_len : Optional[int] = None) :
+        mask = np.ones(len(self), dtype=bool)
+        if max_evalue is not None : mask &= self['evalue'] <= max_evalue
+        if min_identity is not None : mask &= self['identity'] >= min_identity
+        if min_bitscore is not None : mask &= self['bitscore'] >= min_bitscore
+        if min_align_len is not None : mask &= self['align_len'] >= min_align_len
+        return self.keep(mask)
+
+    def top(self, n : int, by : str = 'bitscore') :
+        #L : best n rows of every query, lowest first for e-values and highest first for everything else
+        key = self[by] if by == 'evalue' else -self[by]
+        order = np.lexsort((key, self['query']))
+        queries = self['query'][order]
+        starts = np.searchsorted(queries, queries, side='left')
+        rank = np.arange(len(queries)) - starts
+        return self.keep(order[rank < n])
+
+    def rows(self) :
+        for i in range(len(self)) :
+            yield {
+                name : (self.queries[values[i]] if name == 'query' else self.subjects[values[i]] if name == 'subject' else values[i].item())
+                for name, values in self.columns.items() if name != 'file'
+            }
+
+    def write_tsv(self, path) :
+        names = [name for name in COLUMNS if name != 'file']
+        formats = {'identity' : '{:.2f}', 'evalue' : '{:.3g}', 'bitscore' : '{:.1f}'}
+        with open(path, 'w') as output :
+            output.write('\t'.join(names) + '\n')
+            for row in self.rows() :
+                output.write('\t'.join(formats.get(name, '{}').format(row[name]) for name in names) + '\n')
@@ -0,0 +1,319 @@
+from config import display
+
+from blast_xml import format_blast_xml, format_blast_tabular
+from aftools_common.metrics import metrics
+from aftools_common.fasta_reader import FastaReader
+from Bio.Align import substitution_matrices
+from pathlib import Path
+from typing import List
+import io
+import math
+import numpy as np
+
+
+ALPHABET = 'ARNDCQEGHILKMFPSTWYVBZX*'
+UNKNOWN = ALPHABET.index('X')
+PAD = len(ALPHABET)
+NEG = -10 ** 6
+
+#L : Karlin-Altschul parameters of BLOSUM62 with gap costs 11/1, as reported by NCBI blastp
+LAMBDA = 0.267
+KAPPA = 0.041
+ENTROPY = 0.14
+VERSION = 'KMER_SEARCH 1.1'
+
+
+def load_scoring_matrix(name : str = 'BLOSUM62') :
+    matrix = substitution_matrices.load(name)
+    scores = np.full((PAD + 1, PAD + 1), NEG // 1000, dtype=np.int32)
+    for a, x in enumerate(ALPHABET) :
+        for b, y in enumerate(ALPHABET) :
+            scores[a, b] = matrix[x][y]
+    return scores
+
+
+ENCODING = np.full(256, UNKNOWN, dtype=np.uint8)
+for code, letter in enumerate(ALPHABET) :
+    ENCODING[ord(letter)] = code
+    ENCODING[ord(letter.lower())] = code
+
+
+def encode(sequence : str) :
+    return ENCODING[np.frombuffer(sequence.encode('ascii', 'replace'), dtype=np.uint8)]
+
+
+def kmer_codes(codes, k : int) :
+    #L : k-mers containing X or * are not used as seeds, we return their codes and their positions
+    if len(codes) < k : return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    windows = np.lib.stride_tricks.sliding_window_view(codes.astype(np.int64), k)
+    valid = (windows < UNKNOWN).all(axis=1)
+    weights = UNKNOWN ** np.arange(k - 1, -1, -1, dtype=np.int64)
+    return windows[valid] @ weights, np.flatnonzero(valid)
+
+
+class KmerIndex :
+    def __init__(self, targets : List[np.ndarray], k : int = 3) :
+        self.k = k
+        self.n_targets = len(targets)
+
+        codes, positions = zip(*[kmer_codes(target, k) for target in targets]) if targets else ([], [])
+        owners = np.repeat(np.arange(len(targets), dtype=np.int64), [len(c) for c in codes])
+        all_codes = np.concatenate(codes) if codes else np.empty(0, dtype=np.int64)
+        all_positions = np.concatenate(positions) if positions else np.empty(0, dtype=np.int64)
+
+        order = np.argsort(all_codes, kind='stable')
+        self.owners = owners[order]
+        self.positions = all_positions[order]
+        counts = np.bincount(all_codes, minlength=UNKNOWN ** k)
+        self.offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+
+    def candidates(self, query : np.ndarray, min_hits : int = 1, max_candidates : int = 50, band : int = 4, window : int = 40) :
+        kmers, query_positions = kmer_codes(query, self.k)
+        starts = self.offsets[kmers]
+        lengths = self.offsets[kmers + 1] - starts
+        total = int(lengths.sum())
+        if total == 0 : return np.empty(0, dtype=np.int64)
+
+        #L : gathers every posting list of the query in one go instead of looping over the k-mers
+        shifts = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        postings = shifts + np.arange(total)
+        owners = self.owners[postings]
+        query_positions = np.repeat(query_positions, lengths)
+        diagonals = (self.positions[postings] - query_positions + len(query)) // band
+
+        #L : BLAST's two-hit rule, a seed counts when a non-overlapping seed follows on the same diagonal band close enough to it
+        _, groups = np.unique(owners * (1 << 32) + diagonals, return_inverse=True)
+        keys = groups.astype(np.int64) * (1 << 32) + query_positions
+        order = np.argsort(keys, kind='stable')
+        keys, owners, query_positions = keys[order], owners[order], query_positions[order]
+        partner = np.minimum(np.searchsorted(keys, keys + self.k), len(keys) - 1)
+        two_hits = (keys[partner] >> 32 == keys >> 32) & (query_positions[partner] - query_positions >= self.k) & (query_positions[partner] - query_positions <= window)
+        hits_per_target = np.bincount(owners[two_hits], minlength=self.n_targets)
+
+        found = np.flatnonzero(hits_per_target >= min_hits)
+        if len(found) > max_candidates :
+            found = found[np.argsort(-hits_per_target[found], kind='stable')[:max_candidates]]
+        return found
+
+
+def smith_waterman_batch(queries, targets, scores, gap_open : int = 11, gap_extend : int = 1) :
+    #L : scores a batch of pairs one query row at a time, every row is vectorised over all pairs and all target columns
+    batch = len(queries)
+    query_lens = np.array([len(q) for q in queries])
+    target_lens = np.array([len(t) for t in targets])
+    q_max, t_max = query_lens.max(), target_lens.max()
+
+    Q = np.full((batch, q_max), PAD, dtype=np.int64)
+    T = np.full((batch, t_max), PAD, dtype=np.int64)
+    for b in range(batch) :
+        Q[b, :query_lens[b]] = queries[b]
+        T[b, :target_lens[b]] = targets[b]
+
+    go, ge = gap_open + gap_extend, gap_extend
+    ramp = np.arange(1, t_max + 1, dtype=np.int32) * ge
+    flat = scores.ravel()
+    Q *= scores.shape[1]
+
+    H = np.zeros((batch, t_max + 1), dtype=np.int32)
+    F = np.full((batch, t_max + 1), NEG, dtype=np.int32)
+    E = np.full((batch, t_max), NEG, dtype=np.int32)
+    best = np.zeros(batch, dtype=np.int32)
+    best_i = np.zeros(batch, dtype=np.int32)
+    best_j = np.zeros(batch, dtype=np.int32)
+
+    for i in range(1, q_max + 1) :
+        F = np.maximum(H - go, F - ge)
+        row = H[:, :-1] + np.take(flat, Q[:, i - 1][:, None] + T)
+        np.maximum(row, F[:, 1:], out=row)
+        np.maximum(row, 0, out=row)
+
+        #L : horizontal gaps as a running maximum, which is exact because opening costs at least as much as extending
+        running = np.maximum.accumulate(row + ramp, axis=1) - ramp - go
+        E[:, 1:] = running[:, :-1]
+
+        H = np.empty_like(H)
+        H[:, 0] = 0
+        np.maximum(row, E, out=H[:, 1:])
+
+        row_best = H[:, 1:].max(axis=1)
+        better = (row_best > best) & (i <= query_lens)
+        best = np.where(better, row_best, best)
+        best_i = np.where(better, i, best_i)
+        best_j = np.where(better, H[:, 1:].argmax(axis=1) + 1, best_j)
+
+    return best, best_i, best_j
+
+
+def align_pair(query, target, scores, gap_open : int = 11, gap_extend : int = 1) :
+    #L : same recurrence as smith_waterman_batch but keeping every row so that we can trace the alignment back
+    q_len, t_len = len(query), len(target)
+    go, ge = gap_open + gap_extend, gap_extend
+    ramp = np.arange(1, t_len + 1, dtype=np.int32) * ge
+
+    H = np.zeros((q_len + 1, t_len + 1), dtype=np.int32)
+    E = np.full((q_len + 1, t_len + 1), NEG, dtype=np.int32)
+    F = np.full((q_len + 1, t_len + 1), NEG, dtype=np.int32)
+    target = np.asarray(target, dtype=np.int64)
+
+    for i in range(1, q_len + 1) :
+        F[i] = np.maximum(H[i - 1] - go, F[i - 1] - ge)
+        row = np.maximum(H[i - 1, :-1] + scores[query[i - 1], target], F[i, 1:])
+        np.maximum(row, 0, out=row)
+        running = np.maximum.accumulate(row + ramp) - ramp - go
+        E[i, 2:] = running[:-1]
+        H[i, 1:] = np.maximum(row, E[i, 1:])
+
+    i, j = np.unravel_index(np.argmax(H), H.shape)
+    score = int(H[i, j])
+    end_i, end_j = i, j
+
+    q_aln, t_aln = [], []
+    state = 'H'
+    while i > 0 and j > 0 :
+        if state == 'H' :
+            if H[i, j] == 0 : break
+            if H[i, j] == H[i - 1, j - 1] + scores[query[i - 1], target[j - 1]] :
+                q_aln.append(query[i - 1])
+                t_aln.append(target[j - 1])
+                i, j = i - 1, j - 1
+            elif H[i, j] == E[i, j] : state = 'E'
+            else : state = 'F'
+        elif state == 'E' :
+            q_aln.append(-1)
+            t_aln.append(target[j - 1])
+            if E[i, j] != H[i, j - 1] - go : state = 'E'
+            else : state = 'H'
+            j -= 1
+        else :
+            q_aln.append(query[i - 1])
+            t_aln.append(-1)
+            if F[i, j] != H[i - 1, j] - go : state = 'F'
+            else : state = 'H'
+            i -= 1
+
+    q_aln.reverse()
+    t_aln.reverse()
+    return score, (i + 1, end_i, j + 1, end_j), q_aln, t_aln
+
+
+def describe_alignment(score, coordinates, q_aln, t_aln, scores, db_len, query_len) :
+    query_from, query_to, hit_from, hit_to = coordinates
+    qseq, hseq, midline = [], [], []
+    identity = positive = gaps = 0
+    for a, b in zip(q_aln, t_aln) :
+        qseq.append('-' if a < 0 else ALPHABET[a])
+        hseq.append('-' if b < 0 else ALPHABET[b])
+        if a < 0 or b < 0 :
+            gaps += 1
+            midline.append(' ')
+        elif a == b :
+            identity += 1
+            positive += 1
+            midline.append(ALPHABET[a])
+        elif scores[a, b] > 0 :
+            positive += 1
+            midline.append('+')
+        else :
+            midline.append(' ')
+
+    bitscore = (LAMBDA * score - math.log(KAPPA)) / math.log(2)
+    evalue = query_len * db_len * 2 ** (-bitscore)
+    return {
+        'score' : score, 'bitscore' : bitscore, 'evalue' : evalue,
+        'query_from' : int(query_from), 'query_to' : int(query_to), 'hit_from' : int(hit_from), 'hit_to' : int(hit_to),
+        'identity' : identity, 'positive' : positive, 'gaps' : gaps, 'align_len' : len(qseq),
+        'qseq' : ''.join(qseq), 'hseq' : ''.join(hseq), 'midline' : ''.join(midline)
+    }
+
+
+class KmerSearchBackend :
+    def __init__(self, db_fasta, k : int = 4, min_hits : int = 1, max_candidates : int = 50,
+                 batch_cells : int = 1 << 18, gap_open : int = 11, gap_extend : int = 1) :
+        self.db_fasta = Path(db_fasta)
+        self.min_hits = min_hits
+        self.max_candidates = max_candidates
+        self.batch_cells = batch_cells
+        self.gap_open = gap_open
+        self.gap_extend = gap_extend
+        self.scores = load_scoring_matrix()
+
+        self.target_ids, self.target_defs, self.targets = [], [], []
+        with FastaReader(self.db_fasta) as reader :
+            for id, description, sequence in reader.records(descriptions=True) :
+                self.target_ids.append(id)
+                self.target_defs.append(description)
+                self.targets.append(encode(sequence))
+            for line_num, line in reader.malformed : 
+                display.warning(f'Skipping malformed line {line_num} of {self.db_fasta}: {line}')
+        self.db_len = sum(len(t) for t in self.targets)
+
+        self.index = KmerIndex(self.targets, k)
+        display.info(f'We have indexed {len(self.targets)} targets ({self.db_len} residues) from {self.db_fasta}')
+
+    def search_params(self) :
+        return {
+            'backend' : 'kmer', 'version' : VERSION, 'database' : str(self.db_fasta), 'database_mtime' : self.db_fasta.stat().st_mtime_ns,
+            'k' : self.index.k, 'min_hits' : self.min_hits, 'max_candidates' : self.max_candidates,
+            'gap_open' : self.gap_open, 'gap_extend' : self.gap_extend
+        }
+
+    @metrics.times('kmer_align')
+    def score_pairs(self, pairs, queries) :
+        #L : sorting by length keeps the padding of every batch small
+        pairs = sorted(pairs, key=lambda p : (len(queries[p[0]]), len(self.targets[p[1]])))
+        results = {}
+        start = 0
+        while start < len(pairs) :
+            end, widest = start, 0
+            while end < len(pairs) :
+                widest = max(widest, len(self.targets[pairs[end][1]]))
+                if end > start and (end - start + 1) * widest > self.batch_cells : break
+                end += 1
+            batch = pairs[start:end]
+            best, _, _ = smith_waterman_batch(
+                [queries[q] for q, _ in batch], [self.targets[t] for _, t in batch],
+                self.scores, self.gap_open, self.gap_extend
+            )
+            for pair, score in zip(batch, best) : results[pair] = int(score)
+            start = end
+        return results
+
+    def search(self, jobs) :
+        queries = [encode(job.sequence) for job in jobs]
+        pairs = []
+        for q, query in enumerate(queries) :
+            for t in self.index.candidates(query, self.min_hits, self.max_candidates) :
+                pairs.append((q, int(t)))
+        display.info(f'We have {len(pairs)} candidate pairs to score for {len(jobs)} queries.')
+
+        scored = self.score_pairs(pairs, queries)
+        per_query = {}
+        for (q, t), score in scored.items() : per_query.setdefault(q, []).append((score, t))
+
+        for q, job in enumerate(jobs) :
+            hits = []
+            for score, t in sorted(per_query.get(q, []), reverse=True)[:job.hitlist_size] :
+                bitscore = (LAMBDA * score - math.log(KAPPA)) / math.log(2)
+                if len(queries[q]) * self.db_len * 2 ** (-bitscore) > job.expect : continue
+
+                score, coordinates, q_aln, t_aln = align_pair(queries[q], self.targets[t], self.scores, self.gap_open, self.gap_extend)
+                hit = describe_alignment(score, coordinates, q_aln, t_aln, self.scores, self.db_len, len(queries[q]))
+                target_id = self.target_ids[t]
+                hit.update({
+                    'hit_id' : target_id,
+                    'hit_def' : self.target_defs[t],
+                    'accession' : target_id.split('|')[1] if target_id.count('|') >= 2 else target_id,
+                    'hit_len' : len(self.targets[t])
+                })
+                hits.append(hit)
+
+            if job.format_type == 'Tabular' :
+                text = format_blast_tabular(job.id, job.id, hits, database=self.db_fasta.name, version=VERSION)
+            else :
+                text = format_blast_xml(
+                    job.id, job.id, len(queries[q]), hits, database=self.db_fasta.name,
+                    db_num=len(self.targets), db_len=self.db_len, version=VERSION, expect=job.expect,
+                    gap_open=self.gap_open, gap_extend=self.gap_extend, kappa=KAPPA, lam=LAMBDA, entropy=ENTROPY
+                )
+            yield job.id, io.StringIO(text)
@@ -0,0 +1,132 @@
+from config import display
+
+from blast_xml import split_multi_query, assign_to_jobs
+from aftools_common.metrics import metrics
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import List, Optional
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+
+
+OUTFMT = {'XML' : '5', 'Tabular' : '7'}
+
+
+def run_shard(program : str, db_prefix : str, fasta : str, work_dir : str, options : List[str]) -> str :
+    #L : runs in a worker process, every shard gets one core since the pool already uses all of them
+    query_file = tempfile.NamedTemporaryFile('w', suffix='.fasta', dir=work_dir, delete=False)
+    with query_file :
+        query_file.write(fasta)
+    output_path = query_file.name[:-len('.fasta')] + '.out'
+
+    try :
+        subprocess.run(
+            [program, '-query', query_file.name, '-db', db_prefix, '-num_threads', '1', '-out', output_path] + options,
+            check=True,
+            capture_output=True,
+            text=True
+        )
+    finally :
+        os.remove(query_file.name)
+    return output_path
+
+
+class LocalBlastBackend :
+    def __init__(self, db_fasta, db_dir, workers : Optional[int] = None, shard_residues : int = 20000, program : str = 'blastp') :
+        self.db_fasta = Path(db_fasta)
+        self.db_dir = Path(db_dir)
+        self.db_prefix = self.db_dir / self.db_fasta.stem
+        self.workers = workers or os.cpu_count() or 1
+        self.shard_residues = shard_residues
+        self.program = program
+
+        for binary in [program, 'makeblastdb'] :
+            if shutil.which(binary) is None :
+                raise Exception(f"{binary} not found. Please install BLAST+ and add it to your PATH to use the local backend.")
+
+    def search_params(self) :
+        return {'backend' : 'local', 'program' : self.program, 'database' : str(self.db_fasta), 'database_mtime' : self.db_fasta.stat().st_mtime_ns}
+
+    def database_is_current(self) :
+        volumes = list(self.db_dir.glob(f'{self.db_prefix.name}*.pin')) + list(self.db_dir.glob(f'{self.db_prefix.name}*.pal'))
+        if not volumes : return False
+        return min(volume.stat().st_mtime for volume in volumes) >= self.db_fasta.stat().st_mtime
+
+    @metrics.times('local_build_db')
+    def build_database(self) :
+        if self.database_is_current() :
+            display.info(f'Local BLAST database {self.db_prefix} is up to date.')
+            return
+
+        self.db_dir.mkdir(parents=True, exist_ok=True)
+        display.info(f'Building local BLAST database {self.db_prefix} from {self.db_fasta}')
+        try :
+            subprocess.run(
+                ['makeblastdb', '-in', str(self.db_fasta), '-dbtype', 'prot', '-out', str(self.db_prefix)],
+                check=True,
+                capture_output=True,
+                text=True
+            )
+        except subprocess.CalledProcessError as e :
+            display.error(f'makeblastdb failed on {self.db_fasta} : {e.stderr}')
+            raise
+
+    def command_options(self, job) :
+        #L : alignments and entrez queries only mean something on NCBI, the hit list and e-value apply everywhere
+        return ['-outfmt', OUTFMT[job.format_type], '-max_target_seqs', str(job.hitlist_size), '-evalue', str(job.expect)]
+
+    def shard_jobs(self, jobs) :
+        #L : small shards so that every core stays busy until the end of the batch
+        total = sum(len(job.sequence) for job in jobs)
+        budget = max(1, min(self.shard_residues, total // (self.workers * 4) or 1))
+        shards = []
+        current, size = [], 0
+        for job in jobs :
+            if current and size + len(job.sequence) > budget :
+                shards.append(current)
+                current, size = [], 0
+            current.append(job)
+            size += len(job.sequence)
+        if current : shards.append(current)
+        return shards
+
+    def search(self, jobs) :
+        if not jobs : return
+        self.build_database()
+
+        if any(job.entrez_query for job in jobs) :
+            display.warning('Entrez queries are ignored by the local backend, restrict the database fasta instead.')
+
+        #L : jobs asking for different options cannot share a blastp call
+        groups = {}
+        for job in jobs : groups.setdefault(tuple(self.command_options(job)), []).append(job)
+        shards = [(list(options), shard) for options, group in groups.items() for shard in self.shard_jobs(group)]
+        display.info(f'Running {len(jobs)} jobs in {len(shards)} shards over {self.workers} processes.')
+
+        with tempfile.TemporaryDirectory(dir=self.db_dir) as work_dir :
+            with ProcessPoolExecutor(max_workers=self.workers) as executor :
+                futures = {
+                    executor.submit(run_shard, self.program, str(self.db_prefix), '\n'.join(job.fasta for job in shard), work_dir, options) : shard
+                    for options, shard in shards
+                }
+
+                for future in as_completed(futures) :
+                    shard = futures[future]
+                    try :
+                        output_path = future.result()
+                        with open(output_path, 'r') as output :
+                            parts = split_multi_query(output.read(), shard[0].format_type)
+                        os.remove(output_path)
+                    except subprocess.CalledProcessError as e :
+                        display.error(f"{self.program} failed on shard {', '.join(job.id for job in shard)} : {e.stderr}")
+                        continue
+                    except Exception as e :
+                        display.error(f"Failed to process shard {', '.join(job.id for job in shard)} : {e}")
+                        continue
+
+                    assigned = assign_to_jobs(parts, [job.id for job in shard])
+                    for job in shard :
+                        if job.id in assigned : yield job.id, io.StringIO(assigned[job.id])
@@ -0,0 +1,300 @@
+from config import display
+from uniprot_cache import SUMMARY_KIND
+
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List
+import json
+import os
+import re
+import numpy as np
+
+
+GRAM = 3
+#L : names are cut in trigrams by chunks, so the arrays of a multi-million names catalog never exist all at once
+CHUNK = 500000
+SEPARATOR = ' : '
+#L : the names added or renamed since the last merge get their own small segment, it is merged in the main one past this share of the names
+MERGE_SHARE = 0.1
+CACHE_SOURCE = 'cache'
+
+
+def reads_names_file(names_path) :
+    #L : names files hold "id : name : length" lines, or "id : name" when they come from batch_gets_name
+    with open(names_path, 'r') as names_file :
+        for line in names_file :
+            parts = line.rstrip('\n').split(SEPARATOR)
+            if len(parts) < 2 : continue
+            if len(parts) == 2 :
+                yield parts[0].strip(), parts[1].strip(), -1
+                continue
+            length = parts[-1].strip()
+            yield parts[0].strip(), SEPARATOR.join(parts[1:-1]).strip(), int(length) if length.isdigit() else -1
+
+
+def packs(strings : List[str]) :
+    encoded = [string.encode() for string in strings]
+    ends = np.cumsum([len(e) for e in encoded], dtype=np.int64) if encoded else np.empty(0, dtype=np.int64)
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), ends
+
+
+def unpacks(blob, ends) -> List[str] :
+    data = blob.tobytes()
+    starts = [0] + ends[:-1].tolist()
+    return [data[start:end].decode() for start, end in zip(starts, ends.tolist())]
+
+
+def gram_codes(encoded : bytes) -> set :
+    return {encoded[i] << 16 | encoded[i + 1] << 8 | encoded[i + 2] for i in range(len(encoded) - GRAM + 1)}
+
+
+def gram_pairs(names : List[str], first : int) :
+    #L : every (trigram, name) pair packed in one int64, trigram in the high bits so that sorting groups the postings
+    encoded = [name.lower().encode() for name in names]
+    lengths = np.array([len(e) for e in encoded], dtype=np.int64)
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8).astype(np.int64)
+    owners = np.repeat(np.arange(first, first + len(names), dtype=np.int64), lengths)
+    positions = np.arange(len(data), dtype=np.int64) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    starts = np.nonzero(positions + GRAM <= np.repeat(lengths, lengths))[0]
+    codes = data[starts] << 16 | data[starts + 1] << 8 | data[starts + 2]
+    return sorted_unique(np.sort(codes << 32 | owners[starts]))
+
+
+def segments(pairs) :
+    #L : sorted (trigram, name) pairs -> the trigrams, where their postings start and the postings
+    keys = pairs >> 32
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.empty(0, dtype=np.int64)
+    return keys[starts], np.append(starts, len(pairs)).astype(np.int64), (pairs & 0xffffffff).astype(np.int32)
+
+
+def looks_up(grams, offsets, postings, code : int) :
+    i = np.searchsorted(grams, code)
+    if i < len(grams) and grams[i] == code : return postings[offsets[i]:offsets[i + 1]]
+    return np.empty(0, dtype=np.int32)
+
+
+def sorted_unique(values) :
+    #L : np.unique goes through a hash table on recent numpy, on sorted values a shifted comparison is much faster
+    first = np.ones(len(values), dtype=bool)
+    first[1:] = values[1:] != values[:-1]
+    return values[first]
+
+
+class NameIndex :
+    def __init__(self, index_dir = None) :
+        self.index_dir = Path(index_dir) if index_dir else None
+        self.ids, self.names, self.lengths = [], [], []
+        self.positions = {}
+        self.sources = {}
+        self.members = {}
+        self.cache_since = 0
+        self.grams = np.empty(0, dtype=np.int64)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.postings = np.empty(0, dtype=np.int32)
+        #L : the main segment covers the first `merged` names as they were at the last merge, the delta one the `dirty` positions
+        self.merged = 0
+        self.dirty = set()
+        self.delta = (np.empty(0, dtype=np.int64), np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int32))
+        self.stale = False
+        if self.index_dir is not None and (self.index_dir / 'index.npz').exists() : self.load()
+
+    def __len__(self) :
+        return len(self.ids)
+
+    def adds(self, id : str, name : str, length : int = -1) -> int :
+        position = self.positions.get(id)
+        if position is None :
+            position = self.positions[id] = len(self.ids)
+            self.ids.append(id)
+            self.names.append(name)
+            self.lengths.append(length)
+            self.dirty.add(position)
+            self.stale = True
+        elif self.names[position] != name or (length >= 0 and self.lengths[position] != length) :
+            self.names[position] = name
+            if length >= 0 : self.lengths[position] = length
+            self.dirty.add(position)
+            self.stale = True
+        return position
+
+    def refresh(self, names_paths : Iterable = (), cache = None, clean : Callable[[str], str] = str.strip) :
+        #L : only the names files that changed and the entries cached since the last refresh are read again
+        for names_path in names_paths :
+            names_path = Path(names_path)
+            if not names_path.exists() : continue
+            stat = names_path.stat()
+            signature = [stat.st_size, stat.st_mtime_ns]
+            source = str(names_path.resolve())
+            if self.sources.get(source) == signature : continue
+            positions = [self.adds(id, name, length) for id, name, length in reads_names_file(names_path)]
+            self.members[source] = np.unique(np.array(positions, dtype=np.int64))
+            self.sources[source] = signature
+            self.stale = True
+
+        if cache is not None :
+            positions = []
+            for accession, entry, fetched in cache.iter_since(SUMMARY_KIND, self.cache_since) :
+                self.cache_since = max(self.cache_since, fetched)
+                if entry.get('protein_name') is None : continue
+                length = str(entry.get('length') or '')
+                positions.append(self.adds(accession, clean(entry['protein_name']), int(length) if length.isdigit() else -1))
+            if positions :
+                self.members[CACHE_SOURCE] = np.union1d(self.members.get(CACHE_SOURCE, np.empty(0, dtype=np.int64)), positions)
+
+        if self.stale :
+            #L : a refresh only indexes and writes the changed names, the whole index is rebuilt and rewritten once they pass MERGE_SHARE
+            merges = len(self.dirty) > len(self.names) * MERGE_SHARE
+            if merges : self.build()
+            else : self.builds_delta()
+            if self.index_dir is not None :
+                if merges : self.save()
+                self.saves_delta()
+        return self
+
+    def build(self) :
+        pairs = [gram_pairs(self.names[i:i + CHUNK], i) for i in range(0, len(self.names), CHUNK)]
+        #L : the chunks hold different names, so their sorted pairs never collide and a plain sort merges them
+        combined = np.sort(np.concatenate(pairs)) if pairs else np.empty(0, dtype=np.int64)
+        self.grams, self.offsets, self.postings = segments(combined)
+        self.merged = len(self.names)
+        self.dirty = set()
+        self.builds_delta()
+        display.info(f'We have indexed {len(self.names)} protein names ({len(self.grams)} trigrams, {len(self.postings)} postings).')
+
+    def builds_delta(self) :
+        #L : the pairs of the dirty names are built on 0..n then moved to their positions, sorted again since the chunks interleave
+        dirty = np.array(sorted(self.dirty), dtype=np.int64)
+        names = [self.names[position] for position in dirty.tolist()]
+        pairs = np.concatenate([gram_pairs(names[i:i + CHUNK], i) for i in range(0, len(names), CHUNK)]) if names else np.empty(0, dtype=np.int64)
+        self.delta = segments(np.sort(pairs >> 32 << 32 | dirty[pairs & 0xffffffff]))
+        self.stale = False
+
+    def metas(self) :
+        meta = {'sources' : self.sources, 'members' : list(self.members), 'cache_since' : self.cache_since, 'merged' : self.merged}
+        members = {f'member_{i}' : positions for i, positions in enumerate(self.members.values())}
+        return meta, members
+
+    def save(self) :
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        ids, id_ends = packs(self.ids)
+        names, name_ends = packs(self.names)
+        meta, members = self.metas()
+        tmp_path = self.index_dir / '.index.tmp.npz'
+        np.savez(
+            tmp_path,
+            meta=np.array(json.dumps(meta)),
+            ids=ids, id_ends=id_ends,
+            names=names, name_ends=name_ends,
+            lengths=np.array(self.lengths, dtype=np.int64),
+            grams=self.grams, offsets=self.offsets, postings=self.postings,
+            **members
+        )
+        os.replace(tmp_path, self.index_dir / 'index.npz')
+
+    def saves_delta(self) :
+        #L : the delta file holds the dirty names and their segment, it only applies on top of the main file it was written after
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        dirty = sorted(self.dirty)
+        ids, id_ends = packs([self.ids[position] for position in dirty])
+        names, name_ends = packs([self.names[position] for position in dirty])
+        meta, members = self.metas()
+        grams, offsets, postings = self.delta
+        tmp_path = self.index_dir / '.delta.tmp.npz'
+        np.savez(
+            tmp_path,
+            meta=np.array(json.dumps(meta)),
+            positions=np.array(dirty, dtype=np.int64),
+            ids=ids, id_ends=id_ends,
+            names=names, name_ends=name_ends,
+            lengths=np.array([self.lengths[position] for position in dirty], dtype=np.int64),
+            grams=grams, offsets=offsets, postings=postings,
+            **members
+        )
+        os.replace(tmp_path, self.index_dir / 'delta.npz')
+
+    def load(self) :
+        with np.load(self.index_dir / 'index.npz', allow_pickle=False) as data :
+            meta = json.loads(str(data['meta']))
+            self.ids = unpacks(data['ids'], data['id_ends'])
+            self.names = unpacks(data['names'], data['name_ends'])
+            self.lengths = data['lengths'].tolist()
+            self.grams, self.offsets, self.postings = data['grams'], data['offsets'], data['postings']
+            self.members = {source : data[f'member_{i}'] for i, source in enumerate(meta['members'])}
+        self.merged = len(self.ids)
+        delta_path = self.index_dir / 'delta.npz'
+        if delta_path.exists() :
+            with np.load(delta_path, allow_pickle=False) as data :
+                delta_meta = json.loads(str(data['meta']))
+                #L : a delta written before the last merge was interrupted is older than the main file, we keep the main one
+                if delta_meta.get('merged') == self.merged :
+                    meta = delta_meta
+                    for position, id, name, length in zip(data['positions'].tolist(), unpacks(data['ids'], data['id_ends']), unpacks(data['names'], data['name_ends']), data['lengths'].tolist()) :
+                        if position < len(self.ids) :
+                            self.names[position], self.lengths[position] = name, length
+                        else :
+                            self.ids.append(id)
+                            self.names.append(name)
+                            self.lengths.append(length)
+                        self.dirty.add(position)
+                    self.delta = (data['grams'], data['offsets'], data['postings'])
+                    self.members = {source : data[f'member_{i}'] for i, source in enumerate(meta['members'])}
+        self.sources = meta['sources']
+        self.cache_since = meta['cache_since']
+        self.positions = {id : position for position, id in enumerate(self.ids)}
+
+    def posting(self, code : int) :
+        #L : a renamed name may keep postings of its former name in the main segment, matches_substring checks every candidate anyway
+        main = looks_up(self.grams, self.offsets, self.postings, code)
+        if not self.dirty : return main
+        delta = looks_up(*self.delta, code)
+        if not len(delta) : return main
+        return np.union1d(main, delta).astype(np.int32)
+
+    def matches_substring(self, pattern : str, within = None) -> set :
+        #L : a name holds the pattern only if it holds all of its trigrams, we intersect from the rarest one and check what is left
+        postings = sorted((self.posting(code) for code in gram_codes(pattern.encode())), key=len)
+        if within is not None : postings.insert(0, within)
+        candidates = postings[0]
+        for posting in postings[1:] :
+            if not len(candidates) : break
+            candidates = np.intersect1d(candidates, posting, assume_unique=True)
+        return {position for position in candidates.tolist() if pattern in self.names[position].lower()}
+
+    def matches_regexes(self, regexes : List[re.Pattern], within = None) -> Dict[re.Pattern, set] :
+        #L : one pass over the names for all the regexes together, then each regex only looks at the names that matched any of them
+        positions = range(len(self.names)) if within is None else within.tolist()
+        if len(regexes) > 1 and not any(regex.groups for regex in regexes) :
+            try :
+                combined = re.compile('|'.join(f'(?:{regex.pattern})' for regex in regexes), re.IGNORECASE)
+                positions = [position for position in positions if combined.search(self.names[position])]
+            except re.error :
+                pass
+        return {regex : {position for position in positions if regex.search(self.names[position])} for regex in regexes}
+
+    def search(self, filters : Dict[str, Iterable], source = None) -> Dict[str, set] :
+        #L : plain strings are case insensitive substrings, compiled patterns are regexes, every pattern is matched once whatever the number of filters using it
+        filters = {label : [patterns] if isinstance(patterns, (str, re.Pattern)) else list(patterns) for label, patterns in filters.items()}
+        within = None
+        if source is not None :
+            within = self.members.get(source if source == CACHE_SOURCE else str(Path(source).resolve()), np.empty(0, dtype=np.int64))
+
+        substrings, regexes = set(), {}
+        for patterns in filters.values() :
+            for pattern in patterns :
+                if isinstance(pattern, re.Pattern) : regexes[pattern] = pattern
+                elif len(pattern.encode()) >= GRAM : substrings.add(pattern.lower())
+                else : regexes[pattern] = re.compile(re.escape(pattern), re.IGNORECASE)
+
+        found = {substring : self.matches_substring(substring, within) for substring in substrings}
+        scanned = self.matches_regexes(list(set(regexes.values())), within)
+        found.update({key : scanned[regex] for key, regex in regexes.items()})
+
+        matches = {}
+        for label, patterns in filters.items() :
+            positions = set().union(*(found[pattern.lower() if isinstance(pattern, str) and pattern not in regexes else pattern] for pattern in patterns))
+            matches[label] = {self.ids[position] for position in positions}
+        return matches
+
+    def line(self, id : str) -> str :
+        position = self.positions[id]
+        length = self.lengths[position]
+        return f'{id}{SEPARATOR}{self.names[position]}{SEPARATOR}{length if length >= 0 else None}'
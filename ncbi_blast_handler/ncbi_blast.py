@@ -1,112 +1,482 @@
-from config import display
-from config import BLAST_RESULTS_DIR, WORKPLACE, TOOLS , display
+from config import NCBI_BLAST_URL, display
 
-import Bio
-from Bio.Blast import NCBIWWW
+#L : requests, Biopython, numpy, scipy and the UniProt client are imported by the modes that use them, --help starts without them
 from pathlib import Path
-from uniprot import Uniprot
+from blast_xml import split_multi_query, assign_to_jobs
+from result_names import RESULT_FORMATS, split_result_name, result_format
+from result_cache import BlastResultCache
+from rid_ledger import RidLedger
+from aftools_common.fasta_reader import FastaReader
+from aftools_common.metrics import metrics, Profiler
+import io
+import re
 import time
 from argparse import ArgumentParser
 import os
 from typing import Dict, List, Optional, Tuple, Union
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
+import gzip
+import shutil
+
+#L : the sequences of a --seq_file batch are turned into jobs and searched this many at a time
+SEQUENCE_CHUNK = 10000
+DOWNLOAD_CHUNK = 1 << 16
 
-uniprot = Uniprot()
 
 @dataclass
 class BlastJob:
     id: str
     sequence: str
     fasta: Optional[str] = None
+    hitlist_size: int = 50
+    expect: float = 10.0
+    entrez_query: Optional[str] = None
+    alignments: int = 500
+    format_type: str = 'XML'
     
     def __post_init__(self):
         if self.fasta is None:
             self.fasta = f">{self.id}\n{self.sequence}"
+        if self.format_type not in RESULT_FORMATS:
+            raise ValueError(f"Unknown format {self.format_type}, we support {', '.join(RESULT_FORMATS)}")
+
+    def search_options(self) -> Dict:
+        #L : only the options that differ from the defaults, so that results searched before keep their cache key
+        return {field.name: getattr(self, field.name) for field in fields(self)
+                if field.name in SEARCH_OPTIONS and getattr(self, field.name) != field.default}
+
+
+SEARCH_OPTIONS = ['hitlist_size', 'expect', 'entrez_query', 'alignments', 'format_type']
+
+
+def iter_chunks(result_handle, chunk_size : int) : 
+    #L : a result is a file object, or an iterator of chunks for a download streamed straight from the server
+    if not hasattr(result_handle, 'read') : 
+        yield from result_handle
+        return
+    chunk = result_handle.read(chunk_size)
+    while chunk : 
+        yield chunk
+        chunk = result_handle.read(chunk_size)
+
+
+def streams_response(response) : 
+    try : 
+        yield from response.iter_content(chunk_size=DOWNLOAD_CHUNK, decode_unicode=True)
+    finally : 
+        response.close()
 
 
 class BlastResultsManager : 
-    def __init__(self, results_dir) : 
+    def __init__(self, results_dir, compress : bool = False, chunk_size : int = 1 << 16) : 
         self.results_dir = Path(results_dir)
+        self.compress = compress
+        self.chunk_size = chunk_size
+        self.index = None
+
+    def refresh_index(self) : 
+        #L : one directory scan per run instead of one stat per job, half-written .part files are not results
+        self.index = {}
+        with os.scandir(self.results_dir) as entries : 
+            for entry in entries : 
+                name = entry.name
+                if name.startswith('.') : continue
+                parsed = split_result_name(name)
+                if parsed : self.index[parsed[0]] = name
+        return self.index
 
     def result_exists(self, job_id) : 
-        file = self.results_dir / f"{job_id}.xml"
-        return file.exists()
+        if self.index is None : self.refresh_index()
+        return job_id in self.index
+
+    def result_name(self, job_id, format_type : str = 'XML') : 
+        return f"{job_id}{RESULT_FORMATS[format_type]}{'.gz' if self.compress else ''}"
+
+    def result_path(self, job_id) : 
+        if self.result_exists(job_id) : return self.results_dir / self.index[job_id]
+        return self.results_dir / self.result_name(job_id)
     
-    def save_result(self, result_handle, job_id) : 
-        path = self.results_dir / f"{job_id}.xml"
+    @metrics.times('blast_save')
+    def save_result(self, result_handle, job_id, format_type : str = 'XML') : 
+        if self.index is None : self.refresh_index()
+        name = self.result_name(job_id, format_type)
+        path = self.results_dir / name
+        tmp_path = self.results_dir / f'.{name}.part'
         try : 
-            with open(path, 'w') as output : 
-                output.write(result_handle.read())
-            display.info(f'Wrote job {job_id}')
-            return output
+            with open(tmp_path, 'wb') as raw : 
+                output = gzip.GzipFile(fileobj=raw, mode='wb') if self.compress else raw
+                for chunk in iter_chunks(result_handle, self.chunk_size) : 
+                    output.write(chunk.encode() if isinstance(chunk, str) else chunk)
+                if self.compress : output.close()
+                raw.flush()
+                os.fsync(raw.fileno())
+            os.replace(tmp_path, path)
+
+            previous = self.index.get(job_id)
+            if previous and previous != name : 
+                (self.results_dir / previous).unlink(missing_ok=True)
+            self.index[job_id] = name
+            return path
         except Exception as e : 
+            tmp_path.unlink(missing_ok=True)
             display.error(f'Failed to save job {job_id} to location {path}. Error : {e}')
             raise
 
+    def link_result(self, source_id, job_id) : 
+        #L : a hard link when both files have the same format, otherwise a streamed copy
+        source = self.result_path(source_id)
+        format_type = result_format(source.name)
+        name = self.result_name(job_id, format_type)
+        if source.name.endswith('.gz') != name.endswith('.gz') : 
+            with (gzip.open(source, 'rb') if source.name.endswith('.gz') else open(source, 'rb')) as result_handle : 
+                return self.save_result(result_handle, job_id, format_type)
+
+        path = self.results_dir / name
+        tmp_path = self.results_dir / f'.{name}.part'
+        tmp_path.unlink(missing_ok=True)
+        try : 
+            os.link(source, tmp_path)
+        except OSError : 
+            shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, path)
+        previous = self.index.get(job_id)
+        if previous and previous != name : 
+            (self.results_dir / previous).unlink(missing_ok=True)
+        self.index[job_id] = name
+        return path
+
+
+def pack_jobs(jobs : List[BlastJob], max_residues : int) -> List[List[BlastJob]] : 
+    #L : a job longer than the budget still gets its own pack
+    packs = []
+    current, size = [], 0
+    for job in jobs : 
+        length = len(job.sequence)
+        if current and size + length > max_residues : 
+            packs.append(current)
+            current, size = [], 0
+        current.append(job)
+        size += length
+    if current : packs.append(current)
+    return packs
+
+
+class RemoteBlastBackend : 
+    def __init__(self, delay, max_residues : int = 10000, program : str = 'blastp', database : str = 'nr',
+                 ledger_path = None, url : str = NCBI_BLAST_URL, poll_interval : float = 60, timeout : float = 60, verbose : bool = True) : 
+        self.delay = delay
+        self.max_residues = max_residues
+        self.program = program
+        self.database = database
+        self.ledger = RidLedger(ledger_path)
+        self.url = url
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.verbose = verbose
+        import requests
+        self.session = requests.Session()
+
+    def search_params(self) : 
+        return {'backend' : 'remote', 'program' : self.program, 'database' : self.database}
+
+    def qblast_options(self, job) : 
+        #L : the descriptions follow the hit list so that text and tabular outputs shrink with it
+        options = {
+            'hitlist_size' : job.hitlist_size,
+            'expect' : job.expect,
+            'alignments' : job.alignments,
+            'descriptions' : job.hitlist_size,
+            'format_type' : job.format_type
+        }
+        if job.entrez_query : options['entrez_query'] = job.entrez_query
+        return options
+
+    def submission_params(self, job) : 
+        return {'program' : self.program, 'database' : self.database, **self.qblast_options(job)}
+
+    @metrics.times('blast_submit')
+    def put(self, jobs : List[BlastJob]) : 
+        options = self.qblast_options(jobs[0])
+        data = {
+            'CMD' : 'Put',
+            'PROGRAM' : self.program,
+            'DATABASE' : self.database,
+            'QUERY' : '\n'.join(job.fasta for job in jobs),
+            'HITLIST_SIZE' : options['hitlist_size'],
+            'EXPECT' : options['expect']
+        }
+        if 'entrez_query' in options : data['ENTREZ_QUERY'] = options['entrez_query']
+        response = self.session.post(self.url, data=data, timeout=self.timeout)
+        response.raise_for_status()
+
+        rid = re.search(r'^\s*RID = (\S+)', response.text, re.M)
+        rtoe = re.search(r'^\s*RTOE = (\d+)', response.text, re.M)
+        if rid is None : 
+            raise RuntimeError('NCBI did not give a RID back for the submission.')
+        return rid.group(1), int(rtoe.group(1)) if rtoe else 0
+
+    def poll(self, rid : str) : 
+        response = self.session.get(self.url, params={'CMD' : 'Get', 'FORMAT_OBJECT' : 'SearchInfo', 'RID' : rid}, timeout=self.timeout)
+        response.raise_for_status()
+        status = re.search(r'Status=(\w+)', response.text)
+        return status.group(1).upper() if status else 'UNKNOWN'
+
+    @metrics.times('blast_poll')
+    def wait_for(self, rid : str) : 
+        #L : NCBI asks for at least a minute between two polls of the same RID
+        import requests
+        entry = self.ledger.searches[rid]
+        remaining = entry['submitted'] + entry['rtoe'] - time.time()
+        if remaining > 0 : time.sleep(remaining)
+        while True : 
+            try : 
+                status = self.poll(rid)
+            except requests.RequestException as e : 
+                display.warning(f'Polling {rid} failed, we will try again : {e}')
+                status = 'WAITING'
+            if status != 'WAITING' : return status
+            time.sleep(self.poll_interval)
+
+    @metrics.times('blast_download')
+    def fetch(self, rid : str, job, stream : bool = False) : 
+        #L : with stream the chunks are written to disk as they arrive, the text is only held when a multi-query output has to be split
+        options = self.qblast_options(job)
+        params = {
+            'CMD' : 'Get',
+            'RID' : rid,
+            'FORMAT_TYPE' : options['format_type'],
+            'ALIGNMENTS' : options['alignments'],
+            'DESCRIPTIONS' : options['descriptions']
+        }
+        response = self.session.get(self.url, params=params, timeout=self.timeout, stream=stream)
+        try : 
+            response.raise_for_status()
+        except Exception : 
+            response.close()
+            raise
+        return streams_response(response) if stream else response.text
+
+    def collect(self, rid : str, jobs : List[BlastJob]) : 
+        status = self.wait_for(rid)
+        self.ledger.set_status(rid, status)
+        if status != 'READY' : 
+            raise RuntimeError(f'Search {rid} ended with status {status}.')
+
+        #L : the output holds every query packed into the RID, even when only some of its jobs are collected after a restart
+        packed = list(self.ledger.searches.get(rid, {}).get('jobs') or [job.id for job in jobs])
+        if len(packed) == 1 : return {jobs[0].id : self.fetch(rid, jobs[0], stream=True)}
+        text = self.fetch(rid, jobs[0])
+        parts = split_multi_query(text, jobs[0].format_type)
+        assigned = assign_to_jobs(parts, packed)
+        wanted = {job.id for job in jobs}
+        return {job_id : io.StringIO(part) for job_id, part in assigned.items() if job_id in wanted}
+
+    def submit_pack(self, jobs : List[BlastJob]) : 
+        rid, rtoe = self.put(jobs)
+        #L : the RID is on disk before we start waiting, an interrupted run picks it up again
+        self.ledger.record(rid, jobs, self.submission_params(jobs[0]), rtoe)
+        return rid
+
+    def search(self, jobs : List[BlastJob]) : 
+        remaining = {job.id : job for job in jobs}
+        for rid in self.ledger.outstanding() : 
+            entry_jobs = [remaining[job_id] for job_id in self.ledger.searches[rid]['jobs'] if job_id in remaining]
+            if not entry_jobs : continue
+            attached = self.ledger.matching_jobs(rid, entry_jobs, self.submission_params(entry_jobs[0]))
+            if not attached : continue
+
+            display.info(f'Reattaching to search {rid} for {len(attached)} jobs submitted before.')
+            try : 
+                handles = self.collect(rid, attached)
+            except Exception as e : 
+                display.warning(f'Could not collect search {rid}, its jobs will be submitted again : {e}')
+                self.ledger.set_status(rid, 'FAILED')
+                continue
+            for job in attached : 
+                if job.id in handles : 
+                    del remaining[job.id]
+                    yield job.id, handles[job.id]
+            self.ledger.set_status(rid, 'DONE')
+
+        #L : one submission carries a single set of options, so jobs are packed per set of options
+        groups = {}
+        for job in remaining.values() : groups.setdefault(tuple(sorted(job.search_options().items())), []).append(job)
+        packs = [pack for group in groups.values() for pack in pack_jobs(group, self.max_residues)]
+        if self.verbose : display.info(f'We have packed {len(remaining)} jobs into {len(packs)} submissions of at most {self.max_residues} residues.')
+
+        for i, pack in enumerate(packs) : 
+            try :
+                rid = self.submit_pack(pack)
+                handles = self.collect(rid, pack)
+                for job in pack : 
+                    if job.id in handles : yield job.id, handles[job.id]
+                self.ledger.set_status(rid, 'DONE')
+            except Exception as e:
+                display.error(f"Failed to process pack {', '.join(job.id for job in pack)}: {e}")
+
+            if i < len(packs) - 1 : time.sleep(self.delay)
+
 
 class NCBIBlastClient :
-    def __init__(self, results_dir, delay) : 
-        self.results_manager = BlastResultsManager(results_dir)
-        self.uniprot = Uniprot()
+    def __init__(self, results_dir, delay, max_residues : int = 10000, backend = None, compress : bool = False,
+                 use_cache : bool = True, cache_bytes : Optional[int] = None) : 
+        self.results_manager = BlastResultsManager(results_dir, compress=compress)
+        self.uniprot_client = None
         self.delay = delay
+        self.backend = backend or RemoteBlastBackend(delay, max_residues, ledger_path=Path(results_dir) / '.rid_ledger.json')
+        self.cache = BlastResultCache(Path(results_dir) / '.cache', max_bytes=cache_bytes) if use_cache else None
+        self.failures = {}
+
+    @property
+    def uniprot(self) : 
+        #L : opening the UniProt cache and dump is only worth it when ids have to be resolved
+        if self.uniprot_client is None : 
+            from uniprot import Uniprot
+            self.uniprot_client = Uniprot()
+        return self.uniprot_client
+
+    def cache_key(self, job) : 
+        return BlastResultCache.make_key(job.sequence, {**self.backend.search_params(), **job.search_options()})
+
+    def result_is_current(self, job) : 
+        if not self.results_manager.result_exists(job.id) : return False
+        if self.cache is None : return True
+        #L : results saved before the cache existed have no link, we keep trusting them
+        linked = self.cache.linked_key(job.id)
+        return linked is None or linked == self.cache_key(job)
+
+    def restore_from_cache(self, job, key, cached_path) : 
+        opener = gzip.open if cached_path.name.endswith('.gz') else open
+        with opener(cached_path, 'rb') as cached : 
+            path = self.results_manager.save_result(cached, job.id, result_format(cached_path.name))
+        self.cache.link(job.id, key)
+        return path
+
+    @metrics.times('jobs_create')
+    def create_jobs_from_uniprot(self, ids : List[str], options : Optional[Dict] = None, workers : int = 8) -> List[BlastJob] : 
+        #L : all the ids are resolved together over one pooled session, the ids we could not use are kept with their reason in self.failures
+        self.uniprot.failures.clear()
+        found = self.uniprot.batch_gets_name_and_sequence_data(ids, workers=workers)
+        jobs = []
+        self.failures = {}
+        for id in dict.fromkeys(ids) : 
+            if id not in found : 
+                self.failures[id] = self.uniprot.failures.get(id, 'not found on UniProt')
+            elif not found[id][3] : 
+                self.failures[id] = 'no sequence on UniProt'
+            else : 
+                jobs.append(BlastJob(id=id, sequence=found[id][3], **(options or {})))
+                continue
+            display.error(f'Skipping {id}, {self.failures[id]}.')
+        if self.failures : 
+            display.warning(f'We have created {len(jobs)} jobs, {len(self.failures)} of {len(jobs) + len(self.failures)} ids failed.')
+        return jobs
 
-    def submit_single(self, job, program : str = 'blastp', database : str = 'nr') : 
-        try:
-            display.info(f"Submitting BLAST for {job.id}")
-            result_handle = NCBIWWW.qblast(program, database, job.fasta)
-            return result_handle
-        except Exception as e : 
-            display.error(f'Job submission failed for {job.id} because of error : {e}')
-
-    def create_job_from_uniprot(self, id) : 
+    def create_job_from_uniprot(self, id, options : Optional[Dict] = None) : 
         try :
-            _ , data = uniprot.gets_taxonomic_id_robust(id)
-            _, full_name, _, sequence = self.uniprot.gets_name_and_sequence_from_data(id, data)
-            full_name.replace(' ', '_')
-            return BlastJob(id=id or full_name, sequence=sequence)
-        
+            jobs = self.create_jobs_from_uniprot([id], options)
         except Exception as e :
             display.error(f'Failed to retrieve data for Uniprot id : {id} : {e}')
             raise
+        if not jobs : 
+            raise ValueError(f'No sequence found for Uniprot id : {id}')
+        return jobs[0]
 
-    def process_single_job(self, id : Optional[str] = None, sequence : Optional[str]= None, skip = True) : 
-        if id and not sequence : job = self.create_job_from_uniprot(id)
-        elif sequence and id : job = BlastJob(id=id, sequence=sequence)
+    def process_single_job(self, id : Optional[str] = None, sequence : Optional[str]= None, skip = True, options : Optional[Dict] = None) : 
+        if id and not sequence : job = self.create_job_from_uniprot(id, options)
+        elif sequence and id : job = BlastJob(id=id, sequence=sequence, **(options or {}))
         else : raise ValueError("You should provide either an id, or a sequence and an id.")
 
-        if skip and self.results_manager.result_exists(job.id) : 
-            display.warning(f'Job {id} already exists. Skipping this job.')
-            return self.results_manager.results_dir / f'{job.id}.xml'
-        
-        result_handle = self.submit_single(job)
-        return self.results_manager.save_result(result_handle, job.id)
+        if skip and self.result_is_current(job) : 
+            display.warning(f'Job {job.id} already exists. Skipping this job.')
+            return self.results_manager.result_path(job.id)
 
-    def process_batch_jobs(self, jobs : List[BlastJob], skip : bool = True) : 
-        results = []
+        results = self.process_batch_jobs([job], skip=skip)
+        if not results : 
+            raise RuntimeError(f'No result came back for job {job.id}.')
+        return results[0]
 
-        for i, job in enumerate(jobs) : 
-            try :
-                if skip and self.results_manager.result_exists(job.id) : 
-                    display.warning(f'Job {id} already exists. Skipping this job.')
-                    continue 
+    @metrics.times('blast_batch')
+    def process_batch_jobs(self, jobs : List[BlastJob], skip : bool = True, verbose : bool = True) : 
+        results = []
+        groups = {}
+        pending = [job for job in jobs if not (skip and self.result_is_current(job))]
+        #L : a caller with its own progress, like the pipeline, runs many small batches quietly
+        progress = display.progress('Jobs', len(pending), quiet=not verbose)
+
+        for job in pending : 
+            key = self.cache_key(job) if self.cache else job.id
+
+            if self.cache and skip : 
+                cached = self.cache.get(key)
+                if cached is not None : 
+                    try : 
+                        results.append(self.restore_from_cache(job, key, cached))
+                        progress.advance('cached')
+                        continue
+                    except Exception as e : 
+                        display.warning(f"Could not restore job {job.id} from the cache, we will search it again : {e}")
+            groups.setdefault(key, []).append(job)
+
+        #L : identical sequences searched with identical parameters are only sent once
+        keys = {group[0].id : key for key, group in groups.items()}
+        searched = {group[0].id : group[0] for group in groups.values()}
+        with progress : 
+            for job_id, result_handle in self.backend.search(list(searched.values())) : 
+                try : 
+                    result_path = self.results_manager.save_result(result_handle, job_id, searched[job_id].format_type)
+                    results.append(result_path)
+                    progress.advance('searched')
+                    if self.cache : 
+                        key = keys[job_id]
+                        cached = self.cache.put(key, result_path)
+                        self.cache.link(job_id, key)
+                        for twin in groups[key][1:] : 
+                            results.append(self.restore_from_cache(twin, key, cached))
+                            progress.advance('cached')
+                except Exception as e:
+                    progress.advance('failed')
+                    display.error(f"Failed to process job {job_id}: {e}")
+
+        missing = len(pending) - len(results)
+        if missing > 0 : 
+            display.warning(f"{missing} jobs did not get a result back.")
+        if self.cache and verbose : 
+            stats = self.cache.stats()
+            display.info(f"Cache : {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} results stored ({stats['bytes'] / 1e6:.1f} MB).")
+        if verbose : display.info(f"Batch is done. We have processed {len(results)} jobs.")
+        return results
 
-                result_handle = self.submit_single(job)
-                result_path = self.results_manager.save_result(result_handle, job.id)
-                results.append(result_path)
-            
-                if i < len(jobs) - 1 : 
-                    display.info(f'Waiting {self.delay} before next submission.')
-                    time.sleep(self.delay)
 
-            except Exception as e:
-                display.error(f"Failed to process job {job.id}: {e}")
+    def process_clustered_batch(self, jobs : List[BlastJob], threshold : float, clusters_path, skip : bool = True) : 
+        from clustering import cluster_jobs
+        representatives, members = cluster_jobs(jobs, threshold=threshold)
+        results = self.process_batch_jobs(representatives, skip=skip)
+
+        #L : one row per member, a run over the same members replaces their rows and keeps the rows of other batches
+        clusters_path = Path(clusters_path)
+        rows = {}
+        if clusters_path.exists() : 
+            with open(clusters_path, 'r') as clusters : 
+                next(clusters, None)
+                for line in clusters : 
+                    if line.strip() : rows[line.split('\t', 1)[0]] = line
+        for member_id, (rep_id, identity) in members.items() : 
+            rows.pop(member_id, None)
+            if not self.results_manager.result_exists(rep_id) : 
+                display.warning(f'No result for representative {rep_id}, {member_id} stays without result.')
                 continue
+            results.append(self.results_manager.link_result(rep_id, member_id))
+            rows[member_id] = f'{member_id}\t{rep_id}\t{identity:.3f}\n'
 
-        display.info(f"Batch is done. We have processed {len(results)} jobs.")
-        return results
-
+        tmp_path = clusters_path.with_name(f'.{clusters_path.name}.part')
+        with open(tmp_path, 'w') as clusters : 
+            clusters.write('member\trepresentative\testimated_identity\n')
+            clusters.writelines(rows.values())
+        os.replace(tmp_path, clusters_path)
 
-    
+        display.info(f'We have mapped {len(members)} cluster members to the results of their representative.')
+        return results
 
 
 class JobFileParser : 
@@ -121,49 +491,43 @@ class JobFileParser :
             display.error(f'Loading of ids from {id_file_path} has failed : {e}')
             raise
 
-    def parse_sequence_file(seq_file_path) :
-        sequences = {}
-
+    def reads_sequence_file(seq_file_path, chunk_size : int = SEQUENCE_CHUNK) :
+        #L : "id : sequence" lines or a FASTA file, yielded as dictionnaries of at most chunk_size sequences so that a large file is never held whole
         try:
-            with open(seq_file_path, 'r', encoding='utf-8') as f:
-                for line_num, line in enumerate(f, 1):
-                    line = line.strip()
-                    if not line:
-                        continue
-                    
-                    parts = line.split(':', 1)
-                    if len(parts) != 2:
-                        display.warning(f"Skipping malformed line {line_num}: {line}")
-                        continue
-                    
-                    job_id, sequence = parts[0].strip(), parts[1].strip()
-                    sequences[job_id] = sequence
-            
-            display.info(f"We have loaded {len(sequences)} sequences from {seq_file_path}")
-            return sequences
+            reader = FastaReader(seq_file_path)
+            count = 0
+            for chunk in reader.chunks(chunk_size):
+                count += len(chunk)
+                yield chunk
+            for line_num, line in reader.malformed:
+                display.warning(f"Skipping malformed line {line_num}: {line}")
+            display.info(f"We have loaded {count} sequences from {seq_file_path}")
         except Exception as e:
             display.error(f"We failed to parse sequence file {seq_file_path}: {e}")
             raise
 
+    def parse_sequence_file(seq_file_path) :
+        sequences = {}
+        for chunk in JobFileParser.reads_sequence_file(seq_file_path):
+            sequences.update(chunk)
+        return sequences
 
-def create_jobs_from_ids(uniprot_ids, client: NCBIBlastClient) -> List[BlastJob]:
-    jobs = []
-    for uniprot_id in uniprot_ids:
-        try:
-            job = client._create_job_from_uniprot_id(uniprot_id)
-            jobs.append(job)
-        except Exception as e:
-            display.error(f"Skipping {uniprot_id} due to error: {e}")
-    return jobs
 
+def create_jobs_from_ids(uniprot_ids, client: NCBIBlastClient, options: Optional[Dict] = None, workers: int = 8) -> List[BlastJob]:
+    try:
+        return client.create_jobs_from_uniprot(uniprot_ids, options, workers)
+    except Exception as e:
+        display.error(f"We failed to retrieve the sequences of {len(uniprot_ids)} ids: {e}")
+        raise
 
-def create_jobs_from_sequences(sequences) -> List[BlastJob]:
-    return [BlastJob(id=job_id, sequence=seq) 
+
+def create_jobs_from_sequences(sequences, options: Optional[Dict] = None) -> List[BlastJob]:
+    return [BlastJob(id=job_id, sequence=seq, **(options or {})) 
             for job_id, seq in sequences.items()]
 
 
-def filter_existing_jobs(jobs: List[BlastJob], results_manager: BlastResultsManager) -> List[BlastJob]:
-    filtered = [job for job in jobs if not results_manager.result_exists(job.id)]
+def filter_existing_jobs(jobs: List[BlastJob], client: NCBIBlastClient) -> List[BlastJob]:
+    filtered = [job for job in jobs if not client.result_is_current(job)]
     skipped_count = len(jobs) - len(filtered)
     
     if skipped_count > 0:
@@ -172,6 +536,38 @@ def filter_existing_jobs(jobs: List[BlastJob], results_manager: BlastResultsMana
     return filtered
 
 
+def creates_client(args, results_dir : Path, workplace : Path) -> NCBIBlastClient : 
+    if args.backend == 'local':
+        from local_blast import LocalBlastBackend
+        backend = LocalBlastBackend(
+            db_fasta=workplace / args.db_fasta,
+            db_dir=workplace / 'blastdb',
+            workers=args.workers,
+            program=args.program
+        )
+    elif args.backend == 'kmer':
+        from kmer_search import KmerSearchBackend
+        backend = KmerSearchBackend(db_fasta=workplace / args.db_fasta)
+    else:
+        backend = RemoteBlastBackend(
+            args.delay, 
+            args.pack_residues, 
+            program=args.program, 
+            database=args.ncbi_db, 
+            ledger_path=results_dir / '.rid_ledger.json', 
+            poll_interval=args.poll_interval
+        )
+    return NCBIBlastClient(
+        results_dir, 
+        delay=args.delay, 
+        max_residues=args.pack_residues, 
+        backend=backend, 
+        compress=args.compress, 
+        use_cache=not args.no_cache, 
+        cache_bytes=int(args.cache_size * 1e6) if args.cache_size else None
+    )
+
+
 def main() : 
 
     display.header("\nNCBI BLAST submission tool developed by Laurène in Pr. Doye's group in Oxford\n")
@@ -183,13 +579,50 @@ def main() :
         default = False, 
         help='Reprocess existing results (default: skip existing)'
     )
-    parser.add_argument('mode', choices = ['single', 'batch'], help='If running in single you need to provide a uniprot id or a single sequence. In batch you need a file with a list of ids or a list of sequences.')
+    parser.add_argument('mode', choices = ['single', 'batch', 'table', 'network'], help='If running in single you need to provide a uniprot id or a single sequence. In batch you need a file with a list of ids or a list of sequences. In table the saved results are gathered into one hit table. In network they become a sparse similarity network split into connected components.')
     parser.add_argument('-i', '--id', default = None ,help='The uniprot id of the protein you want to BLAST')
     parser.add_argument('-s', '--sequence', default = None , help='The sequence of the protein you want to BLAST')
     parser.add_argument('-n', '--name', default = None, help = 'A name for your job with the explicit sequence')
     parser.add_argument('-if', '--id_file', default = None, help = 'A file in your workplace containing a list of ids for when you run in batch mode')
     parser.add_argument('-sf', '--seq_file', default = None, help = 'A file in your workplace containing a list of sequences for when you run in batch mode')
-    parser.add_argument('-d', '--delay', default = 5, help = 'The delay between job submissions')
+    parser.add_argument(
+        '--compress', 
+        action='store_true',
+        default = False, 
+        help='Save the results gzip-compressed as {job_id}.xml.gz'
+    )
+    parser.add_argument(
+        '--no_cache', 
+        action='store_true',
+        default = False, 
+        help='Do not reuse results of identical sequences searched with identical parameters'
+    )
+    parser.add_argument('-cs', '--cache_size', type = float, default = None, help = 'The maximum size of the result cache in MB, least recently used results are evicted first (default: no limit)')
+    parser.add_argument('-d', '--delay', type = float, default = 5, help = 'The delay between job submissions')
+    parser.add_argument('-pr', '--pack_residues', type = int, default = 10000, help = 'The maximum number of residues packed into one multi-query submission in batch mode')
+    parser.add_argument('-b', '--backend', choices = ['remote', 'local', 'kmer'], default = 'remote', help = 'remote sends the queries to NCBI, local runs blastp against a database built from --db_fasta, kmer aligns in process against the proteins of --db_fasta')
+    parser.add_argument('-db', '--db_fasta', default = None, help = 'A fasta file in your workplace to build the local BLAST database from')
+    parser.add_argument('-t', '--top', type = int, default = None, help = 'In table and network modes, only keep the best hits of every query')
+    parser.add_argument('-e', '--max_evalue', type = float, default = None, help = 'In table and network modes, only keep hits under this e-value')
+    parser.add_argument('-mi', '--min_identity', type = float, default = None, help = 'In table and network modes, only keep hits over this percentage of identity')
+    parser.add_argument('-mb', '--min_bitscore', type = float, default = None, help = 'In table and network modes, only keep hits over this bitscore')
+    parser.add_argument('-ml', '--min_align_len', type = int, default = None, help = 'In table and network modes, only keep alignments at least this long')
+    parser.add_argument('-we', '--weight', choices = ['bitscore', 'evalue', 'identity'], default = 'bitscore', help = 'In network mode, the score of the edges, evalue is used as -log10(evalue)')
+    parser.add_argument('-np', '--network_prefix', default = 'blast_network', help = 'In network mode, the files written in your workplace are {prefix}.npz and {prefix}_components.tsv')
+    parser.add_argument('-o', '--output', default = 'blast_hits.tsv', help = 'In table mode, the file in your workplace the hit table is written to')
+    parser.add_argument('-c', '--cluster', type = float, default = None, help = 'In batch mode, only search one representative per group of sequences above this estimated identity (e.g. 0.9) and map the others to its result')
+    parser.add_argument('-w', '--workers', type = int, default = None, help = 'The number of parallel blastp processes for the local backend (default: all cores)')
+    parser.add_argument('-me', '--metrics', default = None, help = 'A file in your workplace the request counts, latencies, retries, bytes and phase times are written to at the end, as JSON if it ends with .json and in the Prometheus text format otherwise')
+    parser.add_argument('-pf', '--profile', choices = ['cprofile', 'sample'], default = None, help = 'Profile the run into profile_{mode}.prof/.txt in your workplace (cprofile, main thread only) or profile_{mode}.folded (sample, every thread, for flame graphs)')
+    parser.add_argument('-uw', '--uniprot_workers', type = int, default = 8, help = 'In batch mode, the number of parallel UniProt requests used to resolve the ids (default: 8)')
+    parser.add_argument('-pi', '--poll_interval', type = float, default = 60, help = 'The delay between two status checks of a remote search, NCBI asks for at least 60 seconds')
+    parser.add_argument('-pg', '--program', default = 'blastp', help = 'The BLAST program to run (default: blastp)')
+    parser.add_argument('-ndb', '--ncbi_db', default = 'nr', help = 'The NCBI database searched by the remote backend (default: nr)')
+    parser.add_argument('-hs', '--hitlist_size', type = int, default = 50, help = 'The maximum number of hits kept for every query (default: 50)')
+    parser.add_argument('-ev', '--expect', type = float, default = 10.0, help = 'Only report hits under this e-value (default: 10)')
+    parser.add_argument('-eq', '--entrez_query', default = None, help = 'Restrict the remote search with an Entrez query, e.g. "txid2759[ORGN]"')
+    parser.add_argument('-al', '--alignments', type = int, default = 500, help = 'The number of alignments the remote backend sends back (default: 500)')
+    parser.add_argument('-f', '--format', choices = list(RESULT_FORMATS), default = 'XML', help = 'XML keeps the full alignments, Tabular only keeps one line per hit and is saved as {job_id}.tsv')
     args = parser.parse_args()
 
     if args.mode == 'single':
@@ -207,17 +640,55 @@ def main() :
             parser.error("For batch mode we require either --id_file or --seq_file")
         if args.id_file and args.seq_file:
             parser.error("Please provide either --id_file or --seq_file, not both")
+
+    if args.backend in ['local', 'kmer'] and not args.db_fasta:
+        parser.error(f"For the {args.backend} backend we require --db_fasta")
     
+    from config import BLAST_RESULTS_DIR, WORKPLACE
     results_dir = Path(BLAST_RESULTS_DIR)
-    client = NCBIBlastClient(results_dir, delay=args.delay)
+    options = {
+        'hitlist_size': args.hitlist_size,
+        'expect': args.expect,
+        'entrez_query': args.entrez_query,
+        'alignments': args.alignments,
+        'format_type': args.format
+    }
+    #L : table and network only read the results, they need neither a backend nor a client
+    client = creates_client(args, results_dir, Path(WORKPLACE)) if args.mode in ['single', 'batch'] else None
     
+    if args.metrics : metrics.instruments_http()
+    profiler = Profiler(args.profile, Path(WORKPLACE) / f'profile_{args.mode}').start()
+
     try:
-        if args.mode == 'single':
+        if args.mode in ['table', 'network']:
+            from hit_table import HitTable
+            table = HitTable.from_results_dir(results_dir)
+            table = table.filter(
+                max_evalue=args.max_evalue, 
+                min_identity=args.min_identity, 
+                min_bitscore=args.min_bitscore, 
+                min_align_len=args.min_align_len
+            )
+            if args.top : table = table.top(args.top)
+
+        if args.mode == 'table':
+            table.write_tsv(Path(WORKPLACE) / args.output)
+            display.info(f"We have written {len(table)} hits to {args.output}")
+
+        elif args.mode == 'network':
+            from similarity_network import SimilarityNetwork
+            network = SimilarityNetwork.from_hit_table(table, weight=args.weight)
+            network.save(Path(WORKPLACE) / f'{args.network_prefix}.npz')
+            network.write_components(Path(WORKPLACE) / f'{args.network_prefix}_components.tsv')
+            display.info(f"We have written the network to {args.network_prefix}.npz and its components to {args.network_prefix}_components.tsv")
+
+        elif args.mode == 'single':
             job_id = args.id or args.name
             result_path = client.process_single_job(
                 id=job_id,
                 sequence=args.sequence,
-                skip=not args.rewrite
+                skip=not args.rewrite,
+                options=options
             )
             display.info(f"Single job completed. We have saved the results saved to {result_path.name}")
             
@@ -225,24 +696,48 @@ def main() :
             if args.id_file:
                 file_path = Path(WORKPLACE) / args.id_file
                 uniprot_ids = JobFileParser.parse_id_file(file_path)
-                jobs = create_jobs_from_ids(uniprot_ids, client)
+                jobs = create_jobs_from_ids(uniprot_ids, client, options, args.uniprot_workers)
+                if client.failures:
+                    with open(Path(WORKPLACE) / 'failed_ids.tsv', 'w') as failures_file:
+                        for id, reason in client.failures.items():
+                            failures_file.write(f'{id}\t{reason}\n')
+                    display.warning(f"The ids we could not BLAST are listed with their reason in failed_ids.tsv")
+                job_chunks = [jobs]
+            elif args.cluster: 
+                #L : clustering compares every sequence with the others, so it still needs them all at once
+                file_path = Path(WORKPLACE) / args.seq_file
+                job_chunks = [create_jobs_from_sequences(JobFileParser.parse_sequence_file(file_path), options)]
             else: 
                 file_path = Path(WORKPLACE) / args.seq_file
-                sequences = JobFileParser.parse_sequence_file(file_path)
-                jobs = create_jobs_from_sequences(sequences)
+                job_chunks = (create_jobs_from_sequences(chunk, options) for chunk in JobFileParser.reads_sequence_file(file_path))
             
-            if not args.rewrite:
-                jobs = filter_existing_jobs(jobs, client.results_manager)
-            
-            if jobs:
-                result_paths = client.process_batch_jobs(jobs, skip=not args.rewrite)
-                display.info(f"We have completed the batch processing. {len(result_paths)} results saved.")
+            job_count, result_count = 0, 0
+            for jobs in job_chunks:
+                if not args.rewrite:
+                    jobs = filter_existing_jobs(jobs, client)
+                job_count += len(jobs)
+                
+                if jobs and args.cluster:
+                    result_count += len(client.process_clustered_batch(jobs, args.cluster, Path(WORKPLACE) / 'blast_clusters.tsv', skip=not args.rewrite))
+                elif jobs:
+                    result_count += len(client.process_batch_jobs(jobs, skip=not args.rewrite))
+
+            if job_count:
+                display.info(f"We have completed the batch processing. {result_count} results saved.")
             else:
                 display.info("No jobs to process unfortunately :(")
                 
     except Exception as e:
         display.error(f"Application error: {e}")
         return 1
+
+    finally:
+        profile_path = profiler.stop()
+        if profile_path : display.info(f"We have written the profile to {profile_path.name}")
+        if args.metrics:
+            metrics.writes(Path(WORKPLACE) / args.metrics)
+            for line in metrics.phase_summary() : display.info(line)
+            display.info(f"We have written the metrics to {args.metrics}")
     
     return 0
 
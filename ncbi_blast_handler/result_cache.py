@@ -0,0 +1,117 @@
+from config import display
+from result_names import split_result_name
+
+from pathlib import Path
+from typing import Optional
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+
+class BlastResultCache :
+    def __init__(self, cache_dir, max_bytes : Optional[int] = None) :
+        self.cache_dir = Path(cache_dir)
+        self.objects_dir = self.cache_dir / 'objects'
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+        #L : the pipeline opens one cache per BLAST worker on the same index, WAL lets them read while one writes and the timeout waits out the writer
+        self.db = sqlite3.connect(self.cache_dir / 'index.sqlite', timeout=60, check_same_thread=False)
+        self.db.executescript('''
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, name TEXT, size INTEGER, last_used REAL, uses INTEGER DEFAULT 0);
+            CREATE TABLE IF NOT EXISTS links (job_id TEXT PRIMARY KEY, key TEXT);
+            CREATE INDEX IF NOT EXISTS objects_last_used ON objects (last_used);
+        ''')
+        self.db.commit()
+
+    @staticmethod
+    def make_key(sequence : str, params : dict) -> str :
+        #L : the digest ignores case and whitespace of the sequence, and the order of the parameters
+        digest = hashlib.sha256()
+        digest.update(''.join(sequence.split()).upper().encode())
+        digest.update(b'\0')
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def object_path(self, key, name) :
+        return self.objects_dir / key[:2] / name
+
+    def get(self, key) :
+        with self.lock :
+            row = self.db.execute('SELECT name FROM objects WHERE key = ?', (key,)).fetchone()
+            path = self.object_path(key, row[0]) if row else None
+            if path is None or not path.exists() :
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute('UPDATE objects SET last_used = ?, uses = uses + 1 WHERE key = ?', (time.time(), key))
+            self.db.commit()
+        return path
+
+    def put(self, key, result_path) :
+        result_path = Path(result_path)
+        _, suffix = split_result_name(result_path.name)
+        name = f'{key}{suffix}'
+        path = self.object_path(key, name)
+        path.parent.mkdir(exist_ok=True)
+
+        #L : a hard link costs no space as long as the result file is kept, we only copy across file systems
+        tmp_path = path.with_name(f'.{name}.part')
+        tmp_path.unlink(missing_ok=True)
+        try :
+            os.link(result_path, tmp_path)
+        except OSError :
+            shutil.copyfile(result_path, tmp_path)
+        os.replace(tmp_path, path)
+
+        with self.lock :
+            self.db.execute(
+                'INSERT OR REPLACE INTO objects (key, name, size, last_used, uses) VALUES (?, ?, ?, ?, 0)',
+                (key, name, path.stat().st_size, time.time())
+            )
+            self.db.commit()
+            self.evict()
+        return path
+
+    def link(self, job_id, key) :
+        with self.lock :
+            self.db.execute('INSERT OR REPLACE INTO links (job_id, key) VALUES (?, ?)', (job_id, key))
+            self.db.commit()
+
+    def linked_key(self, job_id) :
+        with self.lock :
+            row = self.db.execute('SELECT key FROM links WHERE job_id = ?', (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def total_bytes(self) :
+        return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM objects').fetchone()[0]
+
+    def evict(self) :
+        #L : least recently used objects go first, the links stay so that existing results keep their key
+        if self.max_bytes is None : return
+        with self.lock :
+            total = self.total_bytes()
+            if total <= self.max_bytes : return
+
+            evicted = 0
+            for key, name, size in self.db.execute('SELECT key, name, size FROM objects ORDER BY last_used').fetchall() :
+                if total <= self.max_bytes : break
+                self.object_path(key, name).unlink(missing_ok=True)
+                self.db.execute('DELETE FROM objects WHERE key = ?', (key,))
+                total -= size
+                evicted += 1
+            self.db.commit()
+        display.info(f'We have evicted {evicted} results from the cache, it now holds {total} bytes.')
+
+    def stats(self) :
+        with self.lock :
+            entries, size = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects').fetchone()
+        return {'hits' : self.hits, 'misses' : self.misses, 'entries' : entries, 'bytes' : size}
@@ -0,0 +1,13 @@
+#L : the names of the saved results, kept apart from hit_table so that reading them does not import numpy
+RESULT_FORMATS = {'XML' : '.xml', 'Tabular' : '.tsv'}
+RESULT_SUFFIXES = ['.xml.gz', '.xml', '.tsv.gz', '.tsv']
+
+
+def split_result_name(name) :
+    for suffix in RESULT_SUFFIXES :
+        if name.endswith(suffix) : return name[:-len(suffix)], suffix
+    return None
+
+
+def result_format(name) :
+    return 'Tabular' if '.tsv' in split_result_name(name)[1] else 'XML'
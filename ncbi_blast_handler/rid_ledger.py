@@ -0,0 +1,70 @@
+from config import display
+
+from pathlib import Path
+from typing import Dict, List
+import hashlib
+import json
+import os
+import time
+
+
+#L : NCBI keeps the results of a RID for about a day and a half, older entries are of no use
+RID_LIFETIME = 36 * 3600
+
+
+def sequence_digest(sequence : str) -> str :
+    return hashlib.sha1(''.join(sequence.split()).upper().encode()).hexdigest()
+
+
+class RidLedger :
+    def __init__(self, path = None) :
+        self.path = Path(path) if path else None
+        self.searches = {}
+        if self.path and self.path.exists() :
+            try :
+                with open(self.path, 'r') as ledger :
+                    self.searches = json.load(ledger)
+            except (OSError, json.JSONDecodeError) as e :
+                display.warning(f'Could not read the RID ledger {self.path}, starting a new one : {e}')
+        self.prune()
+
+    def save(self) :
+        #L : same write-then-rename as the results, a crash leaves either the old or the new ledger
+        if self.path is None : return
+        tmp_path = self.path.with_name(f'.{self.path.name}.part')
+        with open(tmp_path, 'w') as ledger :
+            json.dump(self.searches, ledger, indent=1)
+            ledger.flush()
+            os.fsync(ledger.fileno())
+        os.replace(tmp_path, self.path)
+
+    def prune(self) :
+        now = time.time()
+        expired = [rid for rid, entry in self.searches.items() if now - entry['submitted'] > RID_LIFETIME]
+        for rid in expired : del self.searches[rid]
+        if expired : self.save()
+
+    def record(self, rid : str, jobs, params : Dict, rtoe : int = 0) :
+        self.searches[rid] = {
+            'jobs' : {job.id : sequence_digest(job.sequence) for job in jobs},
+            'params' : params,
+            'submitted' : time.time(),
+            'rtoe' : rtoe,
+            'status' : 'WAITING'
+        }
+        self.save()
+
+    def set_status(self, rid : str, status : str) :
+        if rid not in self.searches : return
+        self.searches[rid]['status'] = status
+        self.searches[rid]['updated'] = time.time()
+        self.save()
+
+    def outstanding(self) -> List[str] :
+        return [rid for rid, entry in self.searches.items() if entry['status'] in ['WAITING', 'READY']]
+
+    def matching_jobs(self, rid : str, jobs, params : Dict) :
+        #L : a RID only stands for the jobs whose sequence and search options are still the ones submitted
+        entry = self.searches[rid]
+        if entry['params'] != params : return []
+        return [job for job in jobs if entry['jobs'].get(job.id) == sequence_digest(job.sequence)]
@@ -0,0 +1,99 @@
+from config import display
+from aftools_common.metrics import metrics
+
+from pathlib import Path
+from typing import List
+import os
+import re
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+
+VERSION = re.compile(r'\.\d+$')
+
+
+def node_name(name : str) -> str :
+    #L : NCBI gives accessions back with their version, our job ids usually have none
+    return VERSION.sub('', name)
+
+
+class SimilarityNetwork :
+    def __init__(self, names : List[str], matrix) :
+        self.names = list(names)
+        self.matrix = matrix.tocsr()
+
+    def __len__(self) :
+        return len(self.names)
+
+    @property
+    def edges(self) :
+        return self.matrix.nnz
+
+    @classmethod
+    @metrics.times('network_build')
+    def from_hit_table(cls, table, weight : str = 'bitscore', symmetric : bool = True) :
+        #L : queries and subjects share one set of nodes, so an all-vs-all search gives a square matrix
+        index = {}
+        query_nodes = np.array([index.setdefault(node_name(name), len(index)) for name in table.queries], dtype=np.int64)
+        subject_nodes = np.array([index.setdefault(node_name(name), len(index)) for name in table.subjects], dtype=np.int64)
+        size = len(index)
+
+        rows = query_nodes[table['query']] if len(table) else np.empty(0, dtype=np.int64)
+        cols = subject_nodes[table['subject']] if len(table) else np.empty(0, dtype=np.int64)
+        if weight == 'evalue' :
+            weights = -np.log10(np.maximum(table['evalue'], 1e-300))
+        else :
+            weights = table[weight].astype(np.float64)
+
+        #L : self hits carry no information, and only the best HSP of every pair is kept
+        keep = (rows != cols) & (weights > 0)
+        rows, cols, weights = rows[keep], cols[keep], weights[keep]
+        order = np.lexsort((-weights, cols, rows))
+        rows, cols, weights = rows[order], cols[order], weights[order]
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+
+        matrix = sparse.csr_matrix((weights[first].astype(np.float32), (rows[first], cols[first])), shape=(size, size))
+        if symmetric : matrix = matrix.maximum(matrix.T)
+        network = cls(list(index), matrix)
+        display.info(f'We have built a network of {len(network)} proteins and {network.edges} edges from {len(table)} hits.')
+        return network
+
+    def components(self) :
+        #L : components are numbered from the largest to the smallest
+        count, labels = connected_components(self.matrix, directed=True, connection='weak')
+        sizes = np.bincount(labels, minlength=count)
+        rank = np.empty(count, dtype=np.int64)
+        rank[np.argsort(-sizes, kind='stable')] = np.arange(count)
+        return rank[labels], np.sort(sizes)[::-1]
+
+    def save(self, path) :
+        path = Path(path)
+        tmp_path = path.with_name(path.name + '.tmp.npz')
+        np.savez(
+            tmp_path,
+            names=np.array(self.names, dtype=str),
+            data=self.matrix.data,
+            indices=self.matrix.indices,
+            indptr=self.matrix.indptr,
+            shape=np.array(self.matrix.shape, dtype=np.int64)
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path) :
+        with np.load(path, allow_pickle=False) as data :
+            matrix = sparse.csr_matrix((data['data'], data['indices'], data['indptr']), shape=tuple(data['shape']))
+            return cls(data['names'].tolist(), matrix)
+
+    def write_components(self, path) :
+        labels, sizes = self.components()
+        degrees = np.diff(self.matrix.indptr)
+        order = np.lexsort((np.arange(len(labels)), labels))
+        with open(path, 'w') as output :
+            output.write('protein\tcomponent\tcomponent_size\tdegree\n')
+            for i in order :
+                output.write(f'{self.names[i]}\t{labels[i]}\t{sizes[labels[i]]}\t{degrees[i]}\n')
+        display.info(f'We have found {len(sizes)} connected components, the largest holds {sizes[0] if len(sizes) else 0} proteins.')
+        return labels
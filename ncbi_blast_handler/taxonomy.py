@@ -0,0 +1,111 @@
+from config import UNIPROT_REST_URL, display
+from aftools_common.metrics import metrics
+
+from typing import Dict, Iterable, List, Optional
+import re
+import threading
+
+
+RANKS = ['superkingdom', 'kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species']
+RANK_ALIASES = {'domain' : 'superkingdom', 'realm' : 'superkingdom'}
+#L : the taxonomy search takes the ids in the query string, we keep the URL short
+QUERY_SIZE = 200
+ROOT = 1
+
+
+def taxon_id_from(value) -> Optional[int] :
+    match = re.search(r'\d+', str(value or ''))
+    return int(match.group(0)) if match else None
+
+
+class Taxonomy :
+    def __init__(self, cache = None, session_factory = None, offline : bool = False) :
+        #L : offline, the taxa are only resolved from the cache and the lineages of the others stay partial
+        self.cache = cache
+        self.session_factory = session_factory
+        self.offline = offline
+        self.session = None
+        self.nodes = {}
+        self.lineages = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.unknown = set()
+
+    @metrics.times('taxonomy_fetch')
+    def fetches_nodes(self, taxon_ids : List[int]) -> Dict[int, dict] :
+        if self.session is None : self.session = self.session_factory()
+        nodes = {}
+        for i in range(0, len(taxon_ids), QUERY_SIZE) :
+            chunk = taxon_ids[i:i + QUERY_SIZE]
+            params = {
+                'query' : ' OR '.join(f'(tax_id:{taxon_id})' for taxon_id in chunk),
+                'fields' : 'id,scientific_name,rank,parent',
+                'format' : 'tsv',
+                'size' : len(chunk)
+            }
+            response = self.session.get(f'{UNIPROT_REST_URL}/taxonomy/search', params=params, timeout=60)
+            response.raise_for_status()
+            self.requests += 1
+            for line in response.text.splitlines()[1:] :
+                values = line.split('\t')
+                if len(values) < 4 : continue
+                taxon_id = taxon_id_from(values[0])
+                if taxon_id is None : continue
+                nodes[taxon_id] = {'name' : values[1], 'rank' : values[2].lower(), 'parent' : taxon_id_from(values[3])}
+        return nodes
+
+    def loads_nodes(self, taxon_ids : Iterable[int]) :
+        #L : memory first, then the shared cache, then the network, and we climb level by level until every ancestor is known
+        pending = {taxon_id for taxon_id in taxon_ids if taxon_id and taxon_id not in self.nodes}
+        while pending :
+            if self.cache is not None :
+                cached = self.cache.get_many([str(taxon_id) for taxon_id in pending], 'taxon')
+                self.nodes.update({int(taxon_id) : node for taxon_id, node in cached.items()})
+            missing = sorted(taxon_id for taxon_id in pending if taxon_id not in self.nodes)
+            if missing and self.offline :
+                self.unknown.update(missing)
+                pending = pending.difference(missing)
+            elif missing :
+                fetched = self.fetches_nodes(missing)
+                self.nodes.update(fetched)
+                if self.cache is not None : self.cache.put_many({str(taxon_id) : node for taxon_id, node in fetched.items()}, 'taxon')
+                for taxon_id in missing :
+                    if taxon_id not in fetched :
+                        display.warning(f'Taxon {taxon_id} was not found, its lineage stops there.')
+                        self.nodes[taxon_id] = {'name' : '', 'rank' : '', 'parent' : None}
+
+            parents = {self.nodes[taxon_id]['parent'] for taxon_id in pending}
+            pending = {parent for parent in parents if parent and parent != ROOT and parent not in self.nodes and parent not in self.unknown}
+
+    def lineage(self, taxon_id : int) -> List[dict] :
+        if taxon_id in self.lineages : return self.lineages[taxon_id]
+        path = []
+        current = taxon_id
+        while current and current != ROOT and current in self.nodes and len(path) < 100 :
+            if current in self.lineages :
+                path = path + self.lineages[current][::-1]
+                break
+            node = self.nodes[current]
+            path.append({'id' : current, 'name' : node['name'], 'rank' : RANK_ALIASES.get(node['rank'], node['rank'])})
+            current = node['parent']
+        self.lineages[taxon_id] = path[::-1]
+        return self.lineages[taxon_id]
+
+    def resolves(self, taxon_ids : Iterable[int]) -> Dict[int, dict] :
+        #L : one row of rank columns per taxon, every taxon is resolved once whatever the number of proteins sharing it
+        taxon_ids = {taxon_id for taxon_id in taxon_ids if taxon_id}
+        with self.lock :
+            try :
+                self.loads_nodes(taxon_ids)
+            except Exception as e :
+                display.warning(f'We could not resolve {len(taxon_ids)} taxa, their lineages stay empty : {e}')
+            columns = {}
+            for taxon_id in taxon_ids :
+                lineage = self.lineage(taxon_id) if taxon_id in self.nodes else []
+                row = {rank : '' for rank in RANKS}
+                for node in lineage :
+                    if node['rank'] in row : row[node['rank']] = node['name']
+                row['organism'] = lineage[-1]['name'] if lineage else ''
+                row['lineage'] = '; '.join(node['name'] for node in lineage)
+                columns[taxon_id] = row
+        return columns
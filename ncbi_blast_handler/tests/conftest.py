@@ -0,0 +1,6 @@
+from pathlib import Path
+import sys
+
+#L : the modules of the tool import each other by their plain names, as when they are run from their folder
+TOOL_DIR = Path(__file__).resolve().parent.parent
+if str(TOOL_DIR) not in sys.path : sys.path.insert(0, str(TOOL_DIR))
@@ -0,0 +1,44 @@
+from blast_xml import assign_to_jobs, format_blast_xml, split_multi_query
+
+
+def multi_query_xml(query_defs) :
+    #L : one output per query merged the way NCBI returns a packed submission
+    documents = [format_blast_xml(f'Query_{i}', query_def, 100, [], 'nr', 10, 1000) for i, query_def in enumerate(query_defs, 1)]
+    head = documents[0][:documents[0].find('<Iteration>')]
+    tail = documents[0][documents[0].rfind('</BlastOutput_iterations>'):]
+    iterations = [document[document.find('<Iteration>'):document.rfind('</Iteration>') + len('</Iteration>')] for document in documents]
+    return head + '\n'.join(iterations) + '\n' + tail
+
+
+def test_assigns_by_query_def() :
+    parts = split_multi_query(multi_query_xml(['P2 second protein', 'P1 first protein']))
+    assigned = assign_to_jobs(parts, ['P1', 'P2'])
+    assert set(assigned) == {'P1', 'P2'}
+    assert '<Iteration_query-def>P1 first protein</Iteration_query-def>' in assigned['P1']
+    assert '<BlastOutput_query-def>P2 second protein</BlastOutput_query-def>' in assigned['P2']
+    assert all(text.count('<Iteration>') == 1 for text in assigned.values())
+
+
+def test_falls_back_on_submission_order() :
+    parts = split_multi_query(multi_query_xml(['unnamed', 'unnamed']))
+    assigned = assign_to_jobs(parts, ['P1', 'P2'])
+    assert assigned == {'P1' : parts[0][1], 'P2' : parts[1][1]}
+
+
+def test_keeps_only_the_matched_parts() :
+    parts = split_multi_query(multi_query_xml(['P1', 'unnamed', 'P3']))
+    assert set(assign_to_jobs(parts, ['P1', 'P3'])) == {'P1', 'P3'}
+
+
+def test_assigns_a_job_once() :
+    parts = split_multi_query(multi_query_xml(['P1', 'P1']))
+    assigned = assign_to_jobs(parts, ['P1', 'P2', 'P3'])
+    assert list(assigned) == ['P1']
+    assert assigned['P1'] == parts[0][1]
+
+
+def test_splits_tabular_blocks() :
+    text = ''.join(f'# BLASTP 2.15.0+\n# Query: {name}\n{name}\tsp|X|Y\t90.0\n' for name in ['P1', 'P2'])
+    assigned = assign_to_jobs(split_multi_query(text, 'Tabular'), ['P2', 'P1'])
+    assert assigned['P1'].endswith('P1\tsp|X|Y\t90.0\n')
+    assert assigned['P2'].endswith('P2\tsp|X|Y\t90.0\n')
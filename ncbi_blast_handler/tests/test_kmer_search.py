@@ -0,0 +1,79 @@
+import random
+
+from kmer_search import ALPHABET, NEG, align_pair, encode, load_scoring_matrix, smith_waterman_batch
+
+
+SCORES = load_scoring_matrix()
+
+
+def random_sequence(rng, length) :
+    return ''.join(rng.choice(ALPHABET[:20]) for _ in range(length))
+
+
+def gotoh(query, target, scores, gap_open = 11, gap_extend = 1) :
+    #L : the textbook local alignment with affine gaps, one cell at a time
+    go, ge = gap_open + gap_extend, gap_extend
+    H = [[0] * (len(target) + 1) for _ in range(len(query) + 1)]
+    E = [[NEG] * (len(target) + 1) for _ in range(len(query) + 1)]
+    F = [[NEG] * (len(target) + 1) for _ in range(len(query) + 1)]
+    best = 0
+    for i in range(1, len(query) + 1) :
+        for j in range(1, len(target) + 1) :
+            E[i][j] = max(H[i][j - 1] - go, E[i][j - 1] - ge)
+            F[i][j] = max(H[i - 1][j] - go, F[i - 1][j] - ge)
+            H[i][j] = max(0, H[i - 1][j - 1] + int(scores[query[i - 1], target[j - 1]]), E[i][j], F[i][j])
+            best = max(best, H[i][j])
+    return best
+
+
+def pairs(seed, n) :
+    #L : related pairs with substitutions and indels so that the alignments hold gaps, and unrelated pairs of very different lengths
+    rng = random.Random(seed)
+    queries, targets = [], []
+    for k in range(n) :
+        query = random_sequence(rng, rng.randint(5, 60))
+        if k % 2 :
+            target = random_sequence(rng, rng.randint(1, 90))
+        else :
+            target = list(query)
+            for _ in range(rng.randint(0, 6)) :
+                position = rng.randrange(len(target) + 1)
+                change = rng.random()
+                if change < 0.4 : target.insert(position, random_sequence(rng, rng.randint(1, 4)))
+                elif change < 0.8 and position < len(target) : del target[position:position + rng.randint(1, 4)]
+                elif position < len(target) : target[position] = rng.choice(ALPHABET[:20])
+            target = ''.join(target) or 'A'
+        queries.append(encode(query))
+        targets.append(encode(target))
+    return queries, targets
+
+
+def test_batch_scores_match_align_pair() :
+    queries, targets = pairs(1, 40)
+    best, best_i, best_j = smith_waterman_batch(queries, targets, SCORES)
+    for b, (query, target) in enumerate(zip(queries, targets)) :
+        score, (_, end_i, _, end_j), _, _ = align_pair(query, target, SCORES)
+        assert best[b] == score
+        if score : assert (best_i[b], best_j[b]) == (end_i, end_j)
+
+
+def test_scores_match_the_reference() :
+    queries, targets = pairs(2, 12)
+    best, _, _ = smith_waterman_batch(queries, targets, SCORES)
+    assert best.tolist() == [gotoh(query, target, SCORES) for query, target in zip(queries, targets)]
+
+
+def test_alignment_scores_its_own_score() :
+    queries, targets = pairs(3, 20)
+    for query, target in zip(queries, targets) :
+        score, (start_i, end_i, start_j, end_j), q_aln, t_aln = align_pair(query, target, SCORES)
+        total, gap = 0, None
+        for q, t in zip(q_aln, t_aln) :
+            kind = 'q' if q < 0 else 't' if t < 0 else None
+            if kind is None : total += int(SCORES[q, t])
+            else : total -= 1 if kind == gap else 12
+            gap = kind
+        assert total == score
+        if score :
+            assert [q for q in q_aln if q >= 0] == query[start_i - 1:end_i].tolist()
+            assert [t for t in t_aln if t >= 0] == target[start_j - 1:end_j].tolist()
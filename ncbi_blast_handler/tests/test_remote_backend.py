@@ -0,0 +1,84 @@
+from ncbi_blast import BlastJob, RemoteBlastBackend
+from test_blast_xml import multi_query_xml
+
+
+class FakeResponse :
+    def __init__(self, text) :
+        self.text = text
+        self.closed = False
+
+    def raise_for_status(self) :
+        pass
+
+    def iter_content(self, chunk_size = 1, decode_unicode = False) :
+        for start in range(0, len(self.text), chunk_size) : yield self.text[start:start + chunk_size]
+
+    def close(self) :
+        self.closed = True
+
+
+class FakeSession :
+    #L : answers the Put, SearchInfo and Get calls of a RID like NCBI, the Get gives every query packed into the RID
+    def __init__(self, query_defs) :
+        self.query_defs = query_defs
+        self.puts = 0
+        self.gets = []
+
+    def post(self, url, data = None, timeout = None) :
+        self.puts += 1
+        return FakeResponse('    RID = NEWRID\n    RTOE = 0\n')
+
+    def get(self, url, params = None, timeout = None, stream = False) :
+        if params.get('FORMAT_OBJECT') == 'SearchInfo' : return FakeResponse('Status=READY')
+        self.gets.append((params['RID'], stream))
+        return FakeResponse(multi_query_xml(self.query_defs[params['RID']]))
+
+
+def backend(tmp_path, session) :
+    remote = RemoteBlastBackend(0, poll_interval=0, ledger_path=tmp_path / 'ledger.json', verbose=False)
+    remote.session = session
+    return remote
+
+
+def jobs(n) :
+    return [BlastJob(id=f'P{i}', sequence='MKVLAAGIVG' * (i + 1)) for i in range(n)]
+
+
+def test_reattach_splits_the_packed_output(tmp_path) :
+    packed = jobs(3)
+    first = backend(tmp_path, FakeSession({}))
+    first.ledger.record('RID1', packed, first.submission_params(packed[0]))
+
+    #L : a new run only wants the first job of the RID, the output still holds the three queries
+    session = FakeSession({'RID1' : [job.id for job in packed]})
+    results = dict(backend(tmp_path, session).search(packed[:1]))
+
+    assert list(results) == ['P0']
+    text = results['P0'].read()
+    assert text.count('<Iteration>') == 1
+    assert '<Iteration_query-def>P0</Iteration_query-def>' in text
+    assert session.gets == [('RID1', False)]
+    assert session.puts == 0
+
+
+def test_reattach_assigns_every_wanted_job(tmp_path) :
+    packed = jobs(3)
+    first = backend(tmp_path, FakeSession({}))
+    first.ledger.record('RID1', packed, first.submission_params(packed[0]))
+
+    session = FakeSession({'RID1' : ['P2', 'P0', 'P1']})
+    results = {job_id : handle.read() for job_id, handle in backend(tmp_path, session).search([packed[0], packed[2]])}
+
+    assert set(results) == {'P0', 'P2'}
+    for job_id, text in results.items() :
+        assert text.count('<Iteration>') == 1
+        assert f'<Iteration_query-def>{job_id}</Iteration_query-def>' in text
+
+
+def test_single_job_rid_is_streamed(tmp_path) :
+    session = FakeSession({'NEWRID' : ['P0']})
+    results = dict(backend(tmp_path, session).search(jobs(1)))
+
+    assert session.gets == [('NEWRID', True)]
+    text = ''.join(results['P0'])
+    assert text.count('<Iteration>') == 1
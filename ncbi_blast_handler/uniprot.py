@@ -1,15 +1,59 @@
-from config import WORKPLACE, TOOLS , display
+from config import UNIPROT_REST_URL, UNIPROT_CACHE_DIR, UNIPROT_DUMP, display
+from uniprot_cache import UniprotCache, SUMMARY_KIND
+from uniprot_index import UniprotDumpIndex, name_from_description
+from taxonomy import Taxonomy, RANKS, taxon_id_from
+from name_index import NameIndex
+from aftools_common.metrics import metrics
 import requests
 from concurrent.futures import as_completed, ThreadPoolExecutor
+import queue
 import re
+import threading
 from urllib3.util.retry import Retry
 from pathlib import Path
 from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
 import urllib3
+import socket
 import ssl
 
+#L : the accessions endpoint takes up to 1000 accessions, smaller batches keep every response quick
+BATCH_SIZE = 500
+BATCH_FIELDS = ['accession', 'protein_name', 'length', 'sequence', 'organism_id']
+LINEAGE_COLUMNS = ['id', 'taxon_id', 'organism'] + RANKS + ['lineage']
+DOMAIN_FILTERS = {'domain_containing' : ['domain', 'containing']}
+
+
+class KeepAliveAdapter(HTTPAdapter) : 
+    #L : HTTPAdapter takes no socket options, they go to the pool manager
+    def init_poolmanager(self, *args, **kwargs) : 
+        kwargs['socket_options'] = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        super().init_poolmanager(*args, **kwargs)
+
+
 class Uniprot : 
-    def create_session_with_retry(self):
+    def __init__(self, use_cache=True, cache_dir=UNIPROT_CACHE_DIR, ttl_days=30, cache_size=None, offline_dump=UNIPROT_DUMP):
+        #L : cache_size is in MB, the cache is shared by every tool pointing to the same folder
+        self.cache = UniprotCache(
+            cache_dir, 
+            ttl=ttl_days * 86400 if ttl_days else None, 
+            max_bytes=int(cache_size * 1e6) if cache_size else None
+        ) if use_cache else None
+
+        #L : with a local dump every lookup is served from it and we never go on the network
+        self.offline = None
+        if offline_dump:
+            dump = Path(offline_dump)
+            self.offline = UniprotDumpIndex(dump, Path(cache_dir) / 'dump_index' / dump.name)
+            display.info(f'Offline mode : {len(self.offline)} accessions from {dump}')
+
+        self.taxonomy = Taxonomy(self.cache, self.create_session_with_retry, offline=self.offline is not None)
+        self.cache_dir = Path(cache_dir)
+        self.names = None
+        #L : the ids we could not resolve and why, filled by every batch until the caller clears it
+        self.failures = {}
+
+    def create_session_with_retry(self, pool_size=10):
 
         session = requests.Session()
 
@@ -20,7 +64,8 @@ class Uniprot :
             allowed_methods=["HEAD", "GET", "OPTIONS"]
         )
 
-        adapter = HTTPAdapter(max_retries=retry_strategy)
+        #L : one session is shared by all the threads of a batch, the pool keeps a connection per thread alive
+        adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=pool_size, pool_maxsize=pool_size)
         session.mount("http://", adapter)
         session.mount("https://", adapter)
 
@@ -31,19 +76,27 @@ class Uniprot :
         return session
 
     def gets_taxonomic_id_robust(self, uniprot_id, session=None):
-        display.info(f'Getting {uniprot_id}')
+        if self.cache is not None:
+            data = self.cache.get(uniprot_id)
+            if data is not None: return uniprot_id, data
+
+        uniprot_id, data = self.fetches_entry_robust(uniprot_id, session)
+        if self.cache is not None and data: self.cache.put(uniprot_id, data)
+        return uniprot_id, data
 
+    @metrics.times('uniprot_fetch_entry')
+    def fetches_entry_robust(self, uniprot_id, session=None):
         if session is None:
             session = self.create_session_with_retry()
         
-        url = f"https://rest.uniprot.org/uniprotkb/{uniprot_id}.json"
+        url = f"{UNIPROT_REST_URL}/uniprotkb/{uniprot_id}.json"
         
         try:
             response = session.get(url, timeout=30)
             response.raise_for_status()
             return uniprot_id, response.json()
         except requests.exceptions.SSLError:
-            display.waring(f"SSL error for {uniprot_id}, trying without SSL verification...")
+            display.warning(f"SSL error for {uniprot_id}, trying without SSL verification...")
 
             try:
                 response = session.get(url, verify=False, timeout=30)
@@ -52,22 +105,23 @@ class Uniprot :
             except Exception as e:
                 display.warning(f"Still failed for {uniprot_id} without SSL: {e}")
                 
+                #L : a session of its own, the shared one is used by the other threads and must keep its adapters
                 try:
-                    import ssl
-                    session.mount('https://', HTTPAdapter(
-                        socket_options=[(ssl.SOL_SOCKET, ssl.SO_KEEPALIVE, 1)]
-                    ))
-                    response = session.get(url, timeout=30)
-                    response.raise_for_status()
-                    return uniprot_id, response.json()
+                    with requests.Session() as fallback:
+                        fallback.headers.update(session.headers)
+                        fallback.mount('https://', KeepAliveAdapter())
+                        response = fallback.get(url, timeout=30)
+                        response.raise_for_status()
+                        return uniprot_id, response.json()
                 except Exception as e2:
                     display.warning(f"Final attempt failed for {uniprot_id}: {e2}")
-                    return uniprot_id, None
+                    #L : the caller records why, so the failed ids say what went wrong instead of not found
+                    raise
 
     def gets_taxonomic_id(id) : #L : this is for proteins
         
         id = id.strip()
-        url = f"https://rest.uniprot.org/uniprotkb/{id}.json"
+        url = f"{UNIPROT_REST_URL}/uniprotkb/{id}.json"
         #print(url)
         response = requests.get(url)
         if response.ok : 
@@ -78,6 +132,173 @@ class Uniprot :
         return id, data
 
 
+    @metrics.times('uniprot_fetch_batch')
+    def gets_batch(self, ids, session=None, fields=BATCH_FIELDS):
+        #L : one request per batch with only the fields we parse, in json because the tsv protein names hold every alternative name
+        if session is None:
+            session = self.create_session_with_retry()
+
+        url = f"{UNIPROT_REST_URL}/uniprotkb/accessions"
+        params = {'accessions' : ','.join(ids), 'fields' : ','.join(fields), 'format' : 'json', 'size' : len(ids)}
+        entries = {}
+        while url:
+            response = session.get(url, params=params, timeout=60)
+            response.raise_for_status()
+            for result in response.json().get('results', []):
+                sequence = result.get('sequence', {})
+                entry = {
+                    'accession' : result.get('primaryAccession'),
+                    'protein_name' : name_from_description(result),
+                    'length' : sequence.get('length'),
+                    'sequence' : sequence.get('value'),
+                    'organism_id' : str(result.get('organism', {}).get('taxonId', ''))
+                }
+                entries[entry['accession']] = {field : entry[field] for field in fields if field in entry}
+            #L : the results are paginated, the next page comes with all its parameters in the Link header
+            url = response.links.get('next', {}).get('url')
+            params = None
+        return entries
+
+    def batch_gets_data(self, ids, fields=BATCH_FIELDS, workers=4, session=None, verbose=True):
+        ids = list(dict.fromkeys(ids))
+        if self.offline is not None:
+            results = self.offline.gets_many(ids)
+            if verbose: display.info(f'We have found {len(results)} of {len(ids)} entries in the local dump.')
+            return results
+
+        results = {}
+        if self.cache is not None:
+            cached = self.cache.get_many(ids, SUMMARY_KIND)
+            results = {id : entry for id, entry in cached.items() if all(field in entry for field in fields)}
+            if verbose: display.info(f'We have {len(results)} of {len(ids)} entries in the UniProt cache.')
+
+        to_fetch = [id for id in ids if id not in results]
+        batches = [to_fetch[i:i + BATCH_SIZE] for i in range(0, len(to_fetch), BATCH_SIZE)]
+        if session is None:
+            session = self.create_session_with_retry(pool_size=workers)
+        #L : the streamed batches report to the progress of streams_data, not to one of their own
+        progress = display.progress('UniProt entries', len(to_fetch)) if verbose and to_fetch else None
+
+        def tracked(function, *args):
+            if progress is None: return function(*args)
+            with progress.tracks(): return function(*args)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(tracked, self.gets_batch, batch, session, fields) : batch for batch in batches}
+            for future in as_completed(futures):
+                try:
+                    entries = future.result()
+                except Exception as e:
+                    display.warning(f"Batch of {len(futures[future])} ids failed, we will fetch them one by one: {e}")
+                    continue
+                fetched = {id : entries[id] for id in futures[future] if id in entries}
+                results.update(fetched)
+                if self.cache is not None: self.cache.put_many(fetched, SUMMARY_KIND, merge=True)
+                if progress is not None: progress.advance('fetched', len(fetched))
+
+        #L : secondary or merged accessions come back under their primary accession, those go through the json entry
+        missing = [id for id in ids if id not in results]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(tracked, self.gets_taxonomic_id_robust, id, session) : id for id in missing}
+            for future in as_completed(futures):
+                id = futures[future]
+                try:
+                    _, data = future.result()
+                    found = self.gets_name_and_sequence_from_data(id, data)
+                except Exception as e:
+                    display.warning(f"We could not fetch {id}: {e}")
+                    self.failures[id] = str(e)
+                    if progress is not None: progress.advance('failed')
+                    continue
+                if found is None:
+                    self.failures[id] = 'not found on UniProt'
+                    if progress is not None: progress.advance('failed')
+                    continue
+                if progress is not None: progress.advance('fetched one by one')
+                _, name, length, sequence = found
+                taxon = str(data.get('organism', {}).get('taxonId', ''))
+                results[id] = {'accession' : id, 'protein_name' : name, 'length' : length, 'sequence' : sequence, 'organism_id' : taxon}
+                if self.cache is not None: self.cache.put(id, results[id], SUMMARY_KIND, merge=True)
+        if progress is not None: progress.close()
+        return {id : results[id] for id in ids if id in results}
+
+    def extracts_name_and_sequence(self, id, entry):
+        length = int(entry['length']) if entry.get('length') not in [None, ''] else None
+        return id, entry.get('protein_name') or '', length, entry.get('sequence') or None
+
+    def batch_gets_name_and_sequence_data(self, ids, workers=4):
+        entries = self.batch_gets_data(ids, workers=workers)
+        return {id : self.extracts_name_and_sequence(id, entry) for id, entry in entries.items()}
+
+    def reads_ids(self, ids_path):
+        with open(ids_path, 'r') as ids_file:
+            for line in ids_file:
+                id = line.split(':')[0].strip()
+                if id and not id.startswith('#'): yield id
+
+    def streams_data(self, ids, fields=BATCH_FIELDS, workers=4, queue_size=8):
+        #L : fetch -> extract -> write, the bounded queues keep at most a few batches in memory whatever the number of ids
+        batches = queue.Queue(maxsize=workers)
+        results = queue.Queue(maxsize=queue_size)
+        session = self.create_session_with_retry(pool_size=workers)
+
+        #L : an error while reading the ids is kept here and raised again by the consumer, the end markers are queued anyway
+        errors = []
+
+        def feeds():
+            #L : an id repeated anywhere in the input is only fetched and yielded once
+            seen = set()
+            batch = []
+            try:
+                for id in ids:
+                    if id in seen: continue
+                    seen.add(id)
+                    batch.append(id)
+                    if len(batch) == BATCH_SIZE:
+                        batches.put(batch)
+                        batch = []
+                if batch: batches.put(batch)
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                for _ in range(workers): batches.put(None)
+
+        def fetches():
+            while True:
+                batch = batches.get()
+                if batch is None: break
+                try:
+                    with progress.tracks():
+                        entries = self.batch_gets_data(batch, fields, workers=1, session=session, verbose=False)
+                    progress.advance('found', len(entries))
+                    progress.advance('failed', len(batch) - len(entries))
+                    results.put(entries)
+                except Exception as e:
+                    progress.advance('failed', len(batch))
+                    display.warning(f"Batch of {len(batch)} ids failed: {e}")
+                    results.put({})
+            results.put(None)
+
+        #L : the ids come from a generator, so there is no total and no ETA, only counts and throughput
+        progress = display.progress('UniProt entries')
+
+        threads = [threading.Thread(target=feeds, daemon=True)] + [threading.Thread(target=fetches, daemon=True) for _ in range(workers)]
+        for thread in threads: thread.start()
+
+        finished = 0
+        with progress:
+            while finished < workers:
+                entries = results.get()
+                if entries is None:
+                    finished += 1
+                    continue
+                yield from entries.items()
+        if errors: raise errors[0]
+
+    def streams_name_and_sequence(self, ids, workers=4, queue_size=8):
+        for id, entry in self.streams_data(ids, BATCH_FIELDS, workers, queue_size):
+            yield self.extracts_name_and_sequence(id, entry)
+
     def gets_name_from_data(self, id, data):
         if not data:
             return None
@@ -102,33 +323,11 @@ class Uniprot :
         return id, name
 
     def batch_gets_name(self, ids_path, names_path) : 
-        ids = []
-        all_data = {}
-        store = {}
-
-        with open(ids_path, 'r') as ids_file : 
-            lines = ids_file.readlines()
-            for id in lines : 
-                id = id.strip()
-                if not id.startswith('#') : ids.append(id)
-
-        with ThreadPoolExecutor() as executor : 
-            futures = {executor.submit(self.gets_taxonomic_id_robust, id) for id in ids}
-            for future in as_completed(futures) : 
-                id, data = future.result()
-                all_data[id] = data
-
-        with ThreadPoolExecutor() as executor : 
-            futures = {executor.submit(self.gets_name_from_data, id, data) for id, data in all_data.items()}
-
-            for future in as_completed(futures) : 
-                if not future.result() == None  : id, f = future.result() 
-                store[id] = f
-
-        with open(names_path, 'w') as names_path : 
-            for id, f in store.items() : 
-                string = f'{id} : {f}\n'
-                names_path.write(string)
+        #L : line buffered, every name is on disk as soon as its batch arrives
+        with open(names_path, 'w', buffering=1) as names_file : 
+            for id, entry in self.streams_data(self.reads_ids(ids_path), fields=['accession', 'protein_name']) : 
+                f = entry.get('protein_name') or ''
+                names_file.write(f'{id} : {f}\n')
 
     def gets_name_and_sequence_from_data(self, id, data):
         if not data:
@@ -164,78 +363,89 @@ class Uniprot :
 
         return id, name, length, sequence
 
-    def batch_gets_name_and_sequence(self, ids_path, names_path) : 
-        ids = []
-        all_data = {}
-        lengths = {}
-        store = {}
-        sequences = {}
-
-        with open(ids_path, 'r') as ids_file : 
-            lines = ids_file.readlines()
-            for id in lines : 
-                id = id.split(':')[0].strip()
-                if not id.startswith('#') : ids.append(id)
-
-
-        with ThreadPoolExecutor() as executor : 
-            futures = {executor.submit(self.gets_taxonomic_id_robust, id) for id in ids}
-            for future in as_completed(futures) : 
-                id, data = future.result()
-                all_data[id] = data
-                
-
-        with ThreadPoolExecutor() as executor : 
-            futures = {executor.submit(self.gets_name_and_sequence_from_data, id, data) for id, data in all_data.items()}
-
-            for future in as_completed(futures) : 
-                if not future.result() == None  : id, f, l, s = future.result() 
-                store[id] = f
-                lengths[id] = l
-                sequences[id] = s
-
-        with open(names_path, 'w') as names_path : 
-            for id, f in store.items() : 
-                if id in lengths : 
-                    l = lengths[id]
-                    string = f'{id} : {f} : {l}\n'
-                    names_path.write(string)
-        return sequences
+    def batch_gets_lineages(self, ids) : 
+        entries = self.batch_gets_data(ids)
+        taxa = {id : taxon_id_from(entry.get('organism_id')) for id, entry in entries.items()}
+        columns = self.taxonomy.resolves(taxa.values())
+        return {id : self.lineage_row(id, taxon, columns) for id, taxon in taxa.items()}
 
+    def lineage_row(self, id, taxon, columns) : 
+        row = {'id' : id, 'taxon_id' : taxon or ''}
+        row.update(columns.get(taxon, {}))
+        return [str(row.get(column, '')) for column in LINEAGE_COLUMNS]
 
-    def looks_at_names() : 
-        with open(names_path, 'r') as names : 
-            lines = names.readlines()
-        
-        filtered = []
-
-        for line in lines : 
-            if len(line.split(':')) > 1 : name = line.split(':')[1].strip()
-            # if 'Uncharacterized' in name or 'S-layer' in name : 
-            #     filtered.append(line)
+    def writes_lineages(self, pending, lineages_file) : 
+        columns = self.taxonomy.resolves(taxon for _, taxon in pending)
+        for id, taxon in pending : 
+            lineages_file.write('\t'.join(self.lineage_row(id, taxon, columns)) + '\n')
 
-            if 'containing' in name or 'Domain' in name or 'Containing' in name or 'domain' in name : 
-                filtered.append(line)
-        
-        print(len(filtered))
-        
+    def batch_gets_name_and_sequence(self, ids_path, names_path, keep_sequences=False, lineages=False) : 
+        #L : by default nothing but the current batches stays in memory and we only return the count, keep_sequences=True returns every sequence
+        sequences = {}
+        count = 0
+        lineages_path = Path(names_path).with_name('lineages.tsv')
+        lineages_file = open(lineages_path, 'w') if lineages else None
+        pending = []
+
+        try : 
+            with open(names_path, 'w', buffering=1) as names_file : 
+                if lineages : lineages_file.write('\t'.join(LINEAGE_COLUMNS) + '\n')
+                for id, entry in self.streams_data(self.reads_ids(ids_path)) : 
+                    id, f, l, s = self.extracts_name_and_sequence(id, entry)
+                    names_file.write(f'{id} : {f} : {l}\n')
+                    count += 1
+                    if keep_sequences : sequences[id] = s
+                    #L : lineages go out per batch, the taxa already seen are answered from memory
+                    if lineages : 
+                        pending.append((id, taxon_id_from(entry.get('organism_id'))))
+                        if len(pending) >= BATCH_SIZE : 
+                            self.writes_lineages(pending, lineages_file)
+                            pending = []
+                if lineages and pending : self.writes_lineages(pending, lineages_file)
+        finally : 
+            if lineages_file is not None : lineages_file.close()
+        if lineages : 
+            display.info(f'We have written the lineages of {count} proteins to {lineages_path} ({len(self.taxonomy.lineages)} taxa, {self.taxonomy.requests} taxonomy requests).')
+            if self.taxonomy.unknown : 
+                display.warning(f'We are offline and {len(self.taxonomy.unknown)} taxa are not in the cache, their lineages are partial.')
+        return sequences if keep_sequences else count
+
+
+    def name_index(self, names_paths=()) : 
+        #L : one index per cache folder, kept up to date with the names files we give it and with the entries cached since its last refresh
+        if self.names is None : 
+            self.names = NameIndex(self.cache_dir / 'name_index')
+        return self.names.refresh(names_paths, self.cache)
+
+    def looks_at_names(self, names_path, filtered_path, filters=DOMAIN_FILTERS) : 
+        index = self.name_index([names_path])
+        matches = index.search(filters, source=names_path)
+        for label, ids in matches.items() : 
+            display.info(f'We have {len(ids)} names matching {label}.')
+
+        filtered = set().union(*matches.values())
         with open(filtered_path, 'w') as file : 
-            for f in filtered : 
-                file.write(f)
-
+            for id in sorted(filtered, key=index.positions.get) : 
+                file.write(index.line(id) + '\n')
+        return matches
 
-            
 
 if __name__ == '__main__' : 
+    from argparse import ArgumentParser
+    from config import WORKPLACE
+
+    parser = ArgumentParser('Script for fetching the names and sequences of the UniProt ids in ids.txt and filtering their names')
+    parser.add_argument('-l', '--lineages', action='store_true', default=False, help='Also write the taxonomy lineage of every protein to lineages.tsv next to names.txt')
+    args = parser.parse_args()
+
     names_path = Path(WORKPLACE) / 'names.txt'
     ids_path = Path(WORKPLACE) / 'ids.txt'
     filtered_path = Path(WORKPLACE) / 'domain_containing.txt'
 
     uniprot = Uniprot()
 
-    sequences = uniprot.batch_gets_name_and_sequence(ids_path, names_path)
-    ids_path = Path(WORKPLACE) / 'domain_containing.txt'
-    uniprot.looks_at_names()
+    uniprot.batch_gets_name_and_sequence(ids_path, names_path, lineages=args.lineages)
+    uniprot.looks_at_names(names_path, filtered_path)
     
 
 
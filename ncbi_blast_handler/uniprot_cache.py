@@ -0,0 +1,142 @@
+from config import display
+
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+
+#L : sqlite refuses more than 999 parameters in one statement on older builds
+CHUNK = 900
+#L : the size limit is checked again once this many bytes were written, not on every put
+EVICT_EVERY = 4 * 1024 * 1024
+#L : the entry summaries of the batch requests, the summaries of the former tsv layout kept the alternative names and are not read anymore
+SUMMARY_KIND = 'summary.v2'
+
+
+class UniprotCache :
+    def __init__(self, cache_dir, ttl : Optional[float] = 30 * 86400, max_bytes : Optional[int] = None) :
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.written = 0
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(self.cache_dir / 'uniprot.sqlite', check_same_thread=False)
+        self.db.executescript('''
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS entries (accession TEXT, kind TEXT, payload BLOB, size INTEGER, fetched REAL, last_used REAL,
+                                                PRIMARY KEY (accession, kind));
+            CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+            CREATE INDEX IF NOT EXISTS entries_fetched ON entries (fetched);
+        ''')
+        self.db.commit()
+        #L : expired entries and the overflow of a previous run go once when the cache is opened
+        self.evict()
+
+    def is_fresh(self, fetched) :
+        return self.ttl is None or time.time() - fetched <= self.ttl
+
+    def get_many(self, accessions : Iterable[str], kind : str = 'entry') -> Dict[str, dict] :
+        accessions = list(dict.fromkeys(accessions))
+        found = {}
+        with self.lock :
+            for i in range(0, len(accessions), CHUNK) :
+                chunk = accessions[i:i + CHUNK]
+                rows = self.db.execute(
+                    f"SELECT accession, payload, fetched FROM entries WHERE kind = ? AND accession IN ({','.join('?' * len(chunk))})",
+                    [kind] + chunk
+                ).fetchall()
+                for accession, payload, fetched in rows :
+                    if self.is_fresh(fetched) : found[accession] = json.loads(zlib.decompress(payload))
+
+            now = time.time()
+            self.db.executemany('UPDATE entries SET last_used = ? WHERE accession = ? AND kind = ?', [(now, accession, kind) for accession in found])
+            self.db.commit()
+        self.hits += len(found)
+        self.misses += len(accessions) - len(found)
+        return found
+
+    def iter_since(self, kind : str = 'entry', since : float = 0) -> Iterator[Tuple[str, dict, float]] :
+        #L : everything stored after a given time, for the indexes built on top of the cache, read CHUNK rows at a time so a large cache never sits in memory
+        last = None
+        while True :
+            with self.lock :
+                if last is None :
+                    rows = self.db.execute('SELECT accession, payload, fetched FROM entries WHERE kind = ? AND fetched > ? ORDER BY fetched, accession LIMIT ?', (kind, since, CHUNK)).fetchall()
+                else :
+                    rows = self.db.execute(
+                        'SELECT accession, payload, fetched FROM entries WHERE kind = ? AND (fetched > ? OR (fetched = ? AND accession > ?)) ORDER BY fetched, accession LIMIT ?',
+                        (kind, last[0], last[0], last[1], CHUNK)
+                    ).fetchall()
+            for accession, payload, fetched in rows :
+                yield accession, json.loads(zlib.decompress(payload)), fetched
+            if len(rows) < CHUNK : return
+            last = (rows[-1][2], rows[-1][0])
+
+    def get(self, accession : str, kind : str = 'entry') -> Optional[dict] :
+        return self.get_many([accession], kind).get(accession)
+
+    def put_many(self, entries : Dict[str, dict], kind : str = 'entry', merge : bool = False) :
+        #L : with merge the fields already stored for an accession are kept, so a few fields fetched alone do not replace a full entry
+        entries = {accession : data for accession, data in entries.items() if data is not None}
+        if not entries : return
+        now = time.time()
+        with self.lock :
+            if merge :
+                accessions = list(entries)
+                for i in range(0, len(accessions), CHUNK) :
+                    chunk = accessions[i:i + CHUNK]
+                    rows = self.db.execute(
+                        f"SELECT accession, payload, fetched FROM entries WHERE kind = ? AND accession IN ({','.join('?' * len(chunk))})",
+                        [kind] + chunk
+                    ).fetchall()
+                    for accession, payload, fetched in rows :
+                        if self.is_fresh(fetched) : entries[accession] = {**json.loads(zlib.decompress(payload)), **entries[accession]}
+            rows = []
+            for accession, data in entries.items() :
+                payload = zlib.compress(json.dumps(data, separators=(',', ':')).encode())
+                rows.append((accession, kind, payload, len(payload), now, now))
+            self.db.executemany('INSERT OR REPLACE INTO entries (accession, kind, payload, size, fetched, last_used) VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self.db.commit()
+            self.written += sum(row[3] for row in rows)
+            due = self.max_bytes is not None and self.written >= min(EVICT_EVERY, max(self.max_bytes // 10, 1))
+        if due : self.evict()
+
+    def put(self, accession : str, data : dict, kind : str = 'entry', merge : bool = False) :
+        self.put_many({accession : data}, kind, merge)
+
+    def total_bytes(self) :
+        return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def evict(self) :
+        #L : expired entries go first, then the least recently used ones until we are under the size limit
+        with self.lock :
+            self.written = 0
+            removed = 0
+            if self.ttl is not None :
+                removed += self.db.execute('DELETE FROM entries WHERE fetched < ?', (time.time() - self.ttl,)).rowcount
+            if self.max_bytes is not None :
+                total = self.total_bytes()
+                if total > self.max_bytes :
+                    #L : row by row in LRU order, entries stored in one batch share their last_used and must not all go at once
+                    rowids, kept = [], total
+                    for rowid, size in self.db.execute('SELECT rowid, size FROM entries ORDER BY last_used, rowid') :
+                        if kept <= self.max_bytes : break
+                        kept -= size
+                        rowids.append(rowid)
+                    for i in range(0, len(rowids), CHUNK) :
+                        chunk = rowids[i:i + CHUNK]
+                        removed += self.db.execute(f"DELETE FROM entries WHERE rowid IN ({','.join('?' * len(chunk))})", chunk).rowcount
+            self.db.commit()
+        if removed : display.info(f'We have evicted {removed} UniProt entries from the cache.')
+
+    def stats(self) :
+        entries, size = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return {'hits' : self.hits, 'misses' : self.misses, 'entries' : entries, 'bytes' : size}
@@ -0,0 +1,194 @@
+from config import display
+
+from array import array
+from pathlib import Path
+from typing import Dict, List
+import json
+import mmap
+import os
+import re
+import numpy as np
+
+
+FORMATS = {
+    '.fasta' : 'fasta', '.fa' : 'fasta', '.faa' : 'fasta',
+    '.dat' : 'flat', '.txt' : 'flat',
+    '.jsonl' : 'jsonl', '.ndjson' : 'jsonl'
+}
+JSON_HINT = 'A UniProt .json download is one {"results" : [...]} document, please download the dump with format=jsonl (one entry per line) instead.'
+WIDTH = 16
+EVIDENCE = re.compile(r'\s*\{[^}]*\}')
+FASTA_TAXON = re.compile(r'\sOX=(\d+)')
+FASTA_HEADER = re.compile(r'^>(?:\w+\|)?([^|\s]+)(?:\|\S+)?\s*(.*?)(?:\s+OS=.*)?$')
+
+
+def dump_format(dump_path) :
+    path = Path(dump_path)
+    if path.suffix == '.gz' :
+        raise ValueError(f'{path.name} is compressed, please decompress it once so that it can be memory mapped.')
+    if path.suffix == '.json' :
+        raise ValueError(f'{path.name} : {JSON_HINT}')
+    if path.suffix not in FORMATS :
+        raise ValueError(f"We do not know the format of {path.name}, we read {', '.join(FORMATS)}")
+    return FORMATS[path.suffix]
+
+
+def scan_fasta(handle) :
+    offset, start, accessions = 0, None, []
+    for line in handle :
+        if line.startswith(b'>') :
+            if start is not None : yield accessions, start, offset - start
+            match = FASTA_HEADER.match(line.decode(errors='replace').rstrip())
+            start, accessions = offset, [match.group(1)] if match else []
+        offset += len(line)
+    if start is not None : yield accessions, start, offset - start
+
+
+def scan_flat(handle) :
+    offset, start, accessions = 0, None, []
+    for line in handle :
+        if line.startswith(b'ID   ') :
+            start, accessions = offset, []
+        elif line.startswith(b'AC   ') :
+            accessions += [ac.strip() for ac in line[5:].decode().split(';') if ac.strip()]
+        offset += len(line)
+        if line.startswith(b'//') and start is not None :
+            yield accessions, start, offset - start
+            start = None
+
+
+def scan_jsonl(handle) :
+    offset = 0
+    for line in handle :
+        if line.strip() :
+            entry = json.loads(line)
+            if 'primaryAccession' not in entry and 'results' in entry : raise ValueError(JSON_HINT)
+            yield [entry.get('primaryAccession')] + entry.get('secondaryAccessions', []), offset, len(line)
+        offset += len(line)
+
+
+def parse_fasta(record : bytes) :
+    lines = record.decode().splitlines()
+    match = FASTA_HEADER.match(lines[0])
+    sequence = ''.join(line.strip() for line in lines[1:])
+    taxon = FASTA_TAXON.search(lines[0])
+    return {'protein_name' : match.group(2) if match else '', 'length' : len(sequence), 'sequence' : sequence,
+            'organism_id' : taxon.group(1) if taxon else ''}
+
+
+def parse_flat(record : bytes) :
+    name, submitted, length, sequence, taxon = None, None, None, [], ''
+
+    in_sequence = False
+    for line in record.decode().splitlines() :
+        if in_sequence :
+            if line.startswith('//') : break
+            sequence.append(line.replace(' ', ''))
+        elif line.startswith('DE   RecName: Full=') and name is None :
+            name = EVIDENCE.sub('', line[len('DE   RecName: Full='):]).rstrip(';')
+        elif line.startswith('DE   SubName: Full=') and submitted is None :
+            submitted = EVIDENCE.sub('', line[len('DE   SubName: Full='):]).rstrip(';')
+        elif line.startswith('OX   NCBI_TaxID=') and not taxon :
+            taxon = EVIDENCE.sub('', line[len('OX   NCBI_TaxID='):]).rstrip(';').strip()
+        elif line.startswith('SQ   ') :
+            length = int(line.split()[2])
+            in_sequence = True
+    return {'protein_name' : name or submitted or '', 'length' : length, 'sequence' : ''.join(sequence), 'organism_id' : taxon}
+
+
+def name_from_description(entry : dict) -> str :
+    #L : the recommended full name, or the first submitted one, the same name whether the entry comes from a batch, a single entry or a dump
+    description = entry.get('proteinDescription', {})
+    names = [description.get('recommendedName', {})] + description.get('submissionNames', [{}])
+    return next((n['fullName']['value'] for n in names if 'value' in n.get('fullName', {})), '')
+
+
+def parse_jsonl(record : bytes) :
+    entry = json.loads(record)
+    sequence = entry.get('sequence', {})
+    return {'protein_name' : name_from_description(entry), 'length' : sequence.get('length'), 'sequence' : sequence.get('value'),
+            'organism_id' : str(entry.get('organism', {}).get('taxonId', ''))}
+
+
+SCANNERS = {'fasta' : scan_fasta, 'flat' : scan_flat, 'jsonl' : scan_jsonl}
+PARSERS = {'fasta' : parse_fasta, 'flat' : parse_flat, 'jsonl' : parse_jsonl}
+
+
+class UniprotDumpIndex :
+    def __init__(self, dump_path, index_dir) :
+        self.dump_path = Path(dump_path)
+        self.format = dump_format(self.dump_path)
+        self.index_dir = Path(index_dir)
+        if not self.is_current() : self.build()
+
+        #L : the index and the dump are memory mapped, only the pages we look at are read from disk
+        self.accessions = np.load(self.index_dir / 'accessions.npy', mmap_mode='r')
+        self.offsets = np.load(self.index_dir / 'offsets.npy', mmap_mode='r')
+        self.sizes = np.load(self.index_dir / 'sizes.npy', mmap_mode='r')
+        #L : an empty file cannot be memory mapped, an empty dump has an empty index and nothing to read
+        self.dump = b''
+        if self.dump_path.stat().st_size :
+            with open(self.dump_path, 'rb') as dump :
+                self.dump = mmap.mmap(dump.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) :
+        return len(self.accessions)
+
+    def is_current(self) :
+        meta_path = self.index_dir / 'meta.json'
+        if not meta_path.exists() : return False
+        with open(meta_path, 'r') as meta_file :
+            meta = json.load(meta_file)
+        stat = self.dump_path.stat()
+        return meta.get('size') == stat.st_size and meta.get('mtime') == stat.st_mtime_ns and meta.get('format') == self.format
+
+    def build(self) :
+        display.info(f'Building the accession index of {self.dump_path}, this is only done once per dump.')
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        stat = self.dump_path.stat()
+
+        #L : primary accessions come first so that they win over a secondary accession shared by a merged entry
+        primary, secondary = ([], array('q'), array('q')), ([], array('q'), array('q'))
+        with open(self.dump_path, 'rb') as dump :
+            for accessions, offset, size in SCANNERS[self.format](dump) :
+                for i, accession in enumerate(accessions) :
+                    if not accession or len(accession) > WIDTH : continue
+                    target = primary if i == 0 else secondary
+                    target[0].append(accession)
+                    target[1].append(offset)
+                    target[2].append(size)
+
+        accessions = np.array(primary[0] + secondary[0], dtype=f'S{WIDTH}')
+        offsets = np.concatenate([np.frombuffer(primary[1], dtype=np.int64), np.frombuffer(secondary[1], dtype=np.int64)])
+        sizes = np.concatenate([np.frombuffer(primary[2], dtype=np.int64), np.frombuffer(secondary[2], dtype=np.int64)])
+        order = np.argsort(accessions, kind='stable')
+
+        for name, values in [('accessions', accessions[order]), ('offsets', offsets[order]), ('sizes', sizes[order])] :
+            tmp_path = self.index_dir / f'.{name}.tmp.npy'
+            np.save(tmp_path, values)
+            os.replace(tmp_path, self.index_dir / f'{name}.npy')
+        with open(self.index_dir / 'meta.json', 'w') as meta_file :
+            json.dump({'dump' : str(self.dump_path), 'size' : stat.st_size, 'mtime' : stat.st_mtime_ns, 'format' : self.format}, meta_file)
+        display.info(f'We have indexed {len(accessions)} accessions ({len(primary[0])} entries) of {self.dump_path.name}.')
+
+    def locate(self, ids : List[str]) :
+        #L : one vectorised binary search for the whole list, -1 when the accession is not in the dump
+        if len(self.accessions) == 0 : return np.full(len(ids), -1, dtype=np.int64)
+        keys = np.array([id.encode() if len(id) <= WIDTH else b'' for id in ids], dtype=f'S{WIDTH}')
+        positions = np.minimum(np.searchsorted(self.accessions, keys), len(self.accessions) - 1)
+        found = (self.accessions[positions] == keys) & (keys != b'')
+        return np.where(found, positions, -1)
+
+    def record(self, position : int) -> bytes :
+        offset, size = int(self.offsets[position]), int(self.sizes[position])
+        return self.dump[offset:offset + size]
+
+    def gets_many(self, ids : List[str]) -> Dict[str, dict] :
+        entries = {}
+        parse = PARSERS[self.format]
+        for id, position in zip(ids, self.locate(ids)) :
+            if position < 0 : continue
+            entry = parse(self.record(position))
+            entry['accession'] = id
+            entries[id] = entry
+        return entries
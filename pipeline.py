@@ -0,0 +1,308 @@
+from pathlib import Path
+import sys
+
+ROOT = Path(__file__).resolve().parent
+#L : the two tools are not installed packages, the pipeline imports them the way their own scripts do
+for path in [ROOT / 'ncbi_blast_handler', ROOT / 'interpro_batch_analyzer'] :
+    if str(path) not in sys.path : sys.path.insert(0, str(path))
+
+from config import display
+from src.job_log import runs_bounded
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import ast
+import json
+import os
+import queue
+import threading
+import time
+
+
+END = None
+MAX_ATTEMPTS = 3
+
+
+class Checkpoint :
+    #L : one append-only TSV per stage, a line is written once an item went through the stage and a restarted pipeline skips it
+    def __init__(self, path) :
+        self.path = Path(path)
+        self.done = {}
+        torn = False
+        if self.path.exists() :
+            with open(self.path, 'r') as checkpoint :
+                for line in checkpoint :
+                    #L : a line cut by an interruption has no line break, the item goes through the stage again
+                    torn = not line.endswith('\n')
+                    fields = line.rstrip('\n').split('\t')
+                    if fields[0] and not torn : self.done[fields[0]] = fields[1:]
+        self.file = open(self.path, 'a', buffering=1)
+        if torn : self.file.write('\n')
+        self.lock = threading.Lock()
+
+    def __contains__(self, id) :
+        return id in self.done
+
+    def __len__(self) :
+        return len(self.done)
+
+    def records(self) :
+        return list(self.done.items())
+
+    def writes(self, id : str, *fields) :
+        with self.lock :
+            self.done[id] = [str(field) for field in fields]
+            self.file.write('\t'.join([id] + self.done[id]) + '\n')
+
+    def close(self) :
+        self.file.close()
+
+
+class Stage :
+    #L : workers take batches from a bounded inbox and fill the bounded inbox of the next stage, a full queue holds the stage before it back instead of filling memory
+    def __init__(self, name : str, handles, inbox : queue.Queue, outbox : queue.Queue = None, workers : int = 1, batch_size : int = 1, linger : float = 2.0) :
+        self.name = name
+        self.handles = handles
+        self.inbox = inbox
+        self.outbox = outbox
+        self.batch_size = batch_size
+        self.linger = linger
+        self.remaining = workers
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.runs, name=f'{name}-{i}', daemon=True) for i in range(workers)]
+
+    def start(self) :
+        for thread in self.threads : thread.start()
+        return self
+
+    def join(self) :
+        for thread in self.threads : thread.join()
+
+    def collects(self) :
+        #L : waits for a first item, then takes what comes within linger seconds up to batch_size, so that a slow trickle still moves on
+        batch = []
+        item = self.inbox.get()
+        deadline = time.time() + self.linger
+        while item is not END :
+            batch.append(item)
+            if len(batch) >= self.batch_size : return batch, False
+            try :
+                item = self.inbox.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty :
+                return batch, False
+        #L : the end mark goes back in the queue for the other workers of the stage
+        self.inbox.put(END)
+        return batch, True
+
+    def runs(self) :
+        try :
+            finished = False
+            while not finished :
+                batch, finished = self.collects()
+                if not batch : continue
+                try :
+                    outputs = self.handles(batch)
+                except Exception as e :
+                    #L : the batch is not checkpointed, the next run takes it again
+                    display.error(f'The {self.name} stage failed on a batch of {len(batch)} : {e}')
+                    continue
+                if self.outbox is not None :
+                    for output in outputs : self.outbox.put(output)
+        finally :
+            with self.lock :
+                self.remaining -= 1
+                last = self.remaining == 0
+            if last and self.outbox is not None : self.outbox.put(END)
+
+
+class Pipeline :
+    def __init__(self, args) :
+        from config import BLAST_RESULTS_DIR, WORKPLACE
+        from src.config import INTERPRO_RESULTS_DIR
+        from src.interpro_analysis import InterproAnalyzer, AnalysisConfig
+        from src.interpro_client import InterproClient, ClientConfig
+        from uniprot import Uniprot
+
+        self.args = args
+        self.workplace = Path(WORKPLACE)
+        self.results_dir = Path(BLAST_RESULTS_DIR)
+        self.results_dir.mkdir(parents=True, exist_ok=True)
+        checkpoint_dir = self.workplace / 'pipeline'
+        checkpoint_dir.mkdir(exist_ok=True)
+
+        self.client = InterproClient(ClientConfig(batch_size=100, results_dir=Path(INTERPRO_RESULTS_DIR), workplace=self.workplace, memory_budget=args.memory_budget))
+        self.analyzer = InterproAnalyzer(AnalysisConfig(results_dir=Path(INTERPRO_RESULTS_DIR), workplace=self.workplace, keywords=args.keywords, memory_budget=args.memory_budget))
+        self.uniprot = Uniprot()
+        self.session = self.uniprot.create_session_with_retry(pool_size=args.uniprot_workers)
+        self.options = {'hitlist_size' : args.hitlist_size, 'expect' : args.expect, 'format_type' : args.format}
+        self.local = threading.local()
+
+        #L : interpro.tsv holds title, keywords found and sequence, uniprot.tsv id, source and sequence, blast.tsv the ids with a result
+        self.interpro_done = Checkpoint(checkpoint_dir / 'interpro.tsv')
+        self.uniprot_done = Checkpoint(checkpoint_dir / 'uniprot.tsv')
+        self.blast_done = Checkpoint(checkpoint_dir / 'blast.tsv')
+        self.names_file = open(self.workplace / 'names.txt', 'a', buffering=1)
+        self.names_lock = threading.Lock()
+
+        self.to_uniprot = queue.Queue(maxsize=args.queue_size)
+        self.to_blast = queue.Queue(maxsize=args.queue_size)
+        self.progress = display.progress('Pipeline')
+        self.counted = set()
+
+    def analyses(self, job) :
+        path = self.client.results_dir / f'{job.title}.json'
+        try :
+            if not path.exists() :
+                data = self.client.gets_data_json(job.id)
+                if not data : return None
+                tmp_path = path.with_name(f'.{path.name}.tmp')
+                with open(tmp_path, 'w') as file : json.dump(data, file, indent=2)
+                os.replace(tmp_path, path)
+            analysis = self.analyzer.find_keywords(f'{job.title}.json')
+        except Exception as e :
+            display.warning(f'We could not analyse {job.title} : {e}')
+            return None
+        return [keyword for keyword, found in analysis.items() if found is True]
+
+    def resumes(self) :
+        #L : what a previous run left between two stages goes through again before anything new
+        for title, (keywords, sequence) in self.interpro_done.records() :
+            self.counted.add(title)
+            if not keywords : self.progress.advance('without keywords', resumed=True)
+            elif title in self.blast_done : self.progress.advance('blasted', resumed=True)
+            elif title not in self.uniprot_done : self.to_uniprot.put((title, sequence))
+        for id, (source, sequence) in self.uniprot_done.records() :
+            if id not in self.blast_done : self.to_blast.put((id, sequence))
+
+    def polls_interpro(self) :
+        #L : every finished job is downloaded and analysed as soon as a poll sees it, the proteins with a keyword go on to UniProt right away
+        attempts = 0
+        with ThreadPoolExecutor(max_workers=self.args.interpro_workers) as executor :
+            while True :
+                self.client.refresh()
+                log = self.client.job_log.current()
+                self.progress.total = len(log)
+                pending = [job for job in log if job.status in ['RUNNING', 'QUEUED']]
+                finished = [(job,) for job in log if job.status == 'FINISHED' and job.title not in self.interpro_done]
+                for job in log :
+                    if job.status in ['FAILED', 'ERROR', 'NOT_FOUND'] and job.title not in self.counted :
+                        self.counted.add(job.title)
+                        self.progress.advance('failed on InterPro', resumed=True)
+
+                missed = 0
+                for (job,), keywords in runs_bounded(executor, self.analyses, finished) :
+                    if keywords is None :
+                        missed += 1
+                        continue
+                    sequence = log.gets_sequence(job) if keywords else ''
+                    self.interpro_done.writes(job.title, ','.join(keywords), sequence)
+                    self.counted.add(job.title)
+                    if keywords :
+                        self.progress.advance('with keywords', final=False)
+                        self.to_uniprot.put((job.title, sequence))
+                    else :
+                        self.progress.advance('without keywords')
+
+                attempts = attempts + 1 if not pending and missed else 0
+                if not pending and (not missed or attempts >= MAX_ATTEMPTS) : break
+                time.sleep(self.args.poll_interval)
+        if missed : display.warning(f'{missed} finished InterPro jobs could not be downloaded, the next run will try them again.')
+
+    def resolves(self, batch) :
+        entries = self.uniprot.batch_gets_data([id for id, _ in batch], workers=1, session=self.session, verbose=False)
+        outputs = []
+        for id, interpro_sequence in batch :
+            entry = entries.get(id)
+            if entry and entry.get('sequence') :
+                _, name, length, sequence = self.uniprot.extracts_name_and_sequence(id, entry)
+                with self.names_lock : self.names_file.write(f'{id} : {name} : {length}\n')
+                source = 'uniprot'
+            elif interpro_sequence :
+                #L : a title that is not a UniProt accession is searched with the sequence it was submitted to InterPro with
+                sequence, source = interpro_sequence, 'interpro'
+            else :
+                self.progress.advance('unresolved')
+                continue
+            self.uniprot_done.writes(id, source, sequence)
+            self.progress.advance('resolved', final=False)
+            outputs.append((id, sequence))
+        return outputs
+
+    def blast_client(self) :
+        #L : the result cache holds one SQLite connection per thread and a RID ledger belongs to one client, so every BLAST worker has its own
+        client = getattr(self.local, 'client', None)
+        if client is None :
+            from ncbi_blast import NCBIBlastClient, RemoteBlastBackend
+            ledger_path = self.results_dir / f'.rid_ledger_{threading.current_thread().name}.json'
+            backend = RemoteBlastBackend(self.args.delay, self.args.pack_residues, ledger_path=ledger_path, poll_interval=self.args.blast_poll_interval, verbose=False)
+            client = self.local.client = NCBIBlastClient(self.results_dir, self.args.delay, self.args.pack_residues, backend=backend)
+        return client
+
+    def searches(self, batch) :
+        from ncbi_blast import BlastJob
+        client = self.blast_client()
+        jobs = [BlastJob(id=id, sequence=sequence, **self.options) for id, sequence in batch]
+        with self.progress.tracks() :
+            client.process_batch_jobs(jobs, verbose=False)
+        for job in jobs :
+            if client.results_manager.result_exists(job.id) :
+                self.blast_done.writes(job.id, 'done')
+                self.progress.advance('blasted')
+            else :
+                self.progress.advance('failed on BLAST')
+        return []
+
+    def runs(self) :
+        stages = [
+            Stage('uniprot', self.resolves, self.to_uniprot, self.to_blast, self.args.uniprot_workers, self.args.uniprot_batch, self.args.linger).start(),
+            Stage('blast', self.searches, self.to_blast, None, self.args.blast_workers, self.args.blast_batch, self.args.linger).start()
+        ]
+        start = time.time()
+        try :
+            with self.progress :
+                if self.args.file :
+                    from aftools_common.fasta_reader import FastaReader
+                    with FastaReader(self.workplace / self.args.file) as reader : self.client.batch_submits(reader)
+                self.resumes()
+                self.polls_interpro()
+                self.to_uniprot.put(END)
+                for stage in stages : stage.join()
+            for checkpoint in [self.interpro_done, self.uniprot_done, self.blast_done] : checkpoint.close()
+            self.names_file.close()
+        except KeyboardInterrupt :
+            #L : the checkpoints are written line by line, the workers are daemon threads and stop with the process
+            display.warning('We have stopped the pipeline, the next run resumes from the checkpoints.')
+            return 1
+
+        display.info(f'We have analysed {len(self.interpro_done)} InterPro results, resolved {len(self.uniprot_done)} proteins with keywords and BLASTed {len(self.blast_done)} of them in {time.time() - start:.0f} s.')
+        return 0
+
+
+def main() :
+    display.header('\nInterPro -> UniProt -> BLAST pipeline\n')
+
+    parser = argparse.ArgumentParser('Streams the proteins InterPro flags with a keyword into UniProt lookups and BLAST searches, every stage running while the previous one still produces')
+    parser.add_argument('-f', '--file', default = None, help = 'A fasta file in your workplace to submit to InterPro first, otherwise the jobs already in interpro_log.json are followed')
+    parser.add_argument('-k', '--keywords', type = ast.literal_eval, default = ['SIGNAL_PEPTIDE'], help = 'A list of the keywords that send a protein on to UniProt and BLAST')
+    parser.add_argument('-pi', '--poll_interval', type = float, default = 30, help = 'The delay between two status checks of the InterPro jobs')
+    parser.add_argument('-iw', '--interpro_workers', type = int, default = 8, help = 'The number of InterPro results downloaded and analysed at once')
+    parser.add_argument('-uw', '--uniprot_workers', type = int, default = 4, help = 'The number of UniProt batches fetched at once')
+    parser.add_argument('-bw', '--blast_workers', type = int, default = 1, help = 'The number of BLAST batches searched at once, every worker keeps its own RID ledger')
+    parser.add_argument('-ub', '--uniprot_batch', type = int, default = 100, help = 'The maximum number of ids of a UniProt request')
+    parser.add_argument('-bb', '--blast_batch', type = int, default = 50, help = 'The maximum number of proteins handed to BLAST at once, they are packed into submissions of at most --pack_residues')
+    parser.add_argument('-l', '--linger', type = float, default = 2, help = 'How long a stage waits for a batch to fill up before it runs a smaller one, in seconds')
+    parser.add_argument('-mb', '--memory_budget', type = int, default = None, help = 'The MB of sequences the InterPro log keeps in memory, the others are spilled to a temporary file in your workplace')
+    parser.add_argument('-qs', '--queue_size', type = int, default = 1000, help = 'The maximum number of proteins waiting between two stages')
+    parser.add_argument('-d', '--delay', type = float, default = 5, help = 'The delay between BLAST submissions')
+    parser.add_argument('-pr', '--pack_residues', type = int, default = 10000, help = 'The maximum number of residues packed into one BLAST submission')
+    parser.add_argument('-bpi', '--blast_poll_interval', type = float, default = 60, help = 'The delay between two status checks of a BLAST search')
+    parser.add_argument('-hs', '--hitlist_size', type = int, default = 50, help = 'The maximum number of hits kept for every query (default: 50)')
+    parser.add_argument('-ev', '--expect', type = float, default = 10.0, help = 'Only report hits under this e-value (default: 10)')
+    parser.add_argument('-fm', '--format', choices = ['XML', 'Tabular'], default = 'XML', help = 'The format of the BLAST results')
+    args = parser.parse_args()
+
+    return Pipeline(args).runs()
+
+
+if __name__ == '__main__' :
+    exit(main())